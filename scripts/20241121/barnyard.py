@@ -0,0 +1,355 @@
+"""
+Compute per-barcode species-mixing (barnyard) statistics in a single pass over a BAM file aligned to a
+combined genome (e.g., hg38 + mm10 with contigs prefixed 'h_' and 'm_'), or over a counts BED file
+generated by dedup.py from such a BAM file.
+
+Each fragment is classified by the species of its reference contig, using a contig-prefix map, and
+counted per barcode in integer arrays. No per-species BAM files are written.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+from helpers import barcode_getter, positive_int
+from counts import NO_BARCODE, read_counts
+
+import numpy as np
+import pandas as pd
+import pysam
+
+DEFAULT_SPECIES = {'h_': 'human', 'm_': 'mouse'}
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    species_prefixes = dict(s.split('=', 1) for s in args.species) if args.species else DEFAULT_SPECIES
+    if args.input.endswith('.bam') or args.input == '-':
+        barcodes, counts = barnyard_counts_bam(
+            args.input,
+            species_prefixes,
+            barcode_rgx=args.barcode_rgx,
+            barcode_tag=args.barcode_tag,
+            min_mapq=args.min_mapq,
+            dedup=args.dedup,
+            threads=args.threads
+        )
+    else:
+        barcodes, counts = barnyard_counts_bed(args.input, species_prefixes, use_counts=args.use_counts)
+    df = mixing_table(barcodes, counts, list(species_prefixes.values()), min_count=args.min_count, purity=args.purity)
+    df.to_csv(args.output if args.output is not None else sys.stdout, sep='\t', index=False)
+    summary = mixing_summary(df, list(species_prefixes.values()))
+    if args.summary is not None:
+        with open(args.summary, 'wt') as f:
+            json.dump(summary, f, indent=2)
+    else:
+        print(json.dumps(summary), file=sys.stderr)
+
+
+def contig_species(contigs, species_prefixes: dict) -> np.ndarray:
+    '''
+    Map each contig to a species index by name prefix.
+
+    Args
+    - contigs: sequence of str
+        Contig names
+    - species_prefixes: dict (str -> str)
+        Map from contig name prefix to species name. The order of entries defines species indices.
+
+    Returns: np.ndarray (int64), shape (len(contigs),)
+      Species index of each contig, or -1 if no prefix matches.
+    '''
+    species = np.full(len(contigs), -1, dtype=np.int64)
+    for i, contig in enumerate(contigs):
+        for j, prefix in enumerate(species_prefixes):
+            if contig.startswith(prefix):
+                species[i] = j
+                break
+    return species
+
+
+class BarcodeSpeciesCounter:
+    '''
+    Accumulate per-barcode, per-species counts in an integer array.
+
+    Observations are buffered and flushed with np.bincount, so the per-read cost is a dict lookup
+    and two list appends.
+    '''
+
+    def __init__(self, n_species: int, buffer_size: int = 1_000_000):
+        self.n_species = n_species
+        self.buffer_size = buffer_size
+        self.barcode_to_index = dict()
+        self.counts = np.zeros((0, n_species), dtype=np.int64)
+        self._index = []
+        self._species = []
+
+    def add(self, barcode, species: int):
+        index = self.barcode_to_index.setdefault(barcode, len(self.barcode_to_index))
+        self._index.append(index)
+        self._species.append(species)
+        if len(self._index) >= self.buffer_size:
+            self.flush()
+
+    def add_many(self, barcodes: np.ndarray, species: np.ndarray, weights: np.ndarray | None = None):
+        unique, inverse = np.unique(barcodes, return_inverse=True)
+        indices = np.fromiter(
+            (self.barcode_to_index.setdefault(b, len(self.barcode_to_index)) for b in unique.tolist()),
+            dtype=np.int64,
+            count=len(unique)
+        )
+        self._add_indices(indices[inverse], species, weights)
+
+    def _add_indices(self, indices, species, weights=None):
+        n_barcodes = len(self.barcode_to_index)
+        if n_barcodes > len(self.counts):
+            grown = np.zeros((max(n_barcodes, 2 * len(self.counts)), self.n_species), dtype=np.int64)
+            grown[:len(self.counts)] = self.counts
+            self.counts = grown
+        flat = np.bincount(
+            np.asarray(indices, dtype=np.int64) * self.n_species + np.asarray(species, dtype=np.int64),
+            weights=weights,
+            minlength=len(self.counts) * self.n_species
+        )
+        self.counts += flat.reshape(-1, self.n_species).astype(np.int64)
+
+    def flush(self):
+        if self._index:
+            self._add_indices(self._index, self._species)
+            self._index = []
+            self._species = []
+
+    def result(self):
+        '''
+        Returns: (barcodes, counts)
+        - barcodes: np.ndarray
+        - counts: np.ndarray (int64), shape (n_barcodes, n_species)
+        '''
+        self.flush()
+        barcodes = np.array(list(self.barcode_to_index.keys()))
+        return barcodes, self.counts[:len(barcodes)]
+
+
+def barnyard_counts_bam(
+    path_in_bam: str,
+    species_prefixes: dict,
+    barcode_rgx: str | None = None,
+    barcode_tag: str | None = None,
+    min_mapq: int = 0,
+    dedup: bool = False,
+    threads: int = 1
+):
+    '''
+    Count fragments per barcode and species from a BAM file aligned to a combined genome.
+
+    Each template is counted once, from its primary read 1 (paired-end) or its primary alignment
+    (single-end). Unmapped, secondary, and supplementary alignments are skipped.
+
+    Args
+    - path_in_bam: path to BAM file. Use '-' for standard in.
+    - species_prefixes: dict (str -> str)
+        Map from contig name prefix to species name.
+    - barcode_rgx: Regular expression for barcode in the read name
+        Currently only supports 1 capture group for an integer.
+    - barcode_tag: BAM tag with an integer barcode (e.g., from tag_barcodes.py). Mutually exclusive with barcode_rgx.
+    - min_mapq: minimum mapping quality
+    - dedup: count unique fragments (alignment coordinates + barcode) instead of reads
+    - threads: Number of threads to use for reading the BAM file
+
+    Returns: see BarcodeSpeciesCounter.result()
+    '''
+    get_barcode = barcode_getter(barcode_rgx, barcode_tag, default=NO_BARCODE)
+    path_in_bam = path_in_bam if path_in_bam != '-' else sys.stdin.buffer
+    counter = BarcodeSpeciesCounter(len(species_prefixes))
+    seen = set()
+    with pysam.AlignmentFile(path_in_bam, 'rb', threads=threads) as file_in:
+        species_of_refid = contig_species(file_in.references, species_prefixes).tolist()
+        for read in file_in.fetch(until_eof=True):
+            if read.is_unmapped or read.is_secondary or read.is_supplementary:
+                continue
+            if read.is_paired and not read.is_read1:
+                continue
+            if read.mapping_quality < min_mapq:
+                continue
+            species = species_of_refid[read.reference_id]
+            if species < 0:
+                continue
+            barcode = get_barcode(read)
+            if dedup:
+                if read.is_paired:
+                    entry = (read.reference_id, min(read.reference_start, read.next_reference_start),
+                             abs(read.template_length), barcode)
+                else:
+                    entry = (read.reference_id, read.reference_start, read.reference_end, barcode)
+                if entry in seen:
+                    continue
+                seen.add(entry)
+            counter.add(barcode, species)
+    return counter.result()
+
+
+def barnyard_counts_bed(path: str, species_prefixes: dict, use_counts: bool = False, chunksize: int = 10_000_000):
+    '''
+    Count fragments per barcode and species from a counts BED file generated by dedup.py.
+
+    Args
+    - path: path to counts BED file
+    - species_prefixes: dict (str -> str)
+        Map from contig name prefix to species name.
+    - use_counts: count reads (including duplicates) instead of unique fragments
+    - chunksize: number of rows to read at a time
+
+    Returns: see BarcodeSpeciesCounter.result()
+    '''
+    counter = BarcodeSpeciesCounter(len(species_prefixes))
+    for df in read_counts(path, usecols=['chr', 'barcode', 'count'], chunksize=chunksize):
+        chroms, chrom_index = np.unique(df['chr'].values, return_inverse=True)
+        species = contig_species(chroms.tolist(), species_prefixes)[chrom_index]
+        mask = species >= 0
+        counter.add_many(
+            df['barcode'].values[mask],
+            species[mask],
+            weights=df['count'].values[mask] if use_counts else None
+        )
+    return counter.result()
+
+
+def mixing_table(barcodes, counts, species_names, min_count: int = 100, purity: float = 0.9) -> pd.DataFrame:
+    '''
+    Per-barcode species-mixing table.
+
+    Args
+    - barcodes: np.ndarray, shape (n_barcodes,)
+    - counts: np.ndarray, shape (n_barcodes, n_species)
+    - species_names: list of str
+    - min_count: minimum total count for a barcode to be called
+    - purity: minimum fraction of counts from one species for a barcode to be called as that species
+
+    Returns: pd.DataFrame, sorted by barcode
+      Columns = barcode, <species...>, total, top_fraction, call
+      call is a species name, 'mixed', or 'low' (total < min_count)
+    '''
+    total = counts.sum(axis=1)
+    top = counts.argmax(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        top_fraction = np.where(total > 0, counts.max(axis=1) / total, 0)
+    call = np.where(top_fraction >= purity, np.asarray(species_names, dtype=object)[top], 'mixed')
+    call = np.where(total >= min_count, call, 'low')
+    df = pd.DataFrame(counts, columns=species_names)
+    df.insert(0, 'barcode', barcodes)
+    df['total'] = total
+    df['top_fraction'] = top_fraction
+    df['call'] = call
+    return df.sort_values('barcode').reset_index(drop=True)
+
+
+def mixing_summary(df: pd.DataFrame, species_names) -> dict:
+    '''
+    Summarize a mixing table.
+
+    Returns: dict
+    - n_barcodes: number of barcodes
+    - n_called: number of barcodes with total >= min_count
+    - calls: number of called barcodes per call
+    - collision_rate: fraction of called barcodes that are mixed
+    - doublet_rate_estimate: collision rate corrected for same-species doublets, assuming barcodes
+        are doublets of independently drawn species: collision_rate / (1 - sum_s p_s^2), where p_s
+        is the fraction of single-species barcodes of species s.
+    '''
+    calls = df['call'].value_counts()
+    n_called = int(calls.drop('low', errors='ignore').sum())
+    n_mixed = int(calls.get('mixed', 0))
+    n_single = np.array([calls.get(s, 0) for s in species_names], dtype=np.float64)
+    collision_rate = n_mixed / n_called if n_called > 0 else float('nan')
+    p = n_single / n_single.sum() if n_single.sum() > 0 else n_single
+    heterotypic = 1 - np.sum(p ** 2)
+    return {
+        'n_barcodes': len(df),
+        'n_called': n_called,
+        'calls': {k: int(v) for k, v in calls.items()},
+        'collision_rate': collision_rate,
+        'doublet_rate_estimate': collision_rate / heterotypic if heterotypic > 0 else float('nan'),
+    }
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Per-barcode species-mixing (barnyard) statistics from a combined-genome alignment."
+    )
+    parser.add_argument(
+        "input",
+        metavar="in.bam|counts.bed(.gz)|-",
+        help=("BAM file aligned to a combined genome, or a counts BED file generated by dedup.py from such "
+              "a BAM file. Use '-' for a BAM file from standard in.")
+    )
+    parser.add_argument(
+        "-o", "--output",
+        metavar="mixing.tsv",
+        help="Output per-barcode mixing table. If not provided, write to standard out."
+    )
+    parser.add_argument(
+        "--summary",
+        metavar="summary.json",
+        help="Output summary (collision rate, calls). If not provided, write to standard error."
+    )
+    parser.add_argument(
+        "-s", "--species",
+        action="append",
+        metavar="PREFIX=NAME",
+        help="Contig name prefix and species name. Can be repeated. Default: h_=human m_=mouse."
+    )
+    parser.add_argument(
+        "--barcode-rgx",
+        metavar="REGEX",
+        help="(BAM input) Regular expression for barcode in the read name."
+    )
+    parser.add_argument(
+        "--barcode-tag",
+        metavar="TAG",
+        help=("(BAM input) BAM tag with an integer barcode (e.g., XB, as written by tag_barcodes.py). "
+              "Mutually exclusive with --barcode-rgx.")
+    )
+    parser.add_argument(
+        "--min-mapq",
+        type=int,
+        default=0,
+        metavar="Q",
+        help="(BAM input) Minimum mapping quality."
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="(BAM input) Count unique fragments by alignment coordinates and barcode, instead of reads."
+    )
+    parser.add_argument(
+        "--use-counts",
+        action="store_true",
+        help="(Counts BED input) Count reads (including duplicates) instead of unique fragments."
+    )
+    parser.add_argument(
+        "--min-count",
+        type=int,
+        default=100,
+        metavar="N",
+        help="Minimum total count for a barcode to be called."
+    )
+    parser.add_argument(
+        "--purity",
+        type=float,
+        default=0.9,
+        help="Minimum fraction of counts from one species for a barcode to be called as that species."
+    )
+    parser.add_argument(
+        "-t", "--threads",
+        type=positive_int,
+        default=1,
+        metavar="#",
+        help="Number of threads to use for decompressing BAM files",
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main()
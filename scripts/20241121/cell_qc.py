@@ -0,0 +1,390 @@
+"""
+Per-barcode (per-cell) quality control from a counts BED file generated by dedup.py: fragment length
+distributions and enrichment of fragments at transcription start sites (TSS).
+
+TSSs are parsed once from a GTF file (e.g., canonical transcripts) into a sorted array per chromosome. The
+counts table is then read in chunks in a single pass; the distance from the midpoint of each fragment to the
+nearest TSS is found with a vectorized binary search (np.searchsorted), and each fragment is counted, per
+barcode, in its fragment length bin and as TSS-proximal (distance <= window) or flanking
+(flank_start <= distance < flank_end).
+
+TSS enrichment is the density (fragments per bp) of fragments within the window around TSSs divided by the
+density in the flanks, so that it is ~1 for fragments distributed uniformly around TSSs.
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+from counts import NO_BARCODE, read_counts
+
+import numpy as np
+import pandas as pd
+
+# fragment length ranges [min, max) of nucleosome-free and mononucleosomal fragments
+NUCLEOSOME_FREE = (0, 147)
+MONONUCLEOSOME = (147, 294)
+
+# columns of the per-barcode counts accumulated in addition to the fragment length bins
+EXTRA_COLUMNS = ['reads', 'nucleosome_free', 'mononucleosome', 'tss', 'flank']
+
+_NO_TSS = np.iinfo(np.int64).max
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    tss = read_tss(args.gtf, feature=args.feature)
+    qc = CellQC(
+        tss,
+        window=args.window,
+        flank=tuple(args.flank),
+        bin_size=args.bin_size,
+        max_length=args.max_length,
+        use_counts=args.use_counts
+    )
+    qc.add_file(args.input, chunksize=args.chunksize)
+    df = qc.table(min_fragments=args.min_fragments)
+    df.to_csv(args.output if args.output is not None else sys.stdout, sep='\t', index=False)
+    if args.histograms is not None:
+        qc.histograms(barcodes=df['barcode'].values).to_csv(args.histograms, sep='\t', index=False)
+    print(f'Computed QC metrics of {len(df)} barcodes from {qc.n_fragments} fragments.', file=sys.stderr)
+
+
+def read_tss(path: str, feature: str = 'transcript') -> dict:
+    '''
+    Read transcription start sites from a GTF file.
+
+    Args
+    - path: path to GTF file, optionally gzip-compressed
+    - feature: feature type (column 3) of the records whose 5' ends are TSSs
+
+    Returns: dict (str -> np.ndarray)
+      Map from chromosome name to sorted unique 0-based TSS positions (int64): start - 1 of records on the
+      + strand and end - 1 of records on the - strand.
+    '''
+    df = pd.read_csv(
+        path,
+        sep='\t',
+        header=None,
+        comment='#',
+        usecols=[0, 2, 3, 4, 6],
+        names=['chr', 'feature', 'start', 'end', 'strand'],
+        dtype={'chr': str, 'feature': str, 'start': np.int64, 'end': np.int64, 'strand': str}
+    )
+    df = df.loc[df['feature'] == feature]
+    assert len(df) > 0, f'ERROR: {path} has no records of feature type {feature}.'
+    positions = np.where(df['strand'].values == '-', df['end'].values, df['start'].values) - 1
+    return {
+        chrom: np.unique(positions[index])
+        for chrom, index in df.groupby('chr', sort=False).indices.items()
+    }
+
+
+def tss_distance(positions: np.ndarray, tss: np.ndarray) -> np.ndarray:
+    '''
+    Distance from each position to the nearest TSS.
+
+    Args
+    - positions: np.ndarray (int64)
+    - tss: np.ndarray (int64), sorted
+        TSS positions on the same chromosome
+
+    Returns: np.ndarray (int64), shape (len(positions),)
+      Absolute distance to the nearest TSS, or the maximum int64 value if there are no TSSs.
+    '''
+    if len(tss) == 0:
+        return np.full(len(positions), _NO_TSS, dtype=np.int64)
+    i = np.searchsorted(tss, positions)
+    left = tss[np.maximum(i - 1, 0)]
+    right = tss[np.minimum(i, len(tss) - 1)]
+    return np.minimum(np.abs(positions - left), np.abs(right - positions))
+
+
+class CellQC:
+    '''
+    Accumulate per-barcode fragment length histograms and TSS-proximal and flanking fragment counts over
+    chunks of a counts table.
+
+    Counts are stored in a single integer array (one row per barcode; one column per fragment length bin,
+    followed by EXTRA_COLUMNS) that grows as new barcodes are seen. Each chunk is added with one np.bincount
+    (or, if the chunk touches rows spread over a large array, one np.unique) over flattened (row, column)
+    indices.
+    '''
+
+    def __init__(
+        self,
+        tss: dict,
+        window: int = 1000,
+        flank: tuple = (1900, 2000),
+        bin_size: int = 10,
+        max_length: int = 1000,
+        use_counts: bool = False
+    ):
+        '''
+        Args
+        - tss: dict (str -> np.ndarray)
+            Sorted TSS positions per chromosome, as returned by read_tss()
+        - window: int. default=1000
+            Fragments whose midpoint is within this distance of a TSS are TSS-proximal.
+        - flank: (int, int). default=(1900, 2000)
+            Fragments whose midpoint is at a distance in [flank[0], flank[1]) from the nearest TSS are
+            flanking (background).
+        - bin_size: int. default=10
+            Width of fragment length bins
+        - max_length: int. default=1000
+            Fragments of at least this length are counted in the last bin.
+        - use_counts: bool. default=False
+            Count reads (including duplicates) instead of unique fragments. The reads column always counts reads.
+        '''
+        assert 0 <= window < flank[0] < flank[1], 'ERROR: The flanks must be outside of the TSS window.'
+        assert bin_size >= 1 and max_length >= bin_size
+        self.tss = tss
+        self.window = window
+        self.flank = flank
+        self.bin_size = bin_size
+        self.n_bins = max_length // bin_size + 1
+        self.use_counts = use_counts
+        self.n_columns = self.n_bins + len(EXTRA_COLUMNS)
+        self.barcode_to_index = dict()
+        self.counts = np.zeros((0, self.n_columns), dtype=np.int64)
+        self.n_fragments = 0
+
+    def _barcode_indices(self, barcodes: np.ndarray) -> np.ndarray:
+        unique, inverse = np.unique(barcodes, return_inverse=True)
+        indices = np.fromiter(
+            (self.barcode_to_index.setdefault(b, len(self.barcode_to_index)) for b in unique.tolist()),
+            dtype=np.int64,
+            count=len(unique)
+        )
+        n_barcodes = len(self.barcode_to_index)
+        if n_barcodes > len(self.counts):
+            grown = np.zeros((max(n_barcodes, 2 * len(self.counts)), self.n_columns), dtype=np.int64)
+            grown[:len(self.counts)] = self.counts
+            self.counts = grown
+        return indices[inverse]
+
+    def add(self, chroms: np.ndarray, starts: np.ndarray, ends: np.ndarray, barcodes: np.ndarray, reads: np.ndarray):
+        '''
+        Add fragments.
+
+        Args
+        - chroms: np.ndarray (str)
+        - starts, ends: np.ndarray (int64)
+            0-based, end-exclusive fragment coordinates
+        - barcodes: np.ndarray (int64)
+        - reads: np.ndarray (int64)
+            Number of reads (duplicates) of each fragment
+        '''
+        if len(chroms) == 0:
+            return
+        lengths = ends - starts
+        midpoints = (starts + ends) // 2
+        distance = np.full(len(chroms), _NO_TSS, dtype=np.int64)
+        # runs of rows on the same chromosome (one run per chromosome if rows are sorted by chromosome)
+        boundaries = np.concatenate(([0], np.flatnonzero(chroms[1:] != chroms[:-1]) + 1, [len(chroms)]))
+        for i_start, i_end in zip(boundaries[:-1].tolist(), boundaries[1:].tolist()):
+            tss = self.tss.get(chroms[i_start])
+            if tss is not None:
+                distance[i_start:i_end] = tss_distance(midpoints[i_start:i_end], tss)
+
+        rows = self._barcode_indices(barcodes)
+        weights = reads if self.use_counts else np.ones(len(rows), dtype=np.int64)
+        masks = {
+            'nucleosome_free': (lengths >= NUCLEOSOME_FREE[0]) & (lengths < NUCLEOSOME_FREE[1]),
+            'mononucleosome': (lengths >= MONONUCLEOSOME[0]) & (lengths < MONONUCLEOSOME[1]),
+            'tss': distance <= self.window,
+            'flank': (distance >= self.flank[0]) & (distance < self.flank[1]),
+        }
+        offsets = rows * self.n_columns
+        keys = [offsets + np.minimum(lengths // self.bin_size, self.n_bins - 1), offsets + self.n_bins]
+        values = [weights, reads]
+        for j, column in enumerate(EXTRA_COLUMNS[1:], start=self.n_bins + 1):
+            keys.append(offsets[masks[column]] + j)
+            values.append(weights[masks[column]])
+        keys = np.concatenate(keys)
+        values = np.concatenate(values)
+        flat = self.counts.reshape(-1)
+        low, high = keys.min(), keys.max() + 1
+        if high - low <= 4 * len(keys):
+            flat[low:high] += np.bincount(keys - low, weights=values, minlength=high - low).astype(np.int64)
+        else:
+            # many barcodes: avoid a dense temporary array spanning all of their rows
+            unique_keys, inverse = np.unique(keys, return_inverse=True)
+            flat[unique_keys] += np.bincount(inverse, weights=values).astype(np.int64)
+        self.n_fragments += len(rows)
+
+    def add_file(self, path: str, chunksize: int = 10_000_000):
+        '''
+        Add the fragments of a counts BED file generated by dedup.py, skipping fragments without a barcode.
+        '''
+        for df in read_counts(path, chunksize=chunksize):
+            df = df.loc[df['barcode'].values != NO_BARCODE]
+            self.add(
+                df['chr'].values,
+                df['start'].values,
+                df['end'].values,
+                df['barcode'].values,
+                df['count'].values
+            )
+
+    def _rows(self, min_fragments: int = 1, barcodes=None):
+        barcodes_all = np.fromiter(self.barcode_to_index.keys(), dtype=np.int64, count=len(self.barcode_to_index))
+        counts = self.counts[:len(barcodes_all)]
+        keep = counts[:, :self.n_bins].sum(axis=1) >= min_fragments
+        if barcodes is not None:
+            keep &= np.isin(barcodes_all, barcodes)
+        order = np.argsort(barcodes_all[keep], kind='stable')
+        return barcodes_all[keep][order], counts[keep][order]
+
+    def table(self, min_fragments: int = 1) -> pd.DataFrame:
+        '''
+        Per-barcode QC table.
+
+        Args
+        - min_fragments: minimum number of fragments (reads if use_counts) of a barcode to be included
+
+        Returns: pd.DataFrame, sorted by barcode
+          Columns
+          - barcode
+          - fragments: number of fragments (reads if use_counts)
+          - reads: number of reads, including duplicates
+          - median_length: median fragment length, at the resolution of the length bins (lower bin edge)
+          - fraction_nucleosome_free: fraction of fragments in NUCLEOSOME_FREE
+          - fraction_mononucleosome: fraction of fragments in MONONUCLEOSOME
+          - tss_fragments: number of TSS-proximal fragments
+          - flank_fragments: number of flanking fragments
+          - tss_fraction: fraction of fragments that are TSS-proximal
+          - tss_enrichment: density of TSS-proximal fragments / density of flanking fragments (NaN if there
+              are no flanking fragments)
+        '''
+        barcodes, counts = self._rows(min_fragments=min_fragments)
+        histograms = counts[:, :self.n_bins]
+        extra = dict(zip(EXTRA_COLUMNS, counts[:, self.n_bins:].T))
+        fragments = histograms.sum(axis=1)
+        median_bin = (np.cumsum(histograms, axis=1) * 2 < fragments[:, np.newaxis]).sum(axis=1)
+        window_size = 2 * self.window + 1
+        flank_size = 2 * (self.flank[1] - self.flank[0])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            df = pd.DataFrame({
+                'barcode': barcodes,
+                'fragments': fragments,
+                'reads': extra['reads'],
+                'median_length': median_bin * self.bin_size,
+                'fraction_nucleosome_free': extra['nucleosome_free'] / fragments,
+                'fraction_mononucleosome': extra['mononucleosome'] / fragments,
+                'tss_fragments': extra['tss'],
+                'flank_fragments': extra['flank'],
+                'tss_fraction': extra['tss'] / fragments,
+                'tss_enrichment': np.where(
+                    extra['flank'] > 0,
+                    (extra['tss'] / window_size) / (extra['flank'] / flank_size),
+                    np.nan
+                ),
+            })
+        return df
+
+    def histograms(self, barcodes=None) -> pd.DataFrame:
+        '''
+        Per-barcode fragment length histograms in long format.
+
+        Args
+        - barcodes: array-like. default=None
+            Barcodes to include. If None, include all barcodes.
+
+        Returns: pd.DataFrame, sorted by barcode and length
+          Columns = barcode, length (lower edge of the length bin), count. Only nonzero bins are included.
+        '''
+        barcodes, counts = self._rows(barcodes=barcodes)
+        i, j = np.nonzero(counts[:, :self.n_bins])
+        return pd.DataFrame({
+            'barcode': barcodes[i],
+            'length': j * self.bin_size,
+            'count': counts[i, j],
+        })
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description=("Per-barcode fragment length distributions and TSS enrichment from a counts BED file "
+                     "generated by dedup.py.")
+    )
+    parser.add_argument(
+        "input",
+        metavar="counts.bed(.gz)",
+        help="Counts BED file. Columns = chr, start, end, barcode, count."
+    )
+    parser.add_argument(
+        "-g", "--gtf",
+        required=True,
+        metavar="genes.gtf(.gz)",
+        help="GTF file of transcripts (e.g., canonical transcripts) whose 5' ends are TSSs."
+    )
+    parser.add_argument(
+        "-o", "--output",
+        metavar="cell_qc.tsv",
+        help="Output per-barcode QC table. If not provided, write to standard out."
+    )
+    parser.add_argument(
+        "--histograms",
+        metavar="lengths.tsv(.gz)",
+        help="Output per-barcode fragment length histograms. Columns = barcode, length, count."
+    )
+    parser.add_argument(
+        "--feature",
+        default="transcript",
+        help="Feature type (column 3) of the GTF records whose 5' ends are TSSs."
+    )
+    parser.add_argument(
+        "-w", "--window",
+        type=int,
+        default=1000,
+        metavar="BP",
+        help="Fragments whose midpoint is within this distance of a TSS are TSS-proximal."
+    )
+    parser.add_argument(
+        "--flank",
+        type=int,
+        nargs=2,
+        default=[1900, 2000],
+        metavar=("START", "END"),
+        help="Fragments whose midpoint is at a distance in [START, END) from the nearest TSS are background."
+    )
+    parser.add_argument(
+        "--bin-size",
+        type=int,
+        default=10,
+        metavar="BP",
+        help="Width of fragment length bins."
+    )
+    parser.add_argument(
+        "--max-length",
+        type=int,
+        default=1000,
+        metavar="BP",
+        help="Fragments of at least this length are counted in the last length bin."
+    )
+    parser.add_argument(
+        "--use-counts",
+        action="store_true",
+        help="Count reads (including duplicates) instead of unique fragments."
+    )
+    parser.add_argument(
+        "--min-fragments",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Minimum number of fragments of a barcode to be included in the outputs."
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=10_000_000,
+        metavar="N",
+        help="Number of rows of the counts BED file to read at a time."
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,311 @@
+"""
+Estimate library complexity and sequencing saturation from duplicate counts, overall and per barcode.
+
+Given a duplicate-count histogram (h_j = number of unique fragments observed exactly j times,
+n = sum_j j * h_j reads, S = sum_j h_j unique fragments), the expected number of unique
+fragments at a depth of m reads is computed by
+- rarefaction (m <= n): S(m) = sum_j h_j * (1 - (1 - m/n)^j)
+    Binomial approximation of sampling m reads without replacement from the n observed reads.
+- extrapolation (m > n): S(m) = S + f0 * (1 - (1 - f1 / (n * f0 + f1))^(m - n))
+    where f0 is the Chao1 estimate of the number of unobserved fragments.
+    Reference: Chao et al. 2014, Ecological Monographs 84(1): 45-67.
+
+All estimates are computed with vectorized NumPy operations over every barcode at once.
+"""
+
+import argparse
+import collections
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+from counts import read_counts
+from helpers import NO_BARCODE
+
+import numpy as np
+import pandas as pd
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    labels, group, j, h = histograms_from_counts_file(args.input, per_barcode=args.per_barcode is not None)
+    curve, total = library_complexity(j, h, extrapolate=args.extrapolate, step=args.step)
+    if args.curve:
+        curve.to_csv(args.curve, sep='\t', index=False)
+    if args.total:
+        total.to_frame().T.to_csv(args.total, sep='\t', index=False)
+    if args.per_barcode is not None:
+        df = barcode_saturation(labels, group, j, h, relative_depths=args.relative_depths)
+        df.to_csv(args.per_barcode, sep='\t', index=False)
+
+
+def histograms_from_counts(barcodes: np.ndarray, counts: np.ndarray):
+    '''
+    Build duplicate-count histograms per barcode.
+
+    Args
+    - barcodes: barcode of each unique fragment
+    - counts: number of reads (duplicates) of each unique fragment
+
+    Returns
+    - labels: np.ndarray, shape (n_barcodes,)
+        Sorted unique barcodes
+    - group: np.ndarray, shape (n_entries,)
+        Index into labels of each histogram entry
+    - j: np.ndarray, shape (n_entries,)
+        Duplicate count
+    - h: np.ndarray, shape (n_entries,)
+        Number of unique fragments of the barcode observed exactly j times
+    Histogram entries are sorted by group, then by j.
+    '''
+    labels, group = np.unique(np.asarray(barcodes), return_inverse=True)
+    counts = np.asarray(counts, dtype=np.int64)
+    keys = np.stack((group.astype(np.int64), counts))
+    entries, h = np.unique(keys, axis=1, return_counts=True)
+    return labels, entries[0], entries[1], h
+
+
+def histograms_from_counter(entries: collections.Counter):
+    '''
+    Build duplicate-count histograms per barcode from the Counter of fragments generated in dedup.py.
+
+    Args
+    - entries: map from (reference_id, start, end, barcode) to read count
+        barcode is '-' for fragments without a barcode; they are labeled NO_BARCODE.
+
+    Returns: see histograms_from_counts()
+    '''
+    barcodes = np.fromiter(
+        (NO_BARCODE if key[3] == '-' else key[3] for key in entries.keys()), dtype=np.int64, count=len(entries))
+    counts = np.fromiter(entries.values(), dtype=np.int64, count=len(entries))
+    return histograms_from_counts(barcodes, counts)
+
+
+def histograms_from_counts_file(path: str, per_barcode: bool = True, chunksize: int = 10_000_000):
+    '''
+    Build duplicate-count histograms from a counts BED file generated by dedup.py,
+    reading only the barcode and count columns.
+
+    Args
+    - path: path to counts BED file
+    - per_barcode: if False, pool all barcodes into a single histogram (with label -1).
+    - chunksize: number of rows to read at a time
+
+    Returns: see histograms_from_counts()
+    '''
+    chunk_histograms = collections.Counter()
+    usecols = ['barcode', 'count'] if per_barcode else ['count']
+    for df in read_counts(path, usecols=usecols, chunksize=chunksize):
+        barcodes = df['barcode'].values if per_barcode else np.full(len(df), -1)
+        labels, group, j, h = histograms_from_counts(barcodes, df['count'].values)
+        for barcode, count, n in zip(labels[group], j, h):
+            chunk_histograms[(barcode, count)] += n
+    keys = np.array(sorted(chunk_histograms.keys()), dtype=np.int64).reshape(-1, 2)
+    h = np.array([chunk_histograms[tuple(key)] for key in keys], dtype=np.int64)
+    labels, group = np.unique(keys[:, 0], return_inverse=True)
+    return labels, group, keys[:, 1], h
+
+
+def _group_sums(values: np.ndarray, group: np.ndarray, n_groups: int) -> np.ndarray:
+    '''
+    Sum rows of values (shape (n_entries,) or (n_entries, k)) by group.
+    '''
+    out = np.zeros((n_groups,) + values.shape[1:], dtype=np.float64)
+    np.add.at(out, group, values)
+    return out
+
+
+def complexity_statistics(group: np.ndarray, j: np.ndarray, h: np.ndarray, n_groups: int) -> dict:
+    '''
+    Summary statistics of each histogram group.
+
+    Returns: dict of np.ndarray, each of shape (n_groups,)
+    - reads: total number of reads (n)
+    - distinct: number of unique fragments (S)
+    - f1, f2: number of fragments observed exactly once or twice
+    - f0: Chao1 estimate of the number of unobserved fragments
+    '''
+    reads = _group_sums(j * h, group, n_groups)
+    distinct = _group_sums(h, group, n_groups)
+    f1 = _group_sums(h * (j == 1), group, n_groups)
+    f2 = _group_sums(h * (j == 2), group, n_groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correction = np.where(reads > 0, (reads - 1) / reads, 0)
+        f0 = np.where(
+            f2 > 0,
+            correction * f1 ** 2 / (2 * f2),
+            correction * f1 * np.maximum(f1 - 1, 0) / 2
+        )
+    return dict(reads=reads, distinct=distinct, f1=f1, f2=f2, f0=f0)
+
+
+def expected_distinct(
+    group: np.ndarray,
+    j: np.ndarray,
+    h: np.ndarray,
+    n_groups: int,
+    depths: np.ndarray
+) -> np.ndarray:
+    '''
+    Expected number of unique fragments at the given sequencing depths.
+
+    Args
+    - group, j, h: histograms, as returned by histograms_from_counts()
+    - n_groups: number of histogram groups
+    - depths: np.ndarray, shape (n_groups, n_depths) or (n_depths,)
+        Number of reads at which to evaluate the expected number of unique fragments.
+        A 1-D array is applied to every group.
+
+    Returns: np.ndarray, shape (n_groups, n_depths)
+    '''
+    stats = complexity_statistics(group, j, h, n_groups)
+    reads = stats['reads'][:, np.newaxis]
+    depths = np.broadcast_to(np.asarray(depths, dtype=np.float64), (n_groups, np.shape(depths)[-1]))
+
+    # rarefaction: interpolate from the observed histogram
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p_missing = np.clip(1 - depths / reads, 0, 1)
+    rarefied = _group_sums(
+        h[:, np.newaxis] * (1 - p_missing[group] ** j[:, np.newaxis]),
+        group,
+        n_groups
+    )
+
+    # extrapolation: Chao et al. 2014
+    distinct = stats['distinct'][:, np.newaxis]
+    f0 = stats['f0'][:, np.newaxis]
+    f1 = stats['f1'][:, np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        base = np.where(f0 > 0, 1 - f1 / (reads * f0 + f1), 1)
+    extrapolated = distinct + f0 * (1 - base ** np.maximum(depths - reads, 0))
+
+    return np.where(depths <= reads, rarefied, extrapolated)
+
+
+def library_complexity(
+    j: np.ndarray,
+    h: np.ndarray,
+    extrapolate: float = 30_000_000,
+    step: float = 100_000
+) -> tuple[pd.DataFrame, pd.Series]:
+    '''
+    Complexity curve and estimated total number of unique fragments of a library.
+    Histogram entries with the same duplicate count j are pooled.
+
+    Args
+    - j, h: duplicate-count histogram
+    - extrapolate: maximum number of reads at which to evaluate the curve
+    - step: step size (in reads) of the curve
+
+    Returns
+    - curve: pd.DataFrame
+        Columns = TOTAL_READS, EXPECTED_DISTINCT (same as preseq lc_extrap)
+    - total: pd.Series
+        Index = total_reads, distinct, pop_size_estimate
+    '''
+    group = np.zeros(len(j), dtype=np.int64)
+    depths = np.arange(0, extrapolate + step, step, dtype=np.float64)
+    curve = pd.DataFrame({
+        'TOTAL_READS': depths,
+        'EXPECTED_DISTINCT': expected_distinct(group, j, h, 1, depths)[0]
+    })
+    stats = complexity_statistics(group, j, h, 1)
+    total = pd.Series({
+        'total_reads': stats['reads'][0],
+        'distinct': stats['distinct'][0],
+        'pop_size_estimate': stats['distinct'][0] + stats['f0'][0]
+    })
+    return curve, total
+
+
+def barcode_saturation(
+    labels: np.ndarray,
+    group: np.ndarray,
+    j: np.ndarray,
+    h: np.ndarray,
+    relative_depths=(0.25, 0.5, 2, 4, 10)
+) -> pd.DataFrame:
+    '''
+    Per-barcode sequencing saturation and complexity estimates.
+
+    Args
+    - labels, group, j, h: histograms, as returned by histograms_from_counts()
+    - relative_depths: depths, relative to the observed number of reads of each barcode,
+        at which to estimate the expected number of unique fragments
+
+    Returns: pd.DataFrame
+      Columns
+      - barcode
+      - reads: number of reads
+      - distinct: number of unique fragments
+      - saturation: 1 - distinct / reads
+      - pop_size_estimate: Chao1 estimate of the total number of unique fragments
+      - distinct_x{depth}: expected unique fragments at each relative depth
+    '''
+    n_groups = len(labels)
+    stats = complexity_statistics(group, j, h, n_groups)
+    relative_depths = np.asarray(relative_depths, dtype=np.float64)
+    depths = stats['reads'][:, np.newaxis] * relative_depths[np.newaxis, :]
+    curves = expected_distinct(group, j, h, n_groups, depths)
+    df = pd.DataFrame({
+        'barcode': labels,
+        'reads': stats['reads'].astype(np.int64),
+        'distinct': stats['distinct'].astype(np.int64),
+        'saturation': 1 - stats['distinct'] / stats['reads'],
+        'pop_size_estimate': stats['distinct'] + stats['f0'],
+    })
+    for i, depth in enumerate(relative_depths):
+        df[f'distinct_x{depth:g}'] = curves[:, i]
+    return df
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description=("Estimate library complexity and sequencing saturation from a counts BED file "
+                     "generated by dedup.py.")
+    )
+    parser.add_argument(
+        "input",
+        metavar="counts.bed(.gz)",
+        help="Counts BED file. Columns = chr, start, end, barcode, count."
+    )
+    parser.add_argument(
+        "--curve",
+        metavar="curve.txt",
+        help="Output complexity curve of the library. Columns = TOTAL_READS, EXPECTED_DISTINCT."
+    )
+    parser.add_argument(
+        "--total",
+        metavar="total.txt",
+        help="Output estimated total number of unique fragments in the library."
+    )
+    parser.add_argument(
+        "--per-barcode",
+        metavar="barcodes.tsv",
+        help="Output per-barcode saturation table."
+    )
+    parser.add_argument(
+        "-e", "--extrapolate",
+        type=float,
+        default=30_000_000,
+        help="Maximum number of reads at which to evaluate the complexity curve."
+    )
+    parser.add_argument(
+        "-s", "--step",
+        type=float,
+        default=100_000,
+        help="Step size (in reads) of the complexity curve."
+    )
+    parser.add_argument(
+        "--relative-depths",
+        type=float,
+        nargs="+",
+        default=[0.25, 0.5, 2, 4, 10],
+        metavar="X",
+        help="Depths, relative to the observed depth of each barcode, at which to estimate unique fragments."
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+"""
+Build a sparse cell (barcode) x feature (genomic bin or peak) count matrix from a counts BED file
+generated by dedup.py.
+
+Fragments are streamed in chunks and mapped to features with vectorized searchsorted over features
+laid out on a single genome-wide coordinate (chromosome offset + position). Each chunk is reduced to a
+scipy.sparse CSR matrix and added to the running total, so memory scales with the number of nonzero
+entries rather than cells x features.
+
+Outputs
+- {prefix}.npz: CSR matrix (cells x features), saved with scipy.sparse.save_npz
+- {prefix}_barcodes.tsv: barcode of each row
+- {prefix}_features.bed: chr, start, end of each column
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+from helpers import parse_chrom_sizes
+from counts import NO_BARCODE, read_counts
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    chrom_sizes = parse_chrom_sizes(args.genome)
+    if args.peaks is not None:
+        features = Features.from_bed(args.peaks, chrom_sizes)
+    else:
+        features = Features.from_bins(chrom_sizes, args.bin_size)
+    matrix, barcodes = build_count_matrix(
+        read_counts(args.input, chunksize=args.chunksize),
+        features,
+        assign=args.assign,
+        use_counts=args.use_counts
+    )
+    if args.min_fragments > 1:
+        keep = np.asarray(matrix.sum(axis=1)).ravel() >= args.min_fragments
+        matrix, barcodes = matrix[keep], barcodes[keep]
+    save_count_matrix(args.output, matrix, barcodes, features)
+
+
+def chrom_offsets(chrom_sizes: dict) -> dict:
+    '''
+    Genome-wide coordinate of the start of each chromosome, with chromosomes concatenated in order.
+    '''
+    lengths = np.fromiter(chrom_sizes.values(), dtype=np.int64, count=len(chrom_sizes))
+    return dict(zip(chrom_sizes.keys(), np.r_[0, np.cumsum(lengths)[:-1]].tolist()))
+
+
+class Features:
+    '''
+    Sorted, non-overlapping genomic features on a genome-wide coordinate.
+
+    Attributes
+    - chrom_sizes: dict (str -> int)
+    - offsets: dict (str -> int)
+        Genome-wide coordinate of the start of each chromosome
+    - starts, ends: np.ndarray (int64)
+        Genome-wide feature coordinates (0-based, half-open)
+    '''
+
+    def __init__(self, chrom_sizes: dict, starts: np.ndarray, ends: np.ndarray):
+        self.chrom_sizes = chrom_sizes
+        self.offsets = chrom_offsets(chrom_sizes)
+        self.starts = starts
+        self.ends = ends
+        assert np.all(ends[:-1] <= starts[1:]), 'Features must be sorted and non-overlapping.'
+
+    def __len__(self):
+        return len(self.starts)
+
+    @classmethod
+    def from_bins(cls, chrom_sizes: dict, bin_size: int):
+        '''
+        Fixed-size bins tiling each chromosome; the last bin of each chromosome is truncated.
+        '''
+        starts, ends = [], []
+        offset = 0
+        for length in chrom_sizes.values():
+            bin_starts = np.arange(0, length, bin_size, dtype=np.int64)
+            starts.append(offset + bin_starts)
+            ends.append(offset + np.minimum(bin_starts + bin_size, length))
+            offset += length
+        return cls(chrom_sizes, np.concatenate(starts), np.concatenate(ends))
+
+    @classmethod
+    def from_bed(cls, path: str, chrom_sizes: dict):
+        '''
+        Features from a BED file (e.g., peaks). Features on chromosomes absent from chrom_sizes
+        are ignored. Overlapping features should be merged beforehand (e.g., bedtools merge).
+        '''
+        df = pd.read_csv(path, sep='\t', header=None, usecols=[0, 1, 2], names=['chr', 'start', 'end'],
+                         dtype={'chr': str, 'start': np.int64, 'end': np.int64}, comment='#')
+        df = df.loc[df['chr'].isin(chrom_sizes)]
+        offset = df['chr'].map(chrom_offsets(chrom_sizes)).values.astype(np.int64)
+        starts = offset + df['start'].values
+        ends = offset + df['end'].values
+        order = np.argsort(starts, kind='stable')
+        return cls(chrom_sizes, starts[order], ends[order])
+
+    def to_bed(self) -> pd.DataFrame:
+        '''
+        Features as a DataFrame with columns chr, start, end (chromosome coordinates).
+        '''
+        chroms = np.array(list(self.offsets.keys()))
+        offsets = np.fromiter(self.offsets.values(), dtype=np.int64, count=len(self.offsets))
+        idx = np.searchsorted(offsets, self.starts, side='right') - 1
+        return pd.DataFrame({
+            'chr': chroms[idx],
+            'start': self.starts - offsets[idx],
+            'end': self.ends - offsets[idx]
+        })
+
+    def assign(self, chroms: np.ndarray, starts: np.ndarray, ends: np.ndarray, assign: str = 'midpoint'):
+        '''
+        Map fragments to features.
+
+        Args
+        - chroms, starts, ends: fragment coordinates
+        - assign: 'midpoint' or 'overlap'
+            'midpoint': each fragment is assigned to the feature containing its midpoint.
+            'overlap': each fragment is assigned to every feature it overlaps.
+
+        Returns: (fragment_index, feature_index)
+          Index into the input fragments and the corresponding feature index, for each assignment.
+        '''
+        offset = pd.Series(chroms).map(self.offsets).values
+        valid = ~pd.isna(offset)
+        offset = np.where(valid, offset, 0).astype(np.int64)
+        g_starts = offset + starts
+        g_ends = offset + ends
+        if assign == 'midpoint':
+            midpoints = (g_starts + g_ends) // 2
+            feature = np.searchsorted(self.starts, midpoints, side='right') - 1
+            hit = valid & (feature >= 0)
+            hit[hit] &= midpoints[hit] < self.ends[feature[hit]]
+            return np.flatnonzero(hit), feature[hit]
+        # first feature ending after the fragment start; first feature starting at or after its end
+        first = np.searchsorted(self.ends, g_starts, side='right')
+        last = np.searchsorted(self.starts, g_ends, side='left')
+        n_hits = np.where(valid, np.maximum(last - first, 0), 0)
+        fragment_index = np.repeat(np.arange(len(starts)), n_hits)
+        within = np.arange(n_hits.sum()) - np.repeat(np.cumsum(n_hits) - n_hits, n_hits)
+        return fragment_index, np.repeat(first, n_hits) + within
+
+
+def build_count_matrix(chunks, features: Features, assign: str = 'midpoint', use_counts: bool = False):
+    '''
+    Build a cell x feature count matrix.
+
+    Args
+    - chunks: iterable of pd.DataFrame
+        Counts table (or chunks thereof), as from read_counts()
+    - features: Features
+    - assign: see Features.assign()
+    - use_counts: count reads (including duplicates) instead of unique fragments
+
+    Returns
+    - matrix: scipy.sparse.csr_matrix, shape (n_barcodes, n_features), dtype int32
+        Rows are sorted by barcode.
+    - barcodes: np.ndarray of barcodes of each row
+    '''
+    barcode_to_row = dict()
+    matrix = scipy.sparse.csr_matrix((0, len(features)), dtype=np.int32)
+    for df in chunks:
+        df = df.loc[df['barcode'].values != NO_BARCODE]
+        fragment_index, feature_index = features.assign(
+            df['chr'].values, df['start'].values, df['end'].values, assign=assign
+        )
+        unique_barcodes, inverse = np.unique(df['barcode'].values, return_inverse=True)
+        for barcode in unique_barcodes.tolist():
+            if barcode not in barcode_to_row:
+                barcode_to_row[barcode] = len(barcode_to_row)
+        chunk_rows = np.fromiter((barcode_to_row[b] for b in unique_barcodes.tolist()),
+                                 dtype=np.int64, count=len(unique_barcodes))
+        rows = chunk_rows[inverse[fragment_index]]
+        data = df['count'].values[fragment_index] if use_counts else np.ones(len(rows), dtype=np.int32)
+        shape = (len(barcode_to_row), len(features))
+        chunk_matrix = scipy.sparse.csr_matrix((data.astype(np.int32), (rows, feature_index)), shape=shape)
+        matrix.resize(shape)
+        matrix = matrix + chunk_matrix
+    barcodes = np.array(list(barcode_to_row.keys()), dtype=np.int64)
+    order = np.argsort(barcodes)
+    return matrix[order].tocsr(), barcodes[order]
+
+
+def save_count_matrix(prefix: str, matrix, barcodes: np.ndarray, features: Features):
+    '''
+    Save a count matrix as {prefix}.npz, {prefix}_barcodes.tsv, and {prefix}_features.bed.
+    '''
+    scipy.sparse.save_npz(f'{prefix}.npz', matrix, compressed=True)
+    pd.Series(barcodes).to_csv(f'{prefix}_barcodes.tsv', sep='\t', index=False, header=False)
+    features.to_bed().to_csv(f'{prefix}_features.bed', sep='\t', index=False, header=False)
+
+
+def load_count_matrix(prefix: str):
+    '''
+    Load a count matrix saved by save_count_matrix().
+
+    Returns
+    - matrix: scipy.sparse.csr_matrix
+    - barcodes: np.ndarray
+    - features: pd.DataFrame with columns chr, start, end
+    '''
+    matrix = scipy.sparse.load_npz(f'{prefix}.npz').tocsr()
+    barcodes = pd.read_csv(f'{prefix}_barcodes.tsv', sep='\t', header=None).iloc[:, 0].values
+    features = pd.read_csv(f'{prefix}_features.bed', sep='\t', header=None, names=['chr', 'start', 'end'])
+    return matrix, barcodes, features
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description=("Build a sparse cell x genomic-bin (or peak) count matrix from a counts BED file "
+                     "generated by dedup.py.")
+    )
+    parser.add_argument(
+        "input",
+        metavar="counts.bed(.gz)",
+        help="Counts BED file. Columns = chr, start, end, barcode, count."
+    )
+    parser.add_argument(
+        "-o", "--output",
+        required=True,
+        metavar="PREFIX",
+        help="Output prefix. Writes PREFIX.npz, PREFIX_barcodes.tsv, and PREFIX_features.bed."
+    )
+    parser.add_argument(
+        "-g", "--genome",
+        required=True,
+        metavar="PATH",
+        help=("Chromosome sizes file (columns = chromosome name, length), or a SAM/BAM file "
+              "whose header gives chromosome names and lengths.")
+    )
+    parser.add_argument(
+        "-b", "--bin-size",
+        type=int,
+        default=5000,
+        metavar="BP",
+        help="Size of genomic bins. Ignored if --peaks is given."
+    )
+    parser.add_argument(
+        "--peaks",
+        metavar="peaks.bed",
+        help="Use the (non-overlapping) regions in this BED file as features instead of genomic bins."
+    )
+    parser.add_argument(
+        "--assign",
+        choices=("midpoint", "overlap"),
+        default="midpoint",
+        help="Assign fragments to the feature containing their midpoint, or to every overlapping feature."
+    )
+    parser.add_argument(
+        "--use-counts",
+        action="store_true",
+        help="Count reads (including duplicates) instead of unique fragments."
+    )
+    parser.add_argument(
+        "--min-fragments",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Only keep barcodes with at least this many counts in the matrix."
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=10_000_000,
+        metavar="N",
+        help="Number of rows of the counts BED file to read at a time."
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main()
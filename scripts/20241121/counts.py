@@ -0,0 +1,81 @@
+"""
+Read counts BED files generated by dedup.py (columns = chr, start, end, barcode, count).
+"""
+
+import numpy as np
+import pandas as pd
+
+from helpers import NO_BARCODE
+
+COUNTS_COLUMNS = ['chr', 'start', 'end', 'barcode', 'count']
+COUNTS_DTYPES = {'chr': str, 'start': np.int64, 'end': np.int64, 'barcode': np.float64, 'count': np.int64}
+
+
+def _clean_counts(df: pd.DataFrame) -> pd.DataFrame:
+    if 'barcode' in df.columns:
+        df['barcode'] = df['barcode'].fillna(NO_BARCODE).astype(np.int64)
+    return df
+
+
+def read_counts(
+    path: str,
+    usecols: list[str] | None = None,
+    chunksize: int | None = None
+):
+    '''
+    Read a counts BED file generated by dedup.py.
+
+    Args
+    - path: path to counts BED file, optionally gzip-compressed
+    - usecols: subset of COUNTS_COLUMNS to read. If None, read all columns.
+    - chunksize: number of rows per chunk. If None, read the whole file at once.
+
+    Returns: pd.DataFrame, or iterator of pd.DataFrame if chunksize is given
+      Columns are a subset of COUNTS_COLUMNS. Missing barcodes ('-') are given as NO_BARCODE.
+    '''
+    usecols = COUNTS_COLUMNS if usecols is None else usecols
+    reader = pd.read_csv(
+        path,
+        sep='\t',
+        header=None,
+        names=COUNTS_COLUMNS,
+        usecols=usecols,
+        dtype={col: COUNTS_DTYPES[col] for col in usecols},
+        na_values={'barcode': ['-']},
+        keep_default_na=False,
+        chunksize=chunksize
+    )
+    if chunksize is None:
+        return _clean_counts(reader)
+    return (_clean_counts(chunk) for chunk in reader)
+
+
+def iter_chrom_blocks(chunks):
+    '''
+    Regroup chunks of a counts table (sorted by chromosome) into one DataFrame per chromosome.
+
+    Args
+    - chunks: iterable of pd.DataFrame, e.g., from read_counts(..., chunksize=...)
+        Rows of each chromosome must be contiguous.
+
+    Returns: iterator of (str, pd.DataFrame)
+      Chromosome name and all rows on that chromosome.
+    '''
+    chrom = None
+    pieces = []
+    for chunk in chunks:
+        values = chunk['chr'].values
+        boundaries = np.concatenate(([0], np.flatnonzero(values[1:] != values[:-1]) + 1, [len(chunk)]))
+        for i_start, i_end in zip(boundaries[:-1], boundaries[1:]):
+            if i_end == i_start:
+                continue
+            piece = chunk.iloc[i_start:i_end]
+            piece_chrom = values[i_start]
+            if piece_chrom != chrom:
+                if pieces:
+                    yield chrom, pd.concat(pieces, ignore_index=True)
+                chrom = piece_chrom
+                pieces = []
+            pieces.append(piece)
+    if pieces:
+        yield chrom, pd.concat(pieces, ignore_index=True)
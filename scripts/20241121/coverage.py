@@ -0,0 +1,373 @@
+"""
+Generate coverage tracks (bedGraph or bigWig) directly from a counts BED file generated by dedup.py.
+
+Coverage is computed from fragment coordinates with a sparse difference array: +weight at each
+fragment start and -weight at each fragment end, sorted by position and cumulatively summed to give
+piecewise-constant coverage between consecutive breakpoints. No per-base genome-length arrays are
+allocated, so per-barcode tracks are as cheap as library tracks.
+
+For paired-end libraries, the counts table holds one row per fragment (insert), so tracks give fragment
+coverage, unlike read coverage from a BAM file (e.g., bamCoverage without --extendReads), which counts each
+mate over its aligned length only.
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+from helpers import parse_chrom_sizes
+from counts import NO_BARCODE, iter_chrom_blocks, read_counts
+
+import numpy as np
+import pyBigWig
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    chrom_sizes = parse_chrom_sizes(args.genome)
+    barcodes = None
+    if args.per_barcode is not None:
+        barcodes = select_barcodes(args.input, min_fragments=args.min_fragments, path_barcodes=args.barcodes)
+    totals = None
+    if args.normalize == 'CPM':
+        totals = track_totals(args.input, use_counts=args.use_counts, barcodes=barcodes)
+    if args.output is not None:
+        write_coverage(
+            read_counts(args.input, chunksize=args.chunksize),
+            args.output,
+            chrom_sizes,
+            bin_size=args.bin_size,
+            use_counts=args.use_counts,
+            scale_factor=1e6 / totals[None] if totals is not None else 1
+        )
+    if barcodes is not None:
+        write_barcode_coverage(
+            read_counts(args.input, chunksize=args.chunksize),
+            args.per_barcode,
+            chrom_sizes,
+            barcodes,
+            bin_size=args.bin_size,
+            use_counts=args.use_counts,
+            scale_factors={b: 1e6 / totals[b] for b in barcodes} if totals is not None else None,
+            extension=args.format
+        )
+
+
+def fragment_runs(starts: np.ndarray, ends: np.ndarray, weights: np.ndarray | None = None):
+    '''
+    Compute piecewise-constant coverage of fragments on one chromosome.
+
+    Args
+    - starts, ends: fragment coordinates (0-based, half-open)
+    - weights: weight of each fragment. If None, each fragment has weight 1.
+
+    Returns: (run_starts, run_ends, values)
+      Runs of constant, nonzero coverage, sorted by position.
+    '''
+    if weights is None:
+        weights = np.ones(len(starts), dtype=np.float64)
+    positions = np.concatenate((starts, ends))
+    deltas = np.concatenate((weights, -weights)).astype(np.float64)
+    order = np.argsort(positions, kind='stable')
+    positions = positions[order]
+    cumulative = np.cumsum(deltas[order])
+    # coverage after the last delta at each unique position
+    is_last = np.r_[positions[1:] != positions[:-1], True]
+    breakpoints = positions[is_last]
+    values = cumulative[is_last]
+    run_starts = breakpoints[:-1]
+    run_ends = breakpoints[1:]
+    values = values[:-1]
+    mask = ~np.isclose(values, 0)
+    return run_starts[mask], run_ends[mask], values[mask]
+
+
+def bin_runs(run_starts, run_ends, values, bin_size: int, chrom_length: int):
+    '''
+    Average piecewise-constant coverage over fixed-size bins.
+
+    Args
+    - run_starts, run_ends, values: coverage runs, as returned by fragment_runs()
+    - bin_size: bin size (bp)
+    - chrom_length: chromosome length (bp). The last bin is truncated to the chromosome end.
+
+    Returns: (bin_starts, bin_ends, values)
+      Bins with nonzero mean coverage.
+    '''
+    if len(values) == 0:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, np.array([], dtype=np.float64)
+    # cumulative area under the coverage curve at each run start
+    area = np.concatenate(([0], np.cumsum(values * (run_ends - run_starts))))
+    edges = np.arange(0, chrom_length + bin_size, bin_size, dtype=np.int64)
+    edges[-1] = min(edges[-1], chrom_length)
+    edges = np.unique(edges)
+
+    # area up to each edge: area of complete runs to the left + partial area of the current run
+    k = np.searchsorted(run_starts, edges, side='right') - 1
+    k_clipped = np.clip(k, 0, None)
+    overlap = np.clip(edges - run_starts[k_clipped], 0, run_ends[k_clipped] - run_starts[k_clipped])
+    area_edges = np.where(k >= 0, area[k_clipped] + values[k_clipped] * overlap, 0)
+
+    bin_values = np.diff(area_edges) / np.diff(edges)
+    mask = bin_values != 0
+    return edges[:-1][mask], edges[1:][mask], bin_values[mask]
+
+
+def chrom_coverage(df, chrom_length: int, bin_size: int = 1, use_counts: bool = False, scale_factor: float = 1):
+    '''
+    Coverage runs (bin_size == 1) or binned mean coverage of the fragments in a counts table.
+
+    Args
+    - df: pd.DataFrame
+        Counts table rows on a single chromosome
+    - chrom_length: chromosome length (bp)
+    - bin_size: bin size (bp). If 1, return runs of constant coverage.
+    - use_counts: weight each unique fragment by its read count, instead of counting it once
+    - scale_factor: multiply coverage values by this factor
+
+    Returns: (starts, ends, values)
+    '''
+    weights = df['count'].values.astype(np.float64) if use_counts else None
+    starts, ends, values = fragment_runs(df['start'].values, df['end'].values, weights)
+    if bin_size > 1:
+        starts, ends, values = bin_runs(starts, ends, values, bin_size, chrom_length)
+    return starts, ends, values * scale_factor
+
+
+class TrackWriter:
+    '''
+    Write coverage intervals to a bedGraph or bigWig file, chosen by file extension.
+    Intervals must be added in chromosome (chrom_sizes) order and sorted by position.
+    '''
+
+    def __init__(self, path: str, chrom_sizes: dict):
+        self.is_bigwig = path.endswith(('.bw', '.bigWig', '.bigwig'))
+        if self.is_bigwig:
+            self.file = pyBigWig.open(path, 'w')
+            self.file.addHeader(list(chrom_sizes.items()))
+        else:
+            self.file = open(path, 'wt')
+
+    def add(self, chrom: str, starts, ends, values):
+        if len(starts) == 0:
+            return
+        if self.is_bigwig:
+            self.file.addEntries(
+                [chrom] * len(starts),
+                starts.astype(np.int64),
+                ends=ends.astype(np.int64),
+                values=values.astype(np.float64)
+            )
+        else:
+            for start, end, value in zip(starts.tolist(), ends.tolist(), values.tolist()):
+                self.file.write(f'{chrom}\t{start}\t{end}\t{value:g}\n')
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def write_coverage(chunks, path: str, chrom_sizes: dict, bin_size: int = 1, use_counts: bool = False, scale_factor: float = 1):
+    '''
+    Write a coverage track of all fragments.
+
+    Args
+    - chunks: iterable of pd.DataFrame
+        Counts table (or chunks thereof) sorted by chromosome, as from read_counts().
+    - path: output path. bigWig if the extension is .bw or .bigWig; bedGraph otherwise.
+    - chrom_sizes: dict (str -> int)
+        Map from chromosome name to length. Defines the chromosome order of the output.
+    - bin_size, use_counts, scale_factor: see chrom_coverage()
+    '''
+    chrom_order = {chrom: i for i, chrom in enumerate(chrom_sizes)}
+    previous = -1
+    with TrackWriter(path, chrom_sizes) as writer:
+        for chrom, df in iter_chrom_blocks(chunks):
+            assert chrom_order[chrom] > previous, \
+                f'Chromosome {chrom} of the counts table is out of order relative to the chromosome sizes.'
+            previous = chrom_order[chrom]
+            writer.add(chrom, *chrom_coverage(df, chrom_sizes[chrom], bin_size, use_counts, scale_factor))
+
+
+def write_barcode_coverage(
+    chunks,
+    directory: str,
+    chrom_sizes: dict,
+    barcodes,
+    bin_size: int = 1,
+    use_counts: bool = False,
+    scale_factors: dict | None = None,
+    extension: str = 'bw'
+):
+    '''
+    Write one coverage track per barcode.
+
+    Only fragments from the selected barcodes are kept in memory; each track is then written in a
+    single pass, so the number of simultaneously open files does not grow with the number of barcodes.
+
+    Args
+    - chunks: iterable of pd.DataFrame
+        Counts table (or chunks thereof), as from read_counts().
+    - directory: output directory. Tracks are named {barcode}.{extension}.
+    - chrom_sizes: dict (str -> int)
+    - barcodes: collection of barcodes for which to write tracks
+    - bin_size, use_counts: see chrom_coverage()
+    - scale_factors: dict (barcode -> float). default=None
+        Per-barcode scale factor. If None, no scaling.
+    - extension: 'bw' or 'bedGraph'
+    '''
+    os.makedirs(directory, exist_ok=True)
+    barcodes = np.asarray(sorted(barcodes), dtype=np.int64)
+    chrom_order = {chrom: i for i, chrom in enumerate(chrom_sizes)}
+    chrom_names = list(chrom_sizes)
+
+    # keep only the selected barcodes, as compact arrays
+    selected = dict(chrom=[], start=[], end=[], barcode=[], count=[])
+    for df in chunks:
+        df = df.loc[np.isin(df['barcode'].values, barcodes)]
+        selected['chrom'].append(df['chr'].map(chrom_order).values.astype(np.int32))
+        selected['start'].append(df['start'].values)
+        selected['end'].append(df['end'].values)
+        selected['barcode'].append(df['barcode'].values)
+        selected['count'].append(df['count'].values)
+    selected = {k: np.concatenate(v) if v else np.array([], dtype=np.int64) for k, v in selected.items()}
+
+    order = np.lexsort((selected['start'], selected['chrom'], selected['barcode']))
+    selected = {k: v[order] for k, v in selected.items()}
+    barcode_bounds = np.searchsorted(selected['barcode'], np.r_[barcodes, barcodes[-1] + 1] if len(barcodes) else [])
+    for i, barcode in enumerate(barcodes):
+        lo, hi = barcode_bounds[i], barcode_bounds[i + 1]
+        scale_factor = scale_factors[barcode] if scale_factors is not None else 1
+        chroms = selected['chrom'][lo:hi]
+        chrom_bounds = np.flatnonzero(np.r_[True, chroms[1:] != chroms[:-1], True])
+        with TrackWriter(os.path.join(directory, f'{barcode}.{extension}'), chrom_sizes) as writer:
+            for c_lo, c_hi in zip(chrom_bounds[:-1], chrom_bounds[1:]):
+                sl = slice(lo + c_lo, lo + c_hi)
+                weights = selected['count'][sl].astype(np.float64) if use_counts else None
+                starts, ends, values = fragment_runs(selected['start'][sl], selected['end'][sl], weights)
+                chrom = chrom_names[chroms[c_lo]]
+                if bin_size > 1:
+                    starts, ends, values = bin_runs(starts, ends, values, bin_size, chrom_sizes[chrom])
+                writer.add(chrom, starts, ends, values * scale_factor)
+
+
+def select_barcodes(path: str, min_fragments: int = 1, path_barcodes: str | None = None):
+    '''
+    Select barcodes for per-barcode tracks.
+
+    Args
+    - path: path to counts BED file
+    - min_fragments: minimum number of unique fragments of a barcode
+    - path_barcodes: path to a file listing barcodes (one per line). If given, only these
+        barcodes are considered.
+
+    Returns: np.ndarray of barcodes
+    '''
+    counts = read_counts(path, usecols=['barcode'])['barcode'].value_counts()
+    counts = counts.loc[counts.index != NO_BARCODE]
+    if path_barcodes is not None:
+        with open(path_barcodes, 'rt') as f:
+            allowed = [int(line.strip()) for line in f if line.strip() != '']
+        counts = counts.loc[counts.index.isin(allowed)]
+    return np.sort(counts.index[counts.values >= min_fragments].values)
+
+
+def track_totals(path: str, use_counts: bool = False, barcodes=None) -> dict:
+    '''
+    Total track weight (fragments, or reads if use_counts) overall (key None) and per selected barcode.
+    '''
+    df = read_counts(path, usecols=['barcode', 'count'])
+    weights = df['count'] if use_counts else np.ones(len(df), dtype=np.int64)
+    totals = {None: weights.sum()}
+    if barcodes is not None:
+        per_barcode = _sum_by_key(df['barcode'].values, np.asarray(weights))
+        totals.update({b: per_barcode.get(b, 0) for b in barcodes})
+    return totals
+
+
+def _sum_by_key(keys: np.ndarray, weights: np.ndarray) -> dict:
+    unique, inverse = np.unique(keys, return_inverse=True)
+    return dict(zip(unique.tolist(), np.bincount(inverse, weights=weights).tolist()))
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate bedGraph/bigWig coverage tracks from a counts BED file generated by dedup.py."
+    )
+    parser.add_argument(
+        "input",
+        metavar="counts.bed(.gz)",
+        help="Counts BED file. Columns = chr, start, end, barcode, count."
+    )
+    parser.add_argument(
+        "-g", "--genome",
+        required=True,
+        metavar="PATH",
+        help=("Chromosome sizes file (columns = chromosome name, length), or a SAM/BAM file "
+              "whose header gives chromosome names and lengths. Defines the output chromosome order.")
+    )
+    parser.add_argument(
+        "-o", "--output",
+        metavar="out.bw|out.bedGraph",
+        help="Output coverage track of all fragments. bigWig if the extension is .bw or .bigWig."
+    )
+    parser.add_argument(
+        "--per-barcode",
+        metavar="DIR",
+        help="Output directory for per-barcode coverage tracks."
+    )
+    parser.add_argument(
+        "--format",
+        choices=("bw", "bedGraph"),
+        default="bw",
+        help="File format of per-barcode coverage tracks."
+    )
+    parser.add_argument(
+        "--min-fragments",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Minimum number of unique fragments for a barcode to get a per-barcode track."
+    )
+    parser.add_argument(
+        "--barcodes",
+        metavar="PATH",
+        help="File of barcodes (one per line) to consider for per-barcode tracks."
+    )
+    parser.add_argument(
+        "-b", "--bin-size",
+        type=int,
+        default=1,
+        metavar="BP",
+        help="Average coverage over bins of this size. If 1, write runs of constant coverage."
+    )
+    parser.add_argument(
+        "--use-counts",
+        action="store_true",
+        help="Weight each unique fragment by its read count (i.e., include duplicates)."
+    )
+    parser.add_argument(
+        "--normalize",
+        choices=("none", "CPM"),
+        default="none",
+        help="Normalize each track to counts per million fragments (or reads, with --use-counts)."
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=10_000_000,
+        metavar="N",
+        help="Number of rows of the counts BED file to read at a time."
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,61 @@
 import argparse
+import array
+import bisect
 import collections
+import hashlib
 import os
-import re
 import sys
 
 sys.path.append(os.path.abspath(os.path.dirname(__file__)))
-from helpers import positive_int, grouper
+from fragment_store import write_fragment_store
+from helpers import NO_BARCODE, barcode_getter, positive_int, grouper
+from instrument import Stats
+from pipeline import run_pipeline
+from tag_barcodes import read_barcode_dictionary
 
+import numpy as np
 import pandas as pd
 import pysam
 
+_BASE_CODES = {base: code for code, base in enumerate('ACGT')}
 
-def main():
-    args = parse_arguments()
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    stats = Stats('dedup', progress_interval=args.progress)
+    saturation = None
+    if args.saturation or args.saturation_barcodes:
+        saturation = SaturationCounter(args.subsample_fractions, seed=args.subsample_seed)
+    barcode_sequences = None
+    if args.barcode_sequences:
+        path_dictionary, field = args.barcode_sequences
+        barcode_sequences = read_barcode_dictionary(path_dictionary, field=field)
     dedup_fun = dedup_paired_end if args.paired else dedup_single_end
-    dedup_fun(
+    df = dedup_fun(
         args.input,
         path_out_bam=args.output,
         path_out_bed=args.counts,
         barcode_rgx=args.barcode_rgx,
-        threads=args.threads
+        barcode_tag=args.barcode_tag,
+        threads=args.threads,
+        batch_size=args.batch_size,
+        saturation=saturation,
+        coordinate_tolerance=args.tolerance,
+        barcode_mismatches=args.barcode_mismatches,
+        barcode_sequences=barcode_sequences,
+        packed_barcodes=args.packed_barcodes,
+        stats=stats
     )
+    if args.fragments:
+        with stats.timer('fragment_store'):
+            write_fragment_store(args.fragments, df)
+    if args.saturation:
+        saturation.table().to_csv(args.saturation, sep='\t', index=False)
+    if args.saturation_barcodes:
+        saturation.barcode_table().to_csv(args.saturation_barcodes, sep='\t', index=False)
+    stats.progress(force=True)
+    if args.stats:
+        stats.write_json(args.stats)
 
 
 def dedup_single_end(
@@ -28,7 +63,15 @@ def dedup_single_end(
     path_out_bam: str | None = None,
     path_out_bed: str | None = None,
     barcode_rgx: str | None = None,
-    threads: int = 1
+    barcode_tag: str | None = None,
+    threads: int = 1,
+    batch_size: int = 1000,
+    saturation: 'SaturationCounter | None' = None,
+    coordinate_tolerance: int = 0,
+    barcode_mismatches: int = 0,
+    barcode_sequences: dict | None = None,
+    packed_barcodes: bool = False,
+    stats: Stats | None = None
 ) -> pd.DataFrame:
     '''
     Deduplicate aligned, single-end reads by genomic coordinates and optional barcode.
@@ -41,37 +84,36 @@ def dedup_single_end(
     - path_out_bed: path to output BED file of read counts.
     - barcode_rgx: Regular expression for barcode in the read name
         Currently only supports 1 capture group for an integer.
+    - barcode_tag: BAM tag with an integer barcode (e.g., from tag_barcodes.py). Mutually exclusive with barcode_rgx.
     - threads: Number of threads to use for reading and writing BAM files
+    - batch_size: Number of records per batch passed between the reader, deduplication, and writer threads.
+        If 0, read, deduplicate, and write in a single thread.
+    - saturation: SaturationCounter in which to record unique fragments at subsampled depths
+    - coordinate_tolerance, barcode_mismatches, barcode_sequences, packed_barcodes: see cluster_entries()
+        If coordinate_tolerance or barcode_mismatches is nonzero, reads are first counted by exact entry in a
+        separate pass over the input (which therefore cannot be standard in), and duplicates are identified
+        by cluster.
+    - stats: Stats object in which to record read counts, timings, and the size of the duplicate table
 
     Returns: Pandas DataFrame of read counts
         Columns = chr, start, end, barcode, count
         Coordinates are 0-based (BED format).
     '''
-    if barcode_rgx:
-        regex_barcode = re.compile(barcode_rgx)
-    path_out_bam = path_out_bam if path_out_bam is not None else sys.stdout.buffer
-    path_in_bam = path_in_bam if path_in_bam != '-' else sys.stdin.buffer
+    get_barcode = barcode_getter(barcode_rgx, barcode_tag, default='-')
 
-    entries = collections.Counter()
-    with pysam.AlignmentFile(path_in_bam, 'rb', threads=threads) as file_in:
-        header = file_in.header.to_dict()
-        with pysam.AlignmentFile(path_out_bam, 'wb', threads=threads, header=header) as file_out:
-            for read in file_in.fetch(until_eof=True):
-                barcode = int(regex_barcode.search(read.qname).groups()[0]) if barcode_rgx else '-'
-                entry = (read.reference_id, read.reference_start, read.reference_end, barcode)
-                if entry not in entries:
-                    file_out.write(read)
-                entries[entry] += 1
-    s = pd.Series(entries, name='count')
-    s.index.set_names(['chr', 'start', 'end', 'barcode'], inplace=True)
-    df = s.reset_index()
-    REFID_TO_CHR = {i: SQ['SN'] for i, SQ in enumerate(header['SQ'])}
-    DTYPE_REFID = pd.CategoricalDtype(categories=list(range(len(header['SQ']))), ordered=True)
-    df['chr'] = df['chr'].astype(DTYPE_REFID).cat.rename_categories(REFID_TO_CHR)
-    df.sort_values(['chr', 'start', 'end', 'barcode', 'count'], inplace=True)
-    if path_out_bed:
-        df.to_csv(path_out_bed, sep='\t', index=False, header=False)
-    return df
+    def get_entry(read):
+        return (read.reference_id, read.reference_start, read.reference_end, get_barcode(read))
+
+    return _dedup(
+        path_in_bam, path_out_bam, path_out_bed, get_entry,
+        paired=False,
+        threads=threads,
+        batch_size=batch_size,
+        saturation=saturation,
+        clustering=_clustering_params(
+            barcode_rgx or barcode_tag, coordinate_tolerance, barcode_mismatches, barcode_sequences, packed_barcodes),
+        stats=stats
+    )
 
 
 def dedup_paired_end(
@@ -79,7 +121,15 @@ def dedup_paired_end(
     path_out_bam: str | None,
     path_out_bed: str | None,
     barcode_rgx: str | None = None,
-    threads: int = 1
+    barcode_tag: str | None = None,
+    threads: int = 1,
+    batch_size: int = 1000,
+    saturation: 'SaturationCounter | None' = None,
+    coordinate_tolerance: int = 0,
+    barcode_mismatches: int = 0,
+    barcode_sequences: dict | None = None,
+    packed_barcodes: bool = False,
+    stats: Stats | None = None
 ):
     '''
     Deduplicate aligned, paired-end reads by genomic coordinates and optional barcode.
@@ -91,57 +141,496 @@ def dedup_paired_end(
     - path_out_bed: path to output sorted BED file of read counts.
     - barcode_rgx: Regular expression for barcode in the read name
         Currently only supports 1 capture group for an integer.
+    - barcode_tag: BAM tag with an integer barcode (e.g., from tag_barcodes.py). Mutually exclusive with barcode_rgx.
     - threads: Number of threads to use for reading and writing BAM files
+    - batch_size: Number of records per batch passed between the reader, deduplication, and writer threads.
+        If 0, read, deduplicate, and write in a single thread.
+    - saturation: SaturationCounter in which to record unique fragments at subsampled depths
+    - coordinate_tolerance, barcode_mismatches, barcode_sequences, packed_barcodes: see dedup_single_end()
+    - stats: Stats object in which to record read counts, timings, and the size of the duplicate table
 
     Returns: Pandas DataFrame of read counts
         Columns = chr, start, end, barcode, count
         Coordinates are 0-based (BED format).
     '''
-    if barcode_rgx:
-        regex_barcode = re.compile(barcode_rgx)
+    get_barcode = barcode_getter(barcode_rgx, barcode_tag, default='-')
+
+    def get_entry(pair):
+        read1, read2 = pair
+        assert read1.qname == read2.qname
+        assert read1.reference_name == read2.reference_name
+        assert read1.reference_end >= read1.reference_start
+        assert read2.reference_end >= read2.reference_start
+        assert read1.template_length == -read2.template_length
+
+        barcode = get_barcode(read1)
+
+        if read1.is_reverse:
+            assert read2.is_forward
+            entry = (read1.reference_id, read2.reference_start, read1.reference_end, barcode)
+        else:
+            assert read1.is_forward and read2.is_reverse
+            entry = (read1.reference_id, read1.reference_start, read2.reference_end, barcode)
+        assert entry[2] >= entry[1]
+        assert entry[2] - entry[1] == abs(read1.template_length)
+        return entry
+
+    return _dedup(
+        path_in_bam, path_out_bam, path_out_bed, get_entry,
+        paired=True,
+        threads=threads,
+        batch_size=batch_size,
+        saturation=saturation,
+        clustering=_clustering_params(
+            barcode_rgx or barcode_tag, coordinate_tolerance, barcode_mismatches, barcode_sequences, packed_barcodes),
+        stats=stats
+    )
+
+
+def _clustering_params(has_barcodes, coordinate_tolerance, barcode_mismatches, barcode_sequences, packed_barcodes):
+    assert coordinate_tolerance >= 0 and barcode_mismatches >= 0, 'Tolerances must be non-negative.'
+    if coordinate_tolerance == 0 and barcode_mismatches == 0:
+        return None
+    assert has_barcodes or barcode_mismatches == 0, 'Barcode mismatches require barcodes.'
+    _check_barcode_encoding(barcode_mismatches, barcode_sequences, packed_barcodes)
+    return dict(
+        coordinate_tolerance=coordinate_tolerance,
+        barcode_mismatches=barcode_mismatches,
+        barcode_sequences=barcode_sequences,
+        packed_barcodes=packed_barcodes
+    )
+
+
+def _check_barcode_encoding(barcode_mismatches, barcode_sequences, packed_barcodes):
+    assert not (barcode_sequences is not None and packed_barcodes), \
+        'Barcode sequences and packed barcodes are mutually exclusive.'
+    # integer barcodes (e.g., bead IDs from a read name or an XB tag) are not sequences unless declared so
+    assert barcode_mismatches == 0 or barcode_sequences is not None or packed_barcodes, (
+        'Barcode mismatches require barcode sequences (--barcode-sequences), or barcodes that are 2-bit packed '
+        'sequences (--packed-barcodes).'
+    )
+
+
+def _dedup(
+    path_in_bam,
+    path_out_bam,
+    path_out_bed,
+    get_entry,
+    paired,
+    threads=1,
+    batch_size=1000,
+    saturation=None,
+    clustering=None,
+    stats=None
+):
+    '''
+    Deduplicate reads (paired=False) or read pairs (paired=True) of a name-sorted BAM file by their entry.
+
+    Args
+    - get_entry: callable
+        Takes a read (or a (read1, read2) tuple) and returns its entry (reference_id, start, end, barcode).
+    - clustering: dict. default=None
+        Keyword arguments of cluster_entries(). If given, count entries in a first pass over the input, then
+        deduplicate by cluster: the reads of each cluster are counted under its representative entry, and
+        the first read (pair) of the representative entry is written.
+    - Other arguments: see dedup_single_end()
+    '''
     path_out_bam = path_out_bam if path_out_bam is not None else sys.stdout.buffer
+    assert not (clustering and path_in_bam == '-'), \
+        'Error-tolerant deduplication reads the input twice, so it cannot be read from standard in.'
     path_in_bam = path_in_bam if path_in_bam != '-' else sys.stdin.buffer
+    stats = stats if stats is not None else Stats('dedup')
+
+    def iter_records(file_in, counter='reads_in'):
+        reads = stats.iter(file_in.fetch(until_eof=True), counter=counter)
+        return grouper(reads, 2, incomplete='strict') if paired else reads
+
+    representatives = dict()
+    if clustering:
+        exact = collections.Counter()
+        with pysam.AlignmentFile(path_in_bam, 'rb', threads=threads) as file_in:
+            with stats.timer('count_entries'):
+                for record in iter_records(file_in, counter='reads_counted'):
+                    exact[get_entry(record)] += 1
+        with stats.timer('cluster_entries'):
+            representatives = cluster_entries(exact, **clustering)
+        stats.gauge('entries_exact', len(exact))
+        stats.gauge('entries_absorbed', len(representatives))
+        del exact
 
     entries = collections.Counter()
+    # representative entries whose first read (pair) has been written; without clustering, the entries
+    # counted so far
+    written = set() if clustering else entries
+    stats.gauge('dedup_entries', callback=lambda: len(entries))
     with pysam.AlignmentFile(path_in_bam, 'rb', threads=threads) as file_in:
         header = file_in.header.to_dict()
-        with pysam.AlignmentFile(path_out_bam, 'wb', threads=threads, header=header) as file_out:
-            for read1, read2 in grouper(file_in.fetch(until_eof=True), 2, incomplete='strict'):
-                assert read1.qname == read2.qname
-                assert read1.reference_name == read2.reference_name
-                assert read1.reference_end >= read1.reference_start
-                assert read2.reference_end >= read2.reference_start
-                assert read1.template_length == -read2.template_length
-    
-                barcode = int(regex_barcode.search(read1.qname).groups()[0]) if barcode_rgx else '-'
-                
-                if read1.is_reverse:
-                    assert read2.is_forward
-                    entry = (read1.reference_id, read2.reference_start, read1.reference_end, barcode)
+
+        def process(records):
+            out = []
+            for record in records:
+                entry = get_entry(record)
+                representative = representatives.get(entry)
+                if representative is None:
+                    representative = entry
+                    if entry not in written:
+                        if paired:
+                            out.extend(record)
+                        else:
+                            out.append(record)
+                        if clustering:
+                            written.add(entry)
+                if saturation is None:
+                    entries[representative] += 1
                 else:
-                    assert read1.is_forward and read2.is_reverse
-                    entry = (read1.reference_id, read1.reference_start, read2.reference_end, barcode)
-                assert entry[2] >= entry[1]
-                assert entry[2] - entry[1] == abs(read1.template_length)
-                if entry not in entries:
-                    file_out.write(read1)
-                    file_out.write(read2)
-                entries[entry] += 1
-    s = pd.Series(entries, name='count')
-    s.index.set_names(['chr', 'start', 'end', 'barcode'], inplace=True)
-    df = s.reset_index()
-    REFID_TO_CHR = {i: SQ['SN'] for i, SQ in enumerate(header['SQ'])}
-    DTYPE_REFID = pd.CategoricalDtype(categories=list(range(len(header['SQ']))), ordered=True)
-    df['chr'] = df['chr'].astype(DTYPE_REFID).cat.rename_categories(REFID_TO_CHR)
-    df.sort_values(['chr', 'start', 'end', 'barcode', 'count'], inplace=True)
-    if path_out_bed:
-        df.to_csv(path_out_bed, sep='\t', index=False, header=False)
+                    entries[representative] = saturation.add(
+                        record[0].qname if paired else record.qname,
+                        representative[3],
+                        entries.get(representative, 0)
+                    )
+            return out
+
+        with pysam.AlignmentFile(path_out_bam, 'wb', threads=threads, header=header) as file_bam_out:
+            run_pipeline(
+                iter_records(file_in),
+                process,
+                stats.writer(file_bam_out).write,
+                batch_size=max(batch_size // 2 if paired else batch_size, 1),
+                threaded=batch_size > 0,
+                stats=stats
+            )
+    if saturation is not None:
+        saturation.unpack_entries(entries)
+    with stats.timer('counts_table'):
+        s = pd.Series(entries, name='count')
+        s.index.set_names(['chr', 'start', 'end', 'barcode'], inplace=True)
+        df = s.reset_index()
+        REFID_TO_CHR = {i: SQ['SN'] for i, SQ in enumerate(header['SQ'])}
+        DTYPE_REFID = pd.CategoricalDtype(categories=list(range(len(header['SQ']))), ordered=True)
+        df['chr'] = df['chr'].astype(DTYPE_REFID).cat.rename_categories(REFID_TO_CHR)
+        df.sort_values(['chr', 'start', 'end', 'barcode', 'count'], inplace=True)
+        if path_out_bed:
+            df.to_csv(path_out_bed, sep='\t', index=False, header=False)
     return df
 
 
-def parse_arguments():
+def cluster_entries(
+    entries: dict,
+    coordinate_tolerance: int = 0,
+    barcode_mismatches: int = 0,
+    barcode_sequences: dict | None = None,
+    packed_barcodes: bool = False
+) -> dict:
+    '''
+    Cluster dedup entries that likely derive from the same molecule despite end jitter and barcode errors.
+
+    2 entries are adjacent if they are on the same reference, their starts and their ends each differ by at
+    most coordinate_tolerance, and their barcodes are within barcode_mismatches (Hamming distance). Adjacent
+    pairs are found by sweeping over the coordinate-sorted entries with a window of the entries whose start
+    is within coordinate_tolerance, indexed by barcode; candidate barcodes are looked up in a
+    BarcodeNeighbors index instead of compared against every barcode in the window.
+
+    Clusters are formed greedily: in order of decreasing count (ties in coordinate order), each entry not yet
+    in a cluster becomes the representative of a new cluster and absorbs its adjacent entries not yet in a
+    cluster. Absorbed entries do not absorb their own neighbors, so clusters do not chain along the genome.
+
+    Args
+    - entries: dict (tuple -> int)
+        Map from entry (reference_id, start, end, barcode) to read count
+    - coordinate_tolerance: int. default=0
+        Maximum difference in start and in end coordinates, in bp
+    - barcode_mismatches: int. default=0
+        Maximum Hamming distance between barcodes. If 0, only entries with identical barcodes are adjacent.
+    - barcode_sequences: dict (int -> str). default=None
+        Barcode sequence of each integer barcode (e.g., from a barcode dictionary written by
+        tag_barcodes.py). See BarcodeNeighbors.
+    - packed_barcodes: bool. default=False
+        Integer barcodes are 2-bit packed sequence keys (e.g., as written by parse_barcodes.py --pack).
+        If barcode_mismatches > 0, either barcode_sequences must be given or packed_barcodes must be True:
+        other integer barcodes (e.g., bead IDs) have no sequence to compare.
+
+    Returns: dict (tuple -> tuple)
+        Map from each absorbed entry to the representative entry of its cluster. Representatives are not
+        keys.
+    '''
+    _check_barcode_encoding(barcode_mismatches, barcode_sequences, packed_barcodes)
+    keys = sorted(entries)
+    n = len(keys)
+    neighbors = None
+    if barcode_mismatches > 0:
+        neighbors = BarcodeNeighbors(
+            set(key[3] for key in keys), barcode_mismatches, sequences=barcode_sequences, packed=packed_barcodes)
+
+    # sweep: edges between adjacent entries, as indices into keys
+    edges = array.array('q')
+    window = collections.deque()
+    window_barcodes = dict()  # barcode -> deque of indices in window, in coordinate order
+    for i, (reference_id, start, end, barcode) in enumerate(keys):
+        while window and (keys[window[0]][0] != reference_id or keys[window[0]][1] < start - coordinate_tolerance):
+            j = window.popleft()
+            indices = window_barcodes[keys[j][3]]
+            indices.popleft()
+            if not indices:
+                del window_barcodes[keys[j][3]]
+        if neighbors is None:
+            candidates = (barcode,)
+        else:
+            candidates = neighbors(barcode)
+            if len(candidates) > len(window_barcodes):
+                candidates = [b for b in window_barcodes if neighbors.distance(barcode, b) <= barcode_mismatches]
+        for b in candidates:
+            for j in window_barcodes.get(b, ()):
+                if abs(keys[j][2] - end) <= coordinate_tolerance:
+                    edges.extend((i, j, j, i))
+        window.append(i)
+        window_barcodes.setdefault(barcode, collections.deque()).append(i)
+    del window, window_barcodes
+
+    # adjacency lists in compressed sparse row format
+    edges = np.frombuffer(edges, dtype=np.int64).reshape(-1, 2)
+    edges = edges[np.argsort(edges[:, 0], kind='stable')]
+    indptr = np.searchsorted(edges[:, 0], np.arange(n + 1)).tolist()
+    adjacent = edges[:, 1].tolist()
+    del edges
+
+    counts = np.fromiter((entries[key] for key in keys), dtype=np.int64, count=n)
+    assigned = bytearray(n)
+    representatives = dict()
+    for i in np.argsort(-counts, kind='stable').tolist():
+        if assigned[i]:
+            continue
+        assigned[i] = 1
+        for j in adjacent[indptr[i]:indptr[i + 1]]:
+            if not assigned[j]:
+                assigned[j] = 1
+                representatives[keys[j]] = keys[i]
+    return representatives
+
+
+class BarcodeNeighbors:
+    '''
+    Index of barcodes for finding all barcodes within a Hamming distance of a barcode.
+
+    Barcodes are compared as 2-bit packed sequences (1 sentinel bit followed by 2 bits per base, first base
+    most significant; see scripts/sequence_encoding.py), so barcodes of different lengths never match. By the
+    pigeonhole principle, 2 sequences within max_mismatches of each other are identical in at least 1 of
+    max_mismatches + 1 segments, so only barcodes sharing a segment are compared.
+    '''
+
+    def __init__(self, barcodes, max_mismatches, sequences=None, packed=False):
+        '''
+        Args
+        - barcodes: iterable of int
+        - max_mismatches: int
+        - sequences: dict (int -> str). default=None
+            Sequence of each barcode. Barcodes without a sequence or with a sequence containing bases other
+            than A, C, G, and T only match themselves.
+        - packed: bool. default=False
+            Barcodes are 2-bit packed sequences. Barcodes that are not positive integers (e.g., NO_BARCODE)
+            only match themselves. Exactly one of sequences and packed must be given.
+        '''
+        assert (sequences is not None) != packed, 'Give either barcode sequences or packed=True.'
+        self.max_mismatches = max_mismatches
+        self.keys = dict()
+        self.segments = collections.defaultdict(list)
+        self.cache = dict()
+        for barcode in barcodes:
+            key = self.encode(barcode, sequences)
+            if key is None:
+                continue
+            self.keys[barcode] = key
+            for segment in self._segments(key):
+                self.segments[segment].append(barcode)
+
+    @staticmethod
+    def encode(barcode, sequences=None):
+        '''
+        Returns: int or None
+            2-bit packed sequence of the barcode, or None if it has none
+        '''
+        if sequences is None:
+            return barcode if isinstance(barcode, int) and barcode > 0 else None
+        sequence = sequences.get(barcode)
+        if sequence is None:
+            return None
+        key = 1
+        for base in sequence:
+            code = _BASE_CODES.get(base)
+            if code is None:
+                return None
+            key = (key << 2) | code
+        return key
+
+    def _segments(self, key):
+        length = (key.bit_length() - 1) // 2
+        n_segments = self.max_mismatches + 1
+        for i in range(n_segments):
+            start, end = i * length // n_segments, (i + 1) * length // n_segments
+            value = (key >> (2 * (length - end))) & ((1 << (2 * (end - start))) - 1)
+            yield (length, i, value)
+
+    def distance(self, barcode1, barcode2):
+        '''
+        Returns: int or float
+            Hamming distance between 2 barcodes, or infinity if their lengths differ or either has no
+            sequence (unless they are the same barcode)
+        '''
+        if barcode1 == barcode2:
+            return 0
+        key1 = self.keys.get(barcode1)
+        key2 = self.keys.get(barcode2)
+        if key1 is None or key2 is None or key1.bit_length() != key2.bit_length():
+            return float('inf')
+        diff = key1 ^ key2
+        length = (key1.bit_length() - 1) // 2
+        return ((diff | (diff >> 1)) & ((4**length - 1) // 3)).bit_count()
+
+    def __call__(self, barcode):
+        '''
+        Returns: list
+            Barcodes within max_mismatches of barcode, including itself
+        '''
+        neighbors = self.cache.get(barcode)
+        if neighbors is None:
+            key = self.keys.get(barcode)
+            if key is None:
+                neighbors = [barcode]
+            else:
+                candidates = set()
+                for segment in self._segments(key):
+                    candidates.update(self.segments[segment])
+                neighbors = [b for b in candidates if self.distance(barcode, b) <= self.max_mismatches]
+            self.cache[barcode] = neighbors
+        return neighbors
+
+
+class SaturationCounter:
+    '''
+    Unique fragment counts at multiple subsampled sequencing depths, computed in a single pass.
+
+    Each read (pair) is assigned a uniform value u in [0, 1) derived from a hash of its read name, and is
+    included in the subsample at fraction f if u < f. Subsamples are therefore nested and deterministic
+    (the same read is always kept or dropped at a given fraction and seed). A fragment (dedup entry) is
+    present in a subsample if any of its reads is.
+
+    The level of a fragment (the smallest subsample that includes it) is stored in the count of its dedup
+    entry, packed as count * n_levels + level, rather than in a second map keyed by every entry. Most packed
+    values remain small integers, which Python shares between entries.
+    '''
+
+    def __init__(self, fractions, seed=0):
+        '''
+        Args
+        - fractions: iterable of float in (0, 1]
+            Subsampling fractions
+        - seed: int. default=0
+            Different seeds give independent subsamples.
+        '''
+        self.fractions = sorted(set(fractions))
+        assert all(0 < f <= 1 for f in self.fractions), 'Subsampling fractions must be in (0, 1].'
+        self.key = str(seed).encode()
+        # level of a read = index of the smallest fraction whose subsample includes the read
+        self.n_levels = len(self.fractions) + 1
+        self.reads = np.zeros(self.n_levels, dtype=np.int64)
+        self.barcode_reads = collections.Counter()
+        # level and barcode of each unique fragment, set by unpack_entries()
+        self.entry_levels = np.zeros(0, dtype=np.int64)
+        self.entry_barcodes = np.zeros(0, dtype=np.int64)
+
+    def level(self, qname):
+        digest = hashlib.blake2b(qname.encode(), digest_size=8, key=self.key).digest()
+        return bisect.bisect_right(self.fractions, int.from_bytes(digest, 'little') / 2**64)
+
+    def add(self, qname, barcode, packed=0):
+        '''
+        Record a read (pair) of a dedup entry.
+
+        Args
+        - qname: str
+            Read name
+        - barcode: int
+            Barcode of the entry
+        - packed: int. default=0
+            Packed count and level of the entry before this read (0 if the entry is new)
+
+        Returns: int
+            Packed count and level of the entry including this read
+        '''
+        level = self.level(qname)
+        self.reads[level] += 1
+        self.barcode_reads[(barcode, level)] += 1
+        if packed == 0:
+            return self.n_levels + level
+        count, entry_level = divmod(packed, self.n_levels)
+        return (count + 1) * self.n_levels + min(level, entry_level)
+
+    def unpack_entries(self, entries):
+        '''
+        Record the level of each dedup entry and replace its packed value, in place, by its read count.
+
+        Args
+        - entries: dict (tuple -> int)
+            Map from entry (reference_id, start, end, barcode) to packed count and level, as returned by add()
+        '''
+        n = len(entries)
+        packed = np.fromiter(entries.values(), dtype=np.int64, count=n)
+        self.entry_levels = packed % self.n_levels
+        # entries without a barcode have barcode '-' (the barcode_getter default)
+        self.entry_barcodes = np.fromiter(
+            (NO_BARCODE if entry[3] == '-' else entry[3] for entry in entries), dtype=np.int64, count=n)
+        for entry, count in zip(entries, (packed // self.n_levels).tolist()):
+            entries[entry] = count
+
+    def table(self):
+        '''
+        Returns: pd.DataFrame
+            Columns = fraction, reads, unique, duplication_rate
+        '''
+        unique = np.bincount(self.entry_levels, minlength=self.n_levels)
+        df = pd.DataFrame({
+            'fraction': self.fractions,
+            'reads': np.cumsum(self.reads)[:len(self.fractions)],
+            'unique': np.cumsum(unique)[:len(self.fractions)],
+        })
+        df['duplication_rate'] = 1 - df['unique'] / df['reads'].where(df['reads'] > 0)
+        return df
+
+    def barcode_table(self):
+        '''
+        Returns: pd.DataFrame
+            Columns = barcode, fraction, reads, unique. Barcodes without reads at a fraction are omitted.
+        '''
+        n_levels = len(self.fractions)
+        reads = pd.Series(self.barcode_reads, dtype=np.int64)
+        unique = pd.Series(
+            collections.Counter(
+                ('-' if barcode == NO_BARCODE else barcode, level)
+                for barcode, level in zip(self.entry_barcodes.tolist(), self.entry_levels.tolist())
+            ),
+            dtype=np.int64
+        )
+        df = pd.DataFrame({'reads': reads, 'unique': unique}).fillna(0).astype(np.int64)
+        df.index.set_names(['barcode', 'level'], inplace=True)
+        df = df.reset_index()
+        df = df.loc[df['level'] < n_levels]
+        # cumulative counts over levels within each barcode, evaluated at every level
+        df = (
+            df.pivot_table(index='barcode', columns='level', values=['reads', 'unique'], fill_value=0)
+            .reindex(columns=pd.MultiIndex.from_product([['reads', 'unique'], range(n_levels)]), fill_value=0)
+        )
+        df = df['reads'].cumsum(axis=1).stack().rename('reads').to_frame().join(
+            df['unique'].cumsum(axis=1).stack().rename('unique'))
+        df.index.set_names(['barcode', 'level'], inplace=True)
+        df = df.reset_index()
+        df = df.loc[df['reads'] > 0]
+        df.insert(1, 'fraction', np.asarray(self.fractions)[df['level'].values])
+        return df.drop(columns='level').astype({'reads': np.int64, 'unique': np.int64})
+
+
+def parse_arguments(argv=None):
     parser = argparse.ArgumentParser(
-        description="Remove duplicate reads based on identical genomic alignment coordinates."
+        description=("Remove duplicate reads based on identical genomic alignment coordinates, or, with "
+                     "--tolerance or --barcode-mismatches, clusters of nearly identical coordinates and barcodes.")
     )
     parser.add_argument(
         "input",
@@ -158,6 +647,12 @@ def parse_arguments():
         metavar="counts.bed(.gz)",
         help="Output counts BED file. Columns = chr, start, end, barcode, count."
     )
+    parser.add_argument(
+        "--fragments",
+        metavar="DIR",
+        help=("Output directory of a memory-mapped columnar fragment store of the counts table, with "
+              "chromosome and barcode indices for region and cell queries (see fragment_store.py).")
+    )
     parser.add_argument(
         "-p", "--paired",
         action="store_true",
@@ -176,7 +671,92 @@ def parse_arguments():
         help=("Regular expression for barcode in the read name. Identify duplicates by "
               "alignment coordinates and barcode.")
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--barcode-tag",
+        metavar="TAG",
+        help=("BAM tag with an integer barcode (e.g., XB, as written by tag_barcodes.py). Identify duplicates "
+              "by alignment coordinates and barcode. Mutually exclusive with --barcode-rgx.")
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=int,
+        default=0,
+        metavar="BP",
+        help=("Treat fragments whose start and end coordinates each differ by at most this many bp as duplicates "
+              "(e.g., of Tn5 end jitter). Duplicates are clustered greedily around the fragment with the most "
+              "reads. Requires reading the input twice, so the input cannot be standard in.")
+    )
+    parser.add_argument(
+        "--barcode-mismatches",
+        type=int,
+        default=0,
+        metavar="N",
+        help=("Treat fragments whose barcodes differ by at most this many substitutions as duplicates. Barcodes "
+              "are compared as sequences given by --barcode-sequences, or as 2-bit packed sequences with "
+              "--packed-barcodes; one of the two is required. Requires reading the input twice, so the input "
+              "cannot be standard in.")
+    )
+    parser.add_argument(
+        "--barcode-sequences",
+        nargs=2,
+        metavar=("barcodes.tsv", "FIELD"),
+        help=("Barcode dictionary written by tag_barcodes.py and the field whose values are the barcode "
+              "sequences (e.g., a field encoded with FIELD=TAG:dict), for --barcode-mismatches.")
+    )
+    parser.add_argument(
+        "--packed-barcodes",
+        action="store_true",
+        help=("Integer barcodes are 2-bit packed sequences (e.g., from parse_barcodes.py --pack), for "
+              "--barcode-mismatches. Mutually exclusive with --barcode-sequences.")
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        metavar="N",
+        help=("Number of reads per batch passed between the reader, deduplication, and writer threads. "
+              "Use 0 to read, deduplicate, and write in a single thread.")
+    )
+    parser.add_argument(
+        "--saturation",
+        metavar="saturation.tsv",
+        help=("Output table of reads and unique fragments at each subsampling fraction "
+              "(see --subsample-fractions). Columns = fraction, reads, unique, duplication_rate.")
+    )
+    parser.add_argument(
+        "--saturation-barcodes",
+        metavar="saturation_barcodes.tsv",
+        help=("Output table of reads and unique fragments per barcode at each subsampling fraction. "
+              "Columns = barcode, fraction, reads, unique.")
+    )
+    parser.add_argument(
+        "--subsample-fractions",
+        type=float,
+        nargs="+",
+        default=[0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1],
+        metavar="FRAC",
+        help=("Subsampling fractions for --saturation and --saturation-barcodes. Read (pairs) are subsampled "
+              "deterministically by a hash of the read name, like samtools view -s.")
+    )
+    parser.add_argument(
+        "--subsample-seed",
+        type=int,
+        default=0,
+        metavar="SEED",
+        help="Seed for subsampling."
+    )
+    parser.add_argument(
+        "--stats",
+        metavar="stats.json",
+        help="Write read counts, timings, and peak memory usage to this JSON file."
+    )
+    parser.add_argument(
+        "--progress",
+        type=float,
+        metavar="SECONDS",
+        help="Print progress (reads/sec, peak memory) to standard error at this interval."
+    )
+    return parser.parse_args(argv)
 
 
 if __name__ == '__main__':
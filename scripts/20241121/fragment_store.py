@@ -0,0 +1,324 @@
+"""
+Columnar, memory-mapped store of deduplicated fragments (as in a counts BED file generated by dedup.py), for
+region and cell (barcode) queries without parsing text.
+
+A store is a directory of one binary file per column (chrom code, start, end, barcode, count), with rows
+sorted by chromosome and start, and a metadata file (meta.json, written last) with the chromosome names, the
+dtype and length of each column, and a per-chromosome offset index: the rows of chromosome i are
+offsets[i]:offsets[i + 1]. An optional inverted index lists the rows of each barcode. Columns are
+memory-mapped read-only, so a query reads only the pages it touches.
+
+- Region query: binary search of the starts within the chromosome's rows, from (region start - the longest
+  fragment on the chromosome) to the region end, then filter by end: O(log n + k).
+- Cell query: binary search of the barcode in the sorted unique barcodes, whose rows are contiguous in the
+  inverted index: O(log n + k).
+
+Example
+    python dedup.py -p --barcode-tag XB --fragments fragments/ in.bam > /dev/null
+    store = FragmentStore('fragments/')
+    df = store.region('chr1', 1_000_000, 2_000_000)        # columns = chr, start, end, barcode, count
+    df = store.cell(12345)
+    df = store.region('chr1', 1_000_000, 2_000_000, barcodes=[12345, 678])
+"""
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+from counts import NO_BARCODE, read_counts
+
+import numpy as np
+import pandas as pd
+
+FORMAT_VERSION = 1
+COLUMNS = {'chrom': np.int32, 'start': np.int32, 'end': np.int32, 'barcode': np.int64, 'count': np.int32}
+INDEX_COLUMNS = {'barcode_values': np.int64, 'barcode_offsets': np.int64, 'barcode_rows': np.int64}
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    with FragmentStoreWriter(args.output, barcode_index=not args.no_barcode_index) as writer:
+        for chunk in read_counts(args.input, chunksize=args.chunksize):
+            writer.write(chunk)
+    print(f'Wrote {writer.n:,} fragments on {len(writer.chroms)} chromosomes to {args.output}.', file=sys.stderr)
+
+
+class FragmentStoreWriter:
+    '''
+    Write a fragment store from chunks of fragments sorted by chromosome and start.
+    '''
+
+    def __init__(self, path: str, chroms=None, barcode_index: bool = True):
+        '''
+        Args
+        - path: directory of the store. Created if it does not exist; an existing store is replaced.
+        - chroms: chromosome names, in order. Chromosomes without fragments are kept in the offset index.
+            If None, chromosomes are added in order of appearance.
+        - barcode_index: build the per-barcode inverted index when the writer is closed.
+        '''
+        self.path = path
+        self.barcode_index = barcode_index
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            os.remove(os.path.join(path, 'meta.json'))
+        self.chroms = list(chroms) if chroms is not None else []
+        self.chrom_codes = {chrom: i for i, chrom in enumerate(self.chroms)}
+        self.counts = np.zeros(len(self.chroms), dtype=np.int64)  # rows per chromosome
+        self.max_length = np.zeros(len(self.chroms), dtype=np.int64)
+        self.last = (-1, -1)  # (chrom code, start) of the last row written
+        self.n = 0
+        self.files = {name: open(os.path.join(path, f'{name}.bin'), 'wb') for name in COLUMNS}
+
+    def _code(self, chrom):
+        code = self.chrom_codes.get(chrom)
+        if code is None:
+            code = len(self.chroms)
+            self.chroms.append(chrom)
+            self.chrom_codes[chrom] = code
+            self.counts = np.r_[self.counts, 0]
+            self.max_length = np.r_[self.max_length, 0]
+        return code
+
+    def write(self, df: pd.DataFrame):
+        '''
+        Append fragments.
+
+        Args
+        - df: columns chr, start, end, barcode, count, e.g., a chunk from counts.read_counts() or the table
+            returned by dedup.py. Rows must continue the sort order (chromosome, start) of previous chunks.
+            Missing barcodes ('-') are stored as NO_BARCODE.
+        '''
+        if len(df) == 0:
+            return
+        if isinstance(df['chr'].dtype, pd.CategoricalDtype):
+            assert (df['chr'].cat.codes.values >= 0).all(), 'Fragments must have a chromosome.'
+            mapping = np.array([self._code(chrom) for chrom in df['chr'].cat.categories], dtype=np.int64)
+            codes = mapping[df['chr'].cat.codes.values]
+        else:
+            chroms = df['chr'].values
+            boundaries = np.r_[0, np.flatnonzero(chroms[1:] != chroms[:-1]) + 1]
+            codes = np.repeat(
+                np.array([self._code(chrom) for chrom in chroms[boundaries]], dtype=np.int64),
+                np.diff(np.r_[boundaries, len(df)])
+            )
+        start = df['start'].values.astype(np.int64)
+        end = df['end'].values.astype(np.int64)
+        barcode = df['barcode']
+        if not pd.api.types.is_numeric_dtype(barcode):
+            barcode = barcode.astype(object).where(barcode != '-', NO_BARCODE)
+        barcode = barcode.to_numpy(dtype=np.int64)
+        count = df['count'].values.astype(np.int64)
+
+        order = np.r_[self.last[0], codes] * 2**32 + np.r_[self.last[1], start]
+        assert (np.diff(order) >= 0).all(), 'Fragments must be sorted by chromosome and start.'
+        assert (end >= start).all() and start.min() >= 0 and end.max() < 2**31, 'Invalid fragment coordinates.'
+        assert count.max() < 2**31, 'Fragment counts are too large.'
+        self.last = (int(codes[-1]), int(start[-1]))
+        np.add.at(self.counts, codes, 1)
+        np.maximum.at(self.max_length, codes, end - start)
+        for name, values in (('chrom', codes), ('start', start), ('end', end), ('barcode', barcode), ('count', count)):
+            self.files[name].write(values.astype(COLUMNS[name]).tobytes())
+        self.n += len(df)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        if self.barcode_index:
+            barcode = _read_column(self.path, 'barcode', COLUMNS['barcode'], self.n)
+            rows = np.argsort(barcode, kind='stable')
+            values, counts = np.unique(barcode[rows], return_counts=True)
+            offsets = np.r_[0, np.cumsum(counts)]
+            for name, array in (('barcode_values', values), ('barcode_offsets', offsets), ('barcode_rows', rows)):
+                with open(os.path.join(self.path, f'{name}.bin'), 'wb') as f:
+                    f.write(array.astype(INDEX_COLUMNS[name]).tobytes())
+            n_barcodes = len(values)
+            del barcode, rows
+        meta = dict(
+            version=FORMAT_VERSION,
+            n=self.n,
+            chroms=self.chroms,
+            offsets=np.r_[0, np.cumsum(self.counts)].tolist(),
+            max_length=self.max_length.tolist(),
+            columns={name: np.dtype(dtype).str for name, dtype in COLUMNS.items()},
+            barcode_index=dict(
+                n_barcodes=n_barcodes,
+                columns={name: np.dtype(dtype).str for name, dtype in INDEX_COLUMNS.items()}
+            ) if self.barcode_index else None
+        )
+        # written last: its presence marks a complete store
+        path_tmp = os.path.join(self.path, '.meta.json.tmp')
+        with open(path_tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(path_tmp, os.path.join(self.path, 'meta.json'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            for f in self.files.values():
+                f.close()
+
+
+def write_fragment_store(path: str, df: pd.DataFrame, barcode_index: bool = True):
+    '''
+    Write a table of fragments (e.g., as returned by dedup.py) to a fragment store.
+
+    Args
+    - path: directory of the store
+    - df: columns chr, start, end, barcode, count, sorted by chr and start. If chr is categorical, its
+        categories (e.g., all reference sequences of the BAM header) are the store's chromosomes.
+    - barcode_index: build the per-barcode inverted index.
+    '''
+    chroms = df['chr'].cat.categories.tolist() if isinstance(df['chr'].dtype, pd.CategoricalDtype) else None
+    with FragmentStoreWriter(path, chroms=chroms, barcode_index=barcode_index) as writer:
+        writer.write(df)
+
+
+def _read_column(path, name, dtype, n):
+    if n == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(os.path.join(path, f'{name}.bin'), dtype=dtype, mode='r', shape=(n,))
+
+
+class FragmentStore:
+    '''
+    Read-only, memory-mapped fragment store written by FragmentStoreWriter.
+
+    Attributes
+    - chroms: list of str
+    - offsets: np.ndarray (int64), shape (len(chroms) + 1,)
+        Rows of chromosome i are offsets[i]:offsets[i + 1].
+    - chrom, start, end, barcode, count: np.ndarray (memory-mapped)
+        Columns, sorted by chromosome and start
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        assert self.meta['version'] == FORMAT_VERSION, f'Fragment store {path} has an unsupported format version.'
+        n = self.meta['n']
+        self.chroms = self.meta['chroms']
+        self.chrom_codes = {chrom: i for i, chrom in enumerate(self.chroms)}
+        self.offsets = np.array(self.meta['offsets'], dtype=np.int64)
+        self.max_length = np.array(self.meta['max_length'], dtype=np.int64)
+        for name, dtype in self.meta['columns'].items():
+            setattr(self, name, _read_column(path, name, np.dtype(dtype), n))
+        self.barcode_values = None
+        if self.meta['barcode_index'] is not None:
+            lengths = dict(barcode_values=self.meta['barcode_index']['n_barcodes'],
+                           barcode_offsets=self.meta['barcode_index']['n_barcodes'] + 1,
+                           barcode_rows=n)
+            for name, dtype in self.meta['barcode_index']['columns'].items():
+                setattr(self, name, _read_column(path, name, np.dtype(dtype), lengths[name]))
+
+    def __len__(self):
+        return self.meta['n']
+
+    def region_rows(self, chrom: str, start: int = 0, end: int | None = None) -> np.ndarray:
+        '''
+        Returns: np.ndarray (int64)
+            Sorted rows of fragments on chrom overlapping [start, end) (0-based, half-open). If end is None,
+            to the end of the chromosome.
+        '''
+        code = self.chrom_codes.get(chrom)
+        if code is None:
+            return np.zeros(0, dtype=np.int64)
+        lo, hi = self.offsets[code], self.offsets[code + 1]
+        starts = self.start[lo:hi]
+        # fragments overlapping the region start at most max_length before it
+        i = np.searchsorted(starts, start - self.max_length[code], side='left')
+        j = np.searchsorted(starts, end, side='left') if end is not None else len(starts)
+        rows = np.arange(lo + i, lo + j, dtype=np.int64)
+        if start > 0:
+            rows = rows[self.end[rows] > start]
+        return rows
+
+    def cell_rows(self, barcodes) -> np.ndarray:
+        '''
+        Args
+        - barcodes: int or iterable of int
+
+        Returns: np.ndarray (int64)
+            Sorted rows of fragments with any of the barcodes
+        '''
+        assert self.barcode_values is not None, f'Fragment store {self.path} has no barcode index.'
+        barcodes = np.unique(np.atleast_1d(np.asarray(barcodes, dtype=np.int64)))
+        i = np.searchsorted(self.barcode_values, barcodes)
+        found = i < len(self.barcode_values)
+        found[found] = self.barcode_values[i[found]] == barcodes[found]
+        pieces = [self._barcode_rows(k) for k in i[found].tolist()]
+        return np.sort(np.concatenate(pieces)) if pieces else np.zeros(0, dtype=np.int64)
+
+    def _barcode_rows(self, k: int) -> np.ndarray:
+        # rows of the k-th barcode in barcode_values, in genomic order
+        return np.asarray(self.barcode_rows[self.barcode_offsets[k]:self.barcode_offsets[k + 1]], dtype=np.int64)
+
+    def fragments(self, rows: np.ndarray) -> pd.DataFrame:
+        '''
+        Returns: pd.DataFrame
+            Columns = chr, start, end, barcode, count (as in a counts BED file), for the given rows
+        '''
+        rows = np.asarray(rows, dtype=np.int64)
+        return pd.DataFrame({
+            'chr': pd.Categorical.from_codes(self.chrom[rows], categories=self.chroms),
+            'start': self.start[rows].astype(np.int64),
+            'end': self.end[rows].astype(np.int64),
+            'barcode': self.barcode[rows],
+            'count': self.count[rows].astype(np.int64),
+        })
+
+    def region(self, chrom: str, start: int = 0, end: int | None = None, barcodes=None) -> pd.DataFrame:
+        '''
+        Fragments overlapping a region, optionally of some barcodes only. See region_rows() and fragments().
+        '''
+        rows = self.region_rows(chrom, start, end)
+        if barcodes is not None:
+            rows = rows[np.isin(self.barcode[rows], np.asarray(barcodes, dtype=np.int64))]
+        return self.fragments(rows)
+
+    def cell(self, barcodes) -> pd.DataFrame:
+        '''
+        Fragments of one or more barcodes. See cell_rows() and fragments().
+        '''
+        return self.fragments(self.cell_rows(barcodes))
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description=("Convert a counts BED file generated by dedup.py (or merge_counts.py) into a memory-mapped "
+                     "columnar fragment store for region and barcode queries.")
+    )
+    parser.add_argument(
+        "input",
+        metavar="counts.bed[.gz]",
+        help="Counts BED file sorted by chromosome and start. Columns = chr, start, end, barcode, count."
+    )
+    parser.add_argument(
+        "-o", "--output",
+        required=True,
+        metavar="DIR",
+        help="Output directory of the fragment store."
+    )
+    parser.add_argument(
+        "--no-barcode-index",
+        action="store_true",
+        help="Do not build the per-barcode inverted index."
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=10_000_000,
+        metavar="N",
+        help="Number of rows read per chunk. Default: 10000000."
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main()
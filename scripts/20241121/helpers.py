@@ -6,6 +6,9 @@ import gzip
 import itertools
 import re
 
+# barcode of fragments without a barcode (dedup.py writes '-', which read_counts() decodes as this value)
+NO_BARCODE = -1
+
 
 def file_open(filename):
     """
@@ -93,6 +96,31 @@ def parse_chrom_map(path):
     return chrom_map
 
 
+def parse_chrom_sizes(path):
+    """
+    Parse chromosome sizes to a dict mapping chromosome names to lengths, in file order.
+
+    Args
+    - path: str
+        Either a tab-delimited chromosome sizes file (columns = chromosome name, length), or a
+        SAM/BAM/CRAM file whose header @SQ lines give the chromosome names and lengths.
+    """
+    if path.endswith(('.bam', '.sam', '.cram')):
+        import pysam
+        with pysam.AlignmentFile(path) as f:
+            return dict(zip(f.references, f.lengths))
+    chrom_sizes = dict()
+    with open(path, 'rt') as f:
+        for line in f:
+            if line.strip() == '' or line.startswith('#'):
+                continue
+            name, length = line.strip().split('\t')[:2]
+            assert name not in chrom_sizes, \
+                f"The chromosome name '{name}' is repeated in the chromosome sizes file."
+            chrom_sizes[name] = int(length)
+    return chrom_sizes
+
+
 # from https://docs.python.org/3/library/itertools.html
 def grouper(iterable, n, *, incomplete='fill', fillvalue=None):
     "Collect data into non-overlapping fixed-length chunks or blocks."
@@ -108,4 +136,28 @@ def grouper(iterable, n, *, incomplete='fill', fillvalue=None):
         case 'ignore':
             return zip(*iterators)
         case _:
-            raise ValueError('Expected fill, strict, or ignore')
\ No newline at end of file
+            raise ValueError('Expected fill, strict, or ignore')
+
+
+def barcode_getter(barcode_rgx=None, barcode_tag=None, default=None):
+    """
+    Create a function that returns the integer barcode of an aligned read.
+
+    Args
+    - barcode_rgx: str. default=None
+        Regular expression for barcode in the read name. Currently only supports 1 capture group for an integer.
+    - barcode_tag: str. default=None
+        BAM tag with an integer barcode, e.g., as written by tag_barcodes.py. Mutually exclusive with barcode_rgx.
+    - default: default=None
+        Barcode returned for every read if neither barcode_rgx nor barcode_tag is given.
+
+    Returns: callable
+        Takes a pysam.AlignedSegment and returns its barcode.
+    """
+    assert not (barcode_rgx and barcode_tag), "Only one of barcode_rgx and barcode_tag can be given."
+    if barcode_tag:
+        return lambda read: read.get_tag(barcode_tag)
+    if barcode_rgx:
+        regex_barcode = re.compile(barcode_rgx)
+        return lambda read: int(regex_barcode.search(read.query_name).groups()[0])
+    return lambda read: default
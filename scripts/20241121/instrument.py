@@ -0,0 +1,182 @@
+"""
+Lightweight instrumentation for the BAM processing scripts: read counters, time spent decoding vs.
+processing vs. encoding records, periodic progress with reads/sec, peak memory, and a JSON summary.
+"""
+
+import collections
+import contextlib
+import json
+import resource
+import sys
+import time
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of the current process, in MiB.
+    """
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+
+
+class Stats:
+    """
+    Counters, timers, and gauges for one run of a script.
+
+    Unless timed explicitly (e.g., by pipeline.run_pipeline()), time not attributed to a timer (e.g., 'decode'
+    or 'encode') is reported as 'process'. When reading and writing run in separate threads, timers measure
+    the busy time of each thread and may sum to more than the wall time.
+
+    Example
+        stats = Stats('dedup', progress_interval=60)
+        for read in stats.iter(file_in.fetch(until_eof=True)):
+            ...
+            stats.writer(file_out).write(read)
+        stats.write_json('dedup_stats.json')
+    """
+
+    def __init__(self, name, progress_interval=None, file=sys.stderr):
+        """
+        Args
+        - name: str
+            Name of the script or step, used in progress messages and the summary.
+        - progress_interval: float. default=None
+            Print progress to file every progress_interval seconds. If None, do not print progress.
+        - file: file object. default=sys.stderr
+        """
+        self.name = name
+        self.progress_interval = progress_interval
+        self.file = file
+        self.counters = collections.Counter()
+        self.timers = collections.defaultdict(float)
+        self.gauges = dict()
+        self.gauge_callbacks = dict()
+        self.start = time.perf_counter()
+        self._last_progress = self.start
+
+    def count(self, key, n=1):
+        self.counters[key] += n
+
+    def gauge(self, key, value=None, callback=None):
+        """
+        Record the current value of a quantity, such as the size of a table.
+
+        Args
+        - key: str
+        - value: numeric. default=None
+        - callback: callable. default=None
+            Function taking no arguments that returns the current value. It is called whenever progress
+            is reported and when the summary is generated.
+        """
+        if callback is not None:
+            self.gauge_callbacks[key] = callback
+            value = callback()
+        self.gauges[key] = value
+
+    @contextlib.contextmanager
+    def timer(self, key):
+        """
+        Context manager that adds the time spent in its body to timer key.
+        """
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[key] += time.perf_counter() - t
+
+    def iter(self, iterable, timer='decode', counter='reads_in'):
+        """
+        Wrap an iterable (e.g., pysam.AlignmentFile.fetch()), timing each step of iteration and counting
+        items. Progress is reported from here.
+        """
+        iterator = iter(iterable)
+        perf_counter = time.perf_counter
+        counters = self.counters
+        timers = self.timers
+        n = 0
+        try:
+            while True:
+                t = perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    timers[timer] += perf_counter() - t
+                    return
+                timers[timer] += perf_counter() - t
+                n += 1
+                if n & 0xFFFF == 0:
+                    counters[counter] += 0x10000
+                    self.progress()
+                yield item
+        finally:
+            counters[counter] += n & 0xFFFF
+
+    def writer(self, file, timer='encode', counter='reads_out'):
+        """
+        Wrap a file object (e.g., pysam.AlignmentFile) such that calls to its write() method are timed
+        and counted.
+        """
+        return _TimedWriter(self, file, timer, counter)
+
+    def progress(self, force=False):
+        """
+        Print progress if progress_interval seconds have elapsed since the last report.
+        """
+        if self.progress_interval is None:
+            return
+        now = time.perf_counter()
+        if not force and now - self._last_progress < self.progress_interval:
+            return
+        self._last_progress = now
+        self._update_gauges()
+        elapsed = now - self.start
+        n_in = self.counters['reads_in']
+        message = (f"[{self.name}] {elapsed:,.0f} s: {n_in:,} reads in ({n_in / elapsed:,.0f} reads/s), "
+                   f"{self.counters['reads_out']:,} reads out, peak RSS {peak_rss_mb():,.0f} MB")
+        for key, value in self.gauges.items():
+            message += f", {key} {value:,}"
+        print(message, file=self.file, flush=True)
+
+    def _update_gauges(self):
+        for key, callback in self.gauge_callbacks.items():
+            self.gauges[key] = callback()
+
+    def summary(self):
+        """
+        Returns: dict
+            JSON-serializable summary of counters, timers (seconds), gauges, throughput, and peak memory.
+        """
+        self._update_gauges()
+        wall = time.perf_counter() - self.start
+        timers = dict(self.timers)
+        if 'process' not in timers:
+            timers['process'] = max(0.0, wall - sum(timers.values()))
+        return dict(
+            name=self.name,
+            wall_seconds=wall,
+            reads_per_sec=self.counters['reads_in'] / wall if wall > 0 else None,
+            peak_rss_mb=peak_rss_mb(),
+            counters=dict(self.counters),
+            seconds=timers,
+            gauges=self.gauges,
+        )
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+            f.write('\n')
+
+
+class _TimedWriter:
+    def __init__(self, stats, file, timer, counter):
+        self.stats = stats
+        self.file = file
+        self.timer = timer
+        self.counter = counter
+
+    def write(self, record):
+        t = time.perf_counter()
+        result = self.file.write(record)
+        self.stats.timers[self.timer] += time.perf_counter() - t
+        self.stats.counters[self.counter] += 1
+        return result
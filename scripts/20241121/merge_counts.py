@@ -0,0 +1,265 @@
+"""
+Merge counts BED files generated by dedup.py (e.g., from multiple sequencing runs of the same library).
+
+Inputs are streamed and combined with a heap-based k-way merge on (chr, start, end, barcode); counts of
+identical fragments are summed. Memory use does not depend on the size of the inputs: only the current
+row of each input (and, when barcodes are remapped, the rows of one fragment coordinate) is held in memory.
+
+Inputs must be sorted as written by dedup.py: by chromosome (in BAM header order), start, end, and barcode.
+The chromosome order is given by a chromosome sizes file or a SAM/BAM header; it is not inferred from the
+inputs, since the interleaved order in which the merge first sees chromosomes need not match any input.
+"""
+
+import argparse
+import heapq
+import io
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+from helpers import NO_BARCODE, file_open, parse_chrom_sizes
+
+import pysam
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    chrom_order = ChromOrder(parse_chrom_sizes(args.genome))
+    barcode_maps = [None] * len(args.input)
+    for index, path in args.barcode_map or []:
+        index = int(index)
+        assert 0 <= index < len(args.input), \
+            f"Barcode map input index {index} is out of range (there are {len(args.input)} inputs)."
+        barcode_maps[index] = parse_barcode_map(path)
+    n_rows = merge_counts(
+        args.input,
+        args.output,
+        chrom_order=chrom_order,
+        barcode_maps=barcode_maps,
+        drop_unmapped=args.drop_unmapped,
+        index=not args.no_index
+    )
+    print(f'Wrote {n_rows:,} fragments to {args.output}', file=sys.stderr)
+
+
+class ChromOrder:
+    '''
+    Map chromosome names to their rank in the sort order of counts files.
+    '''
+
+    def __init__(self, chroms):
+        '''
+        Args
+        - chroms: iterable of str
+            Chromosome names in sort order, e.g., the keys of parse_chrom_sizes()
+        '''
+        self.ranks = {chrom: i for i, chrom in enumerate(chroms)}
+        self.names = list(self.ranks)
+
+    def rank(self, chrom):
+        rank = self.ranks.get(chrom)
+        assert rank is not None, f"Chromosome '{chrom}' is not in the chromosome sizes file."
+        return rank
+
+
+def parse_barcode_map(path):
+    """
+    Parse a barcode map file (tab-delimited columns = old barcode, new barcode) to a dict mapping old
+    barcodes to new barcodes. Barcodes are integers as in counts files; '-' denotes no barcode.
+    """
+    barcode_map = dict()
+    with open(path, 'rt') as f:
+        for line in f:
+            if line.strip() == '' or line.startswith('#'):
+                continue
+            old_barcode, new_barcode = (_parse_barcode(x) for x in line.strip().split('\t')[:2])
+            assert old_barcode not in barcode_map, \
+                f"The barcode '{old_barcode}' is repeated in the barcode map {path}."
+            barcode_map[old_barcode] = new_barcode
+    return barcode_map
+
+
+def _parse_barcode(value):
+    return NO_BARCODE if value == '-' else int(value)
+
+
+def iter_counts(path, chrom_order, barcode_map=None, drop_unmapped=False):
+    '''
+    Stream the rows of a counts BED file, checking that they are sorted.
+
+    Args
+    - path: str
+        Path to counts BED file, optionally gzip-compressed
+    - chrom_order: ChromOrder
+    - barcode_map: dict (int -> int). default=None
+        Map from barcodes in this file to barcodes in the merged output. Since remapping can change the
+        order of barcodes, the rows of each fragment coordinate are collected, remapped, summed, and
+        re-sorted before they are yielded.
+    - drop_unmapped: bool. default=False
+        Drop rows whose barcode is not in barcode_map. If False, such barcodes are kept unchanged.
+
+    Returns: iterator of tuple (chromosome rank, start, end, barcode, count)
+    '''
+    rank = chrom_order.rank
+    previous = None
+    group_coords = None
+    group = dict()
+    with file_open(path) as f:
+        for line_number, line in enumerate(io.TextIOWrapper(f), start=1):
+            chrom, start, end, barcode, count = line.rstrip('\n').split('\t')
+            row = (rank(chrom), int(start), int(end), _parse_barcode(barcode), int(count))
+            assert previous is None or row[:4] >= previous, (
+                f"{path} is not sorted at line {line_number}. Counts files must be sorted by chromosome, "
+                "start, end, and barcode, with chromosomes in the order of the chromosome sizes file."
+            )
+            previous = row[:4]
+            if barcode_map is None:
+                yield row
+                continue
+            if row[:3] != group_coords:
+                yield from _flush(group_coords, group)
+                group_coords = row[:3]
+            new_barcode = barcode_map.get(row[3])
+            if new_barcode is None:
+                if drop_unmapped:
+                    continue
+                new_barcode = row[3]
+            group[new_barcode] = group.get(new_barcode, 0) + row[4]
+    yield from _flush(group_coords, group)
+
+
+def _flush(coords, group):
+    for barcode in sorted(group):
+        yield (*coords, barcode, group[barcode])
+    group.clear()
+
+
+def merge_counts(
+    paths,
+    path_out,
+    chrom_order,
+    barcode_maps=None,
+    drop_unmapped=False,
+    index=True,
+    lines_per_write=10000
+):
+    '''
+    Merge counts BED files, summing the counts of identical (chr, start, end, barcode) rows.
+
+    Args
+    - paths: list of str
+        Paths to counts BED files, each sorted as written by dedup.py
+    - path_out: str
+        Path to output counts BED file. If it ends with '.gz', the output is compressed with BGZF
+        (readable by gzip) and, if index is True, indexed with tabix. '-' writes to standard output.
+    - chrom_order: ChromOrder
+        Chromosome sort order of the inputs
+    - barcode_maps: list of (dict or None). default=None
+        Barcode map for each input, as returned by parse_barcode_map()
+    - drop_unmapped: bool. default=False
+        See iter_counts().
+    - index: bool. default=True
+        Create a tabix index (path_out + '.tbi') of BGZF-compressed output.
+    - lines_per_write: int. default=10000
+        Number of output lines buffered per write.
+
+    Returns: int
+        Number of rows written
+    '''
+    if barcode_maps is None:
+        barcode_maps = [None] * len(paths)
+    streams = [
+        iter_counts(path, chrom_order, barcode_map=barcode_map, drop_unmapped=drop_unmapped)
+        for path, barcode_map in zip(paths, barcode_maps)
+    ]
+    compressed = path_out.endswith('.gz')
+    if path_out == '-':
+        f = sys.stdout.buffer
+    elif compressed:
+        f = pysam.BGZFile(path_out, 'wb')
+    else:
+        f = open(path_out, 'wb')
+    names = chrom_order.names
+    n_rows = 0
+    lines = []
+    key = None
+    total = 0
+    try:
+        for row in heapq.merge(*streams):
+            if row[:4] == key:
+                total += row[4]
+                continue
+            if key is not None:
+                lines.append(_format_row(names, key, total))
+                if len(lines) >= lines_per_write:
+                    f.write(''.join(lines).encode())
+                    n_rows += len(lines)
+                    lines = []
+            key = row[:4]
+            total = row[4]
+        if key is not None:
+            lines.append(_format_row(names, key, total))
+        f.write(''.join(lines).encode())
+        n_rows += len(lines)
+    finally:
+        if path_out != '-':
+            f.close()
+    if compressed and index:
+        pysam.tabix_index(path_out, preset='bed', force=True)
+    return n_rows
+
+
+def _format_row(names, key, count):
+    rank, start, end, barcode = key
+    return f"{names[rank]}\t{start}\t{end}\t{'-' if barcode == NO_BARCODE else barcode}\t{count}\n"
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description=("Merge sorted counts BED files generated by dedup.py (e.g., from multiple sequencing "
+                     "runs of the same library), summing counts of identical fragments. Memory use is "
+                     "constant in the size of the inputs.")
+    )
+    parser.add_argument(
+        "input",
+        nargs="+",
+        metavar="counts.bed[.gz]",
+        help="Counts BED files (columns = chr, start, end, barcode, count), sorted as written by dedup.py."
+    )
+    parser.add_argument(
+        "-o", "--output",
+        required=True,
+        metavar="merged.bed.gz",
+        help=("Path to output counts BED file. If it ends with .gz, it is BGZF-compressed and indexed with "
+              "tabix. Use '-' for uncompressed standard output.")
+    )
+    parser.add_argument(
+        "-g", "--genome",
+        required=True,
+        metavar="chrom.sizes",
+        help=("Chromosome sizes file or SAM/BAM/CRAM file whose header gives the chromosome order of the "
+              "inputs (e.g., a deduplicated BAM file).")
+    )
+    parser.add_argument(
+        "--barcode-map",
+        nargs=2,
+        action="append",
+        metavar=("INDEX", "barcode_map.tsv"),
+        help=("Remap the barcodes of the INDEX-th input (0-based) using a tab-delimited file of old and "
+              "new barcodes. Can be given multiple times.")
+    )
+    parser.add_argument(
+        "--drop-unmapped",
+        action="store_true",
+        help="Drop rows of remapped inputs whose barcode is not in the barcode map, instead of keeping them unchanged."
+    )
+    parser.add_argument(
+        "--no-index",
+        action="store_true",
+        help="Do not create a tabix index of compressed output."
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Reader -> processing -> writer pipeline for record-processing scripts (e.g., BAM filters).
+
+Records are read in batches by a reader thread, processed batch by batch in the calling thread, and
+written by a writer thread. The stages are linked by bounded queues, so memory use is bounded and
+decoding/encoding (e.g., pysam/htslib I/O) can overlap with processing. Output order matches input order.
+"""
+
+import itertools
+import queue
+import threading
+
+_DONE = object()
+
+
+def batched(iterable, n):
+    "Batch data into lists of length n. The last batch may be shorter."
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, n)):
+        yield batch
+
+
+def run_pipeline(source, process, write, batch_size=1000, queue_size=16, threaded=True, stats=None):
+    """
+    Process records from source and write the results.
+
+    Args
+    - source: iterable
+        Input records, e.g., pysam.AlignmentFile.fetch(until_eof=True). Iterated in the reader thread.
+    - process: callable
+        Takes a list of input records and returns an iterable of output records. Called on batches in
+        input order, in the calling thread, so it may keep state across batches.
+    - write: callable
+        Takes one output record, e.g., the write method of a pysam.AlignmentFile. Called in the writer
+        thread, in order.
+    - batch_size: int. default=1000
+        Number of input records per batch
+    - queue_size: int. default=16
+        Maximum number of batches waiting in each queue
+    - threaded: bool. default=True
+        If False, read, process, and write in the calling thread.
+    - stats: instrument.Stats. default=None
+        If given, time spent in process is recorded as timer 'process', and time the calling thread spends
+        waiting on the reader or writer is recorded as timer 'wait'.
+
+    Returns: None
+    """
+    batches = batched(source, batch_size)
+    if not threaded:
+        for batch in batches:
+            for record in _process(process, batch, stats):
+                write(record)
+        return
+
+    in_queue = queue.Queue(maxsize=queue_size)
+    out_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    errors = []
+
+    def put(q, item):
+        # returns False if the pipeline was stopped before the item could be queued
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(q):
+        while True:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set():
+                    return _DONE
+
+    def read_batches():
+        try:
+            for batch in batches:
+                if not put(in_queue, batch):
+                    return
+        except BaseException as err:
+            errors.append(err)
+            stop.set()
+        finally:
+            put(in_queue, _DONE)
+
+    def write_batches():
+        try:
+            while (batch := get(out_queue)) is not _DONE:
+                for record in batch:
+                    write(record)
+        except BaseException as err:
+            errors.append(err)
+            stop.set()
+
+    reader = threading.Thread(target=read_batches, name='pipeline-reader', daemon=True)
+    writer = threading.Thread(target=write_batches, name='pipeline-writer', daemon=True)
+    reader.start()
+    writer.start()
+    try:
+        while True:
+            batch = _timed(stats, 'wait', get, in_queue)
+            if batch is _DONE:
+                break
+            result = list(_process(process, batch, stats))
+            if not _timed(stats, 'wait', put, out_queue, result):
+                break
+    except BaseException as err:
+        errors.append(err)
+        stop.set()
+    finally:
+        put(out_queue, _DONE)
+        reader.join()
+        writer.join()
+    if errors:
+        raise errors[0]
+
+
+def _process(process, batch, stats):
+    if stats is None:
+        return process(batch)
+    with stats.timer('process'):
+        return list(process(batch))
+
+
+def _timed(stats, key, fun, *args):
+    if stats is None:
+        return fun(*args)
+    with stats.timer(key):
+        return fun(*args)
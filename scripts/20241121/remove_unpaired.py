@@ -1,65 +1,188 @@
 import argparse
+import functools
+import heapq
+import itertools
 import os
 import sys
 
 sys.path.append(os.path.abspath(os.path.dirname(__file__)))
 from helpers import positive_int
+from instrument import Stats
+from pipeline import run_pipeline
 
 import pysam
 
+FLAG_SECONDARY = 0x100
+FLAG_SUPPLEMENTARY = 0x800
 
-def main():
-    args = parse_arguments()
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    stats = Stats('remove_unpaired', progress_interval=args.progress)
     remove_unpaired(
         args.input,
         path_out_bam=args.output,
-        threads=args.threads
+        threads=args.threads,
+        batch_size=args.batch_size,
+        coordinate_sorted=args.coordinate_sorted,
+        stats=stats
     )
+    stats.progress(force=True)
+    if args.stats:
+        stats.write_json(args.stats)
 
 
 def remove_unpaired(
     path_in_bam: str,
     path_out_bam: str | None = None,
-    threads: int = 1
+    threads: int = 1,
+    batch_size: int = 1000,
+    coordinate_sorted: bool = False,
+    stats: Stats | None = None
 ) -> None:
     '''
     Remove unpaired reads by read name.
 
+    Only primary alignments of paired reads are considered: a read pair is kept if it has exactly 1 primary
+    read 1 and 1 primary read 2 alignment. Secondary and supplementary alignments are removed. Mates are
+    written adjacent to each other, in input order.
+
     Args
-    - path_in_bam: path to name-collated BAM file
-    - path_out_bam: path to output BAM file of deduplicated reads. If None, write to standard out.
+    - path_in_bam: path to name-collated BAM file, or, if coordinate_sorted is True, coordinate-sorted BAM file
+    - path_out_bam: path to output BAM file of paired reads. If None, write to standard out.
     - threads: Number of threads to use for reading and writing BAM files
+    - batch_size: Number of reads per batch passed between the reader, filtering, and writer threads.
+        If 0, read, filter, and write in a single thread.
+    - coordinate_sorted: Input is sorted by coordinate. Reads wait in a table of pending mates until their
+        mate is found, or until the input passes their mate's position (from the read's mate fields), at
+        which point they are removed. Memory is therefore bounded by the number of reads within an insert
+        size of the current position. Otherwise, reads of a read pair must be adjacent.
+    - stats: Stats object in which to record read counts and timings
 
     Returns: None
     '''
     path_out_bam = path_out_bam if path_out_bam is not None else sys.stdout.buffer
     path_in_bam = path_in_bam if path_in_bam != '-' else sys.stdin.buffer
+    stats = stats if stats is not None else Stats('remove_unpaired')
 
-    in_pair = False
-    paired_read = None
     with pysam.AlignmentFile(path_in_bam, 'rb', threads=threads) as file_in:
         header = file_in.header.to_dict()
-        with pysam.AlignmentFile(path_out_bam, 'wb', threads=threads, header=header) as file_out:
-            for read in file_in.fetch(until_eof=True):
-                if in_pair and read.qname == paired_read.qname:
-                    file_out.write(paired_read)
-                    file_out.write(read)
-                    in_pair = False
-                else:
-                    paired_read = read
-                    in_pair = True
-
-
-def parse_arguments():
+        reads = stats.iter(file_in.fetch(until_eof=True))
+        if coordinate_sorted:
+            source = reads
+            process = _pair_sorted_reads(stats)
+        else:
+            source = (list(group) for _, group in itertools.groupby(reads, key=lambda read: read.query_name))
+            process = functools.partial(_pair_collated_reads, stats=stats)
+        with pysam.AlignmentFile(path_out_bam, 'wb', threads=threads, header=header) as file_bam_out:
+            run_pipeline(
+                source,
+                process,
+                stats.writer(file_bam_out).write,
+                batch_size=max(batch_size if coordinate_sorted else batch_size // 2, 1),
+                threaded=batch_size > 0,
+                stats=stats
+            )
+
+
+def _is_pairable(read, stats):
+    # primary alignment of a paired read
+    if read.flag & (FLAG_SECONDARY | FLAG_SUPPLEMENTARY):
+        stats.count('non_primary')
+        return False
+    if not read.is_paired:
+        stats.count('unpaired')
+        return False
+    return True
+
+
+def _pair_collated_reads(groups, stats):
+    '''
+    Args
+    - groups: list of list of pysam.AlignedSegment
+        Adjacent records with the same read name
+    - stats: Stats
+
+    Returns: list of pysam.AlignedSegment
+    '''
+    out = []
+    for group in groups:
+        mates = [read for read in group if _is_pairable(read, stats)]
+        if len(mates) == 2 and mates[0].is_read1 != mates[1].is_read1:
+            out.extend(mates)
+        else:
+            stats.count('unpaired', len(mates))
+    return out
+
+
+def _pair_sorted_reads(stats):
+    '''
+    Create a batch processing function that pairs mates of a coordinate-sorted BAM file.
+
+    Returns: callable
+        Takes a list of pysam.AlignedSegment and returns a list of pysam.AlignedSegment
+    '''
+    pending = dict()  # read name -> first mate seen
+    # (mate position, read name) of pending reads, to remove reads whose mate position has been passed
+    mate_positions = []
+    last_position = (-1, -1)
+    stats.gauge('pending_mates', callback=lambda: len(pending))
+
+    def position(reference_id, reference_start):
+        # unmapped reads without a position are at the end of a coordinate-sorted file
+        return (reference_id if reference_id >= 0 else sys.maxsize, reference_start)
+
+    def process(reads):
+        nonlocal last_position
+        out = []
+        for read in reads:
+            current = position(read.reference_id, read.reference_start)
+            assert current >= last_position, \
+                f'Input is not sorted by coordinate: {read.query_name} at {current} after {last_position}.'
+            last_position = current
+            while mate_positions and mate_positions[0][0] < current:
+                _, name = heapq.heappop(mate_positions)
+                mate = pending.get(name)
+                if mate is not None and position(mate.next_reference_id, mate.next_reference_start) < current:
+                    del pending[name]
+                    stats.count('unpaired')
+            if not _is_pairable(read, stats):
+                continue
+            mate = pending.pop(read.query_name, None)
+            if mate is None:
+                pending[read.query_name] = read
+                heapq.heappush(
+                    mate_positions,
+                    (position(read.next_reference_id, read.next_reference_start), read.query_name)
+                )
+            elif mate.is_read1 != read.is_read1:
+                out.append(mate)
+                out.append(read)
+            else:
+                # 2 primary alignments of the same mate: neither can be paired reliably
+                stats.count('unpaired', 2)
+        return out
+
+    return process
+
+
+def parse_arguments(argv=None):
     parser = argparse.ArgumentParser(
-        description="Remove unpaired reads based on identical genomic alignment coordinates."
+        description=("Remove unpaired reads and secondary and supplementary alignments. Mates are written "
+                     "adjacent to each other.")
     )
     parser.add_argument(
         "input",
         metavar="in.bam|-",
         help=("Input BAM file, with reads grouped by name (i.e., after running "
-              "samtools collate) such that reads from a read pair are adjacent. "
-              "Use '-' for standard in.")
+              "samtools collate) such that reads from a read pair are adjacent, or sorted by coordinate "
+              "with --coordinate-sorted. Use '-' for standard in.")
+    )
+    parser.add_argument(
+        "--coordinate-sorted",
+        action="store_true",
+        help=("Input is sorted by coordinate. Reads are held until their mate is found or the input passes "
+              "their mate's position, so memory is bounded by the reads within an insert size.")
     )
     parser.add_argument(
         "-o", "--output",
@@ -73,7 +196,26 @@ def parse_arguments():
         metavar="#",
         help="Number of threads to use for compressing/decompressing BAM files",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        metavar="N",
+        help=("Number of reads per batch passed between the reader, filtering, and writer threads. "
+              "Use 0 to read, filter, and write in a single thread.")
+    )
+    parser.add_argument(
+        "--stats",
+        metavar="stats.json",
+        help="Write read counts, timings, and peak memory usage to this JSON file."
+    )
+    parser.add_argument(
+        "--progress",
+        type=float,
+        metavar="SECONDS",
+        help="Print progress (reads/sec, peak memory) to standard error at this interval."
+    )
+    return parser.parse_args(argv)
 
 
 if __name__ == '__main__':
@@ -10,10 +10,12 @@ import subprocess
 import sys
 sys.path.append(os.path.abspath(os.path.dirname(__file__)))
 from helpers import positive_int, parse_chrom_map
+from instrument import Stats
+from pipeline import run_pipeline
 import pysam
 
 
-def main():
+def main(argv=None):
     """
     Parse arguments and execute the following behavior based on the arguments as follows:
 
@@ -26,7 +28,8 @@ def main():
     <path>    | True, False | None   | Rename/filter chromosomes, write to standard out
     <path>    | True, False | <path> | Rename/filter chromosomes, write to <path>
     """
-    args = parse_arguments()
+    args = parse_arguments(argv)
+    stats = Stats('rename_and_filter_chr', progress_interval=args.progress)
     if args.chrom_map is None:
         if args.output is None:
             with open(args.input, "rb") as f:
@@ -53,11 +56,16 @@ def main():
             no_PG=args.no_PG,
             threads=args.threads,
             verbose=not args.quiet,
+            batch_size=args.batch_size,
+            stats=stats,
         )
+        stats.progress(force=True)
+    if args.stats:
+        stats.write_json(args.stats)
 
 
 
-def parse_arguments():
+def parse_arguments(argv=None):
     parser = argparse.ArgumentParser(
         description="Rename chromosomes and keep only reads aligned to selected chromosomes."
     )
@@ -105,7 +113,28 @@ def parse_arguments():
         action="store_true",
         help="Do not add @PG line to the header of the output file if sorting BAM file."
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        metavar="N",
+        help=(
+            "Number of reads per batch passed between the reader, filtering, and writer threads. "
+            "Use 0 to read, filter, and write in a single thread."
+        ),
+    )
+    parser.add_argument(
+        "--stats",
+        metavar="stats.json",
+        help="Write read counts, timings, and peak memory usage to this JSON file."
+    )
+    parser.add_argument(
+        "--progress",
+        type=float,
+        metavar="SECONDS",
+        help="Print progress (reads/sec, peak memory) to standard error at this interval."
+    )
+    return parser.parse_args(argv)
 
 
 def reheader(old_header, chrom_map):
@@ -162,7 +191,8 @@ def reheader(old_header, chrom_map):
 
 
 def filter_reads(
-    path_bam_in, path_bam_out, chrom_map, try_symlink=False, sort="auto", no_PG=False, threads=1, verbose=True
+    path_bam_in, path_bam_out, chrom_map, try_symlink=False, sort="auto", no_PG=False, threads=1, verbose=True,
+    batch_size=1000, stats=None
 ):
     """
     Discard reads that do not map to the specified chromosomes, and generate a new header for only the specified
@@ -187,7 +217,13 @@ def filter_reads(
         Number of threads to use for compressing/decompressing BAM files
     - verbose: bool. default=True
         Print the number of discarded reads and the number of output reads.
+    - batch_size: int. default=1000
+        Number of reads per batch passed between the reader, filtering, and writer threads.
+        If 0, read, filter, and write in a single thread.
+    - stats: Stats. default=None
+        Object in which to record read counts and timings
     """
+    stats = stats if stats is not None else Stats("rename_and_filter_chr")
     count_discard = 0
     count_out = 0
     with pysam.AlignmentFile(path_bam_in, "rb", threads=threads) as file_bam_in:
@@ -203,18 +239,30 @@ def filter_reads(
                 if verbose:
                     print(f"Error upon attempt to create a symbolic link from {path_bam_in} to {path_bam_out}:", err)
 
-        def process_reads(output_stream):
+        def filter_batch(reads):
             nonlocal count_discard, count_out
-            for read in file_bam_in.fetch(until_eof=True):
+            out = []
+            for read in reads:
                 if read.reference_name in chrom_map:
                     read.reference_id = old_to_new_refID[read.reference_id]
                     # if reference sequence name of paired read is not in chrom_map, set RNEXT
                     # to be "*"
                     read.next_reference_id = old_to_new_refID.get(read.next_reference_id, -1)
-                    output_stream.write(read)
+                    out.append(read)
                     count_out += 1
                 else:
                     count_discard += 1
+            return out
+
+        def process_reads(output_stream):
+            run_pipeline(
+                stats.iter(file_bam_in.fetch(until_eof=True)),
+                filter_batch,
+                stats.writer(output_stream).write,
+                batch_size=max(batch_size, 1),
+                threaded=batch_size > 0,
+                stats=stats,
+            )
 
         if sort == "true" or ((sort == "auto") and retains_sorting is False):
             sort_cmd = ["samtools", "sort"]
@@ -244,6 +292,7 @@ def filter_reads(
             ) as file_bam_out:
                 process_reads(file_bam_out)
         sys.stdout.flush()
+    stats.count("reads_discarded", count_discard)
 
     if verbose:
         print("Discarded reads:", count_discard, file=sys.stderr)
@@ -0,0 +1,295 @@
+"""
+Move barcode fields from read names (e.g., 'readname::bead=123') into integer BAM tags (e.g., XB:i:123).
+
+Shorter read names make every BAM record smaller, and downstream scripts (e.g., dedup.py --barcode-tag)
+read an integer tag instead of parsing each read name with a regular expression. A sidecar barcode
+dictionary (tab-delimited columns = field, tag, value, id, reads) lists every barcode value seen, the
+integer stored in its tag, and the number of reads with that value.
+
+Fields are encoded either as integers (values must be integers, which are stored as-is) or with a
+dictionary (any values; each distinct value is assigned an integer id in order of first appearance).
+"""
+
+import argparse
+import os
+import re
+import sys
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+from helpers import positive_int
+from instrument import Stats
+from pipeline import run_pipeline
+
+import pysam
+
+REGEX_FIELD = re.compile(r'::([A-Za-z_][A-Za-z0-9_]*)=([^:\s]*)')
+REGEX_TAG = re.compile(r'[A-Za-z][A-Za-z0-9]')
+DEFAULT_FIELDS = ('bead=XB',)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    stats = Stats('tag_barcodes', progress_interval=args.progress)
+    fields = parse_field_specs(args.field if args.field else DEFAULT_FIELDS)
+    dictionary = tag_barcodes(
+        args.input,
+        args.output,
+        fields,
+        threads=args.threads,
+        uncompressed=args.uncompressed,
+        batch_size=args.batch_size,
+        stats=stats
+    )
+    if args.dictionary:
+        dictionary.write(args.dictionary)
+    stats.progress(force=True)
+    if args.stats:
+        stats.write_json(args.stats)
+
+
+def parse_field_specs(specs):
+    """
+    Parse field specifications of the form FIELD=TAG or FIELD=TAG:dict.
+
+    Returns: dict (str -> (str, str))
+        Map from read name field to (BAM tag, encoding), where encoding is 'int' or 'dict'.
+    """
+    fields = dict()
+    for spec in specs:
+        field, _, tag = spec.partition('=')
+        tag, _, encoding = tag.partition(':')
+        encoding = encoding or 'int'
+        assert field and REGEX_TAG.fullmatch(tag), \
+            f"Invalid field specification '{spec}'. Expected FIELD=TAG or FIELD=TAG:dict, e.g., bead=XB."
+        assert encoding in ('int', 'dict'), f"Invalid encoding '{encoding}' in field specification '{spec}'."
+        assert field not in fields, f"The field '{field}' is specified more than once."
+        assert tag not in (t for t, _ in fields.values()), f"The tag '{tag}' is specified more than once."
+        fields[field] = (tag, encoding)
+    return fields
+
+
+class BarcodeDictionary:
+    """
+    Integer ids of barcode values and the number of reads with each value, per read name field.
+    """
+
+    def __init__(self, fields):
+        """
+        Args
+        - fields: dict (str -> (str, str))
+            As returned by parse_field_specs()
+        """
+        self.fields = fields
+        self.ids = {field: dict() for field in fields}
+        self.reads = {field: dict() for field in fields}
+
+    def encode(self, field, value):
+        """
+        Returns: int
+            Integer to store in the BAM tag of field
+        """
+        ids = self.ids[field]
+        id = ids.get(value)
+        if id is None:
+            if self.fields[field][1] == 'int':
+                id = int(value)
+            else:
+                id = len(ids)
+            ids[value] = id
+            self.reads[field][value] = 0
+        self.reads[field][value] += 1
+        return id
+
+    def decode(self, field):
+        """
+        Returns: dict (int -> str)
+            Map from tag value to barcode value
+        """
+        return {id: value for value, id in self.ids[field].items()}
+
+    def write(self, path):
+        with open(path, 'wt') as f:
+            f.write('field\ttag\tvalue\tid\treads\n')
+            for field, (tag, _) in self.fields.items():
+                for value, id in self.ids[field].items():
+                    f.write(f'{field}\t{tag}\t{value}\t{id}\t{self.reads[field][value]}\n')
+
+
+def read_barcode_dictionary(path, field=None):
+    """
+    Read a barcode dictionary written by tag_barcodes.py.
+
+    Args
+    - path: str
+    - field: str. default=None
+        If given, return only the map from tag value to barcode value for this field.
+
+    Returns: dict (str -> dict (int -> str)), or dict (int -> str) if field is given
+    """
+    dictionary = dict()
+    with open(path, 'rt') as f:
+        header = f.readline().rstrip('\n').split('\t')
+        assert header == ['field', 'tag', 'value', 'id', 'reads'], f"{path} is not a barcode dictionary."
+        for line in f:
+            name, _, value, id, _ = line.rstrip('\n').split('\t')
+            dictionary.setdefault(name, dict())[int(id)] = value
+    if field is not None:
+        return dictionary[field]
+    return dictionary
+
+
+def split_read_name(name, fields):
+    """
+    Remove the given fields from a read name.
+
+    Args
+    - name: str
+        Read name, e.g., 'readname::bead=123'
+    - fields: container of str
+        Names of fields to remove
+
+    Returns: (str, list of (str, str))
+    - Read name without the fields, e.g., 'readname'
+    - (field, value) pairs removed from the read name, in order
+    """
+    found = []
+
+    def remove(match):
+        if match.group(1) in fields:
+            found.append((match.group(1), match.group(2)))
+            return ''
+        return match.group(0)
+
+    return REGEX_FIELD.sub(remove, name), found
+
+
+def tag_barcodes(
+    path_in_bam,
+    path_out_bam,
+    fields,
+    threads=1,
+    uncompressed=False,
+    batch_size=1000,
+    stats=None
+):
+    """
+    Move barcode fields from read names into integer BAM tags.
+
+    Args
+    - path_in_bam: str
+        Path to input BAM file. Use '-' for standard in.
+    - path_out_bam: str or None
+        Path to output BAM file. If None, write to standard out.
+    - fields: dict (str -> (str, str))
+        As returned by parse_field_specs()
+    - threads: int. default=1
+        Number of threads to use for compressing/decompressing BAM files
+    - uncompressed: bool. default=False
+        Write uncompressed BAM, e.g., to pipe into samtools sort.
+    - batch_size: int. default=1000
+        Number of reads per batch passed between the reader, tagging, and writer threads.
+        If 0, read, tag, and write in a single thread.
+    - stats: Stats. default=None
+        Object in which to record read counts and timings
+
+    Returns: BarcodeDictionary
+    """
+    stats = stats if stats is not None else Stats('tag_barcodes')
+    path_in_bam = path_in_bam if path_in_bam != '-' else sys.stdin.buffer
+    path_out_bam = path_out_bam if path_out_bam is not None else sys.stdout.buffer
+    dictionary = BarcodeDictionary(fields)
+    encode = dictionary.encode
+    n_missing = 0
+
+    def process(reads):
+        nonlocal n_missing
+        for read in reads:
+            name, found = split_read_name(read.query_name, fields)
+            if len(found) < len(fields):
+                n_missing += 1
+            read.query_name = name
+            for field, value in found:
+                read.set_tag(fields[field][0], encode(field, value))
+        return reads
+
+    with pysam.AlignmentFile(path_in_bam, 'rb', threads=threads) as file_in:
+        with pysam.AlignmentFile(
+            path_out_bam, 'wbu' if uncompressed else 'wb', template=file_in, threads=threads
+        ) as file_out:
+            run_pipeline(
+                stats.iter(file_in.fetch(until_eof=True)),
+                process,
+                stats.writer(file_out).write,
+                batch_size=max(batch_size, 1),
+                threaded=batch_size > 0,
+                stats=stats
+            )
+    stats.count('reads_missing_fields', n_missing)
+    for field in fields:
+        stats.gauge(f'barcodes_{field}', len(dictionary.ids[field]))
+    return dictionary
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Move barcode fields (e.g., '::bead=123') from read names into integer BAM tags."
+    )
+    parser.add_argument(
+        "input",
+        metavar="in.bam|-",
+        help="Input BAM file. Use '-' for standard in."
+    )
+    parser.add_argument(
+        "-o", "--output",
+        metavar="out.bam",
+        help="Output BAM file. If not provided, write to standard out."
+    )
+    parser.add_argument(
+        "-f", "--field",
+        action="append",
+        metavar="FIELD=TAG[:dict]",
+        help=("Read name field ('::FIELD=value') to move into BAM tag TAG. By default, values must be integers "
+              "and are stored as-is; with ':dict', values are assigned integer ids listed in the barcode "
+              f"dictionary. Can be repeated. Default: {' '.join(DEFAULT_FIELDS)}.")
+    )
+    parser.add_argument(
+        "-d", "--dictionary",
+        metavar="barcodes.tsv",
+        help="Output barcode dictionary. Columns = field, tag, value, id, reads."
+    )
+    parser.add_argument(
+        "-u", "--uncompressed",
+        action="store_true",
+        help="Write uncompressed BAM output."
+    )
+    parser.add_argument(
+        "-t", "--threads",
+        type=positive_int,
+        default=1,
+        metavar="#",
+        help="Number of threads to use for compressing/decompressing BAM files",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        metavar="N",
+        help=("Number of reads per batch passed between the reader, tagging, and writer threads. "
+              "Use 0 to read, tag, and write in a single thread.")
+    )
+    parser.add_argument(
+        "--stats",
+        metavar="stats.json",
+        help="Write read counts, timings, and peak memory usage to this JSON file."
+    )
+    parser.add_argument(
+        "--progress",
+        type=float,
+        metavar="SECONDS",
+        help="Print progress (reads/sec, peak memory) to standard error at this interval."
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main()
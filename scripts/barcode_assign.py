@@ -0,0 +1,387 @@
+'''
+Quality-aware probabilistic assignment of observed barcodes to whitelist barcodes.
+
+Each base of an observed barcode is scored against each candidate whitelist barcode by its Phred quality:
+log P(base | true base) is log(1 - e) for a match and log(e / 3) for a mismatch, where e = 10^(-q/10) is the
+error probability of the base call. These log-likelihoods are precomputed in a table indexed by (quality,
+mismatch), so scoring a batch of reads is a table lookup and a sum per candidate. Candidates are the
+whitelist barcodes within max_mismatches (Hamming distance) of the observed barcode, found with a
+pigeonhole index of whitelist segments. A read is assigned to its most likely candidate if that
+candidate's posterior probability (likelihood x prior, normalized over the candidates and an off-whitelist
+term) is at least a threshold; otherwise, e.g., if 2 candidates are about equally likely, it is left
+unassigned.
+
+The off-whitelist term accounts for reads whose true barcode is not in the whitelist, or is a whitelist
+barcode beyond max_mismatches: with a prior probability, the true barcode is a uniformly random sequence, so
+each called base has likelihood 1/4. A read whose only candidate is several high-quality mismatches away is
+therefore more likely off-whitelist than from that candidate, and is not assigned.
+
+Unlike exact or edit-distance correction (see correction_table.py), a mismatch at a low-quality base costs
+little, and a read within 1 mismatch of 2 whitelist barcodes can still be assigned if the mismatch with
+one of them is at a low-quality base.
+
+Example
+    assigner = BarcodeAssigner(whitelist, max_mismatches=2, threshold=0.9)
+    ids, posteriors = assigner.assign(['ACGTACGT', 'ACGTACGA'], ['IIIIIIII', 'IIIIIII#'])
+'''
+
+import argparse
+import itertools
+import sys
+import numpy as np
+from helpers import fastq_parse, file_open
+from sequence_encoding import N_CODE, hamming, pack, to_codes
+
+MAX_QUALITY = 93  # highest Phred score in Sanger (offset 33) FASTQ
+MAX_ERROR = 0.75  # error probability of a base call that carries no information
+
+
+def to_quals(quals, length=None, offset=33):
+    '''
+    Decode quality strings into a 2-D array of Phred scores.
+
+    Args
+    - quals: sequence of str
+    - length: int. default=None
+        Length of the output rows: shorter strings are padded with quality 0 (no information), longer strings
+        are truncated. If None, all strings must have the same length.
+    - offset: int. default=33
+        ASCII offset of the quality encoding
+
+    Returns: np.ndarray (uint8), shape (len(quals), length)
+        Phred scores clipped to [0, MAX_QUALITY]
+    '''
+    lengths = np.fromiter(map(len, quals), dtype=np.int64, count=len(quals))
+    if length is None:
+        assert len(quals) == 0 or (lengths == lengths[0]).all(), \
+            'Quality strings must have the same length unless length is given.'
+        length = int(lengths[0]) if len(quals) > 0 else 0
+    flat = np.frombuffer(''.join(quals).encode('ascii'), dtype=np.uint8).astype(np.int16) - offset
+    flat = np.clip(flat, 0, MAX_QUALITY).astype(np.uint8)
+    if (lengths == length).all():
+        return flat.reshape(len(quals), length)
+    scores = np.zeros((len(quals), length), dtype=np.uint8)
+    starts = np.cumsum(lengths) - lengths
+    positions = np.arange(length)
+    in_string = positions < lengths[:, np.newaxis]
+    scores[in_string] = flat[(starts[:, np.newaxis] + positions)[in_string]]
+    return scores
+
+
+def likelihood_table(max_error=MAX_ERROR):
+    '''
+    Log-likelihood of a base call given the true base, by quality and whether the call matches.
+
+    Args
+    - max_error: float. default=MAX_ERROR
+        Upper bound on the error probability of a base call. At 0.75, a call of quality 0 or 1 is
+        uninformative (its log-likelihood is the same for a match and a mismatch).
+
+    Returns: np.ndarray (float64), shape (MAX_QUALITY + 1, 2)
+        table[q, 0]: log(1 - e) for a match; table[q, 1]: log(e / 3) for a mismatch; e = 10^(-q/10)
+    '''
+    error = np.minimum(10 ** (-np.arange(MAX_QUALITY + 1) / 10), max_error)
+    return np.stack((np.log1p(-error), np.log(error / 3)), axis=1)
+
+
+class BarcodeAssigner:
+    '''
+    Assign observed barcodes to whitelist barcodes by posterior probability, given base qualities.
+    '''
+
+    def __init__(self, whitelist, max_mismatches=2, threshold=0.9, prior=None, off_whitelist=0.01, max_error=MAX_ERROR):
+        '''
+        Args
+        - whitelist: sequence of str
+            Whitelist barcodes, all of the same length, without Ns. IDs are indices into the whitelist.
+        - max_mismatches: int. default=2
+            Maximum Hamming distance between an observed barcode and a candidate whitelist barcode
+        - threshold: float. default=0.9
+            Minimum posterior probability of the best candidate to assign a read
+        - prior: array_like of float. default=None
+            Prior weight of each whitelist barcode (e.g., its number of reads with an exact match, plus a
+            pseudocount). If None, all whitelist barcodes are equally likely.
+        - off_whitelist: float in [0, 1). default=0.01
+            Prior probability that a read's true barcode is not a whitelist barcode within max_mismatches
+            (e.g., an off-whitelist or chimeric barcode). The prior of the whitelist barcodes is scaled by
+            1 - off_whitelist. If 0, the posterior is normalized over the candidates only, so a read with a
+            single candidate is always assigned.
+        - max_error: float. default=MAX_ERROR
+            See likelihood_table().
+        '''
+        assert len(whitelist) > 0, 'The whitelist is empty.'
+        assert len(set(whitelist)) == len(whitelist), 'Whitelist barcodes must be unique.'
+        self.whitelist = list(whitelist)
+        self.codes = to_codes(self.whitelist)
+        assert (self.codes != N_CODE).all(), 'Whitelist barcodes must only contain A, C, G, and T.'
+        self.length = self.codes.shape[1]
+        self.max_mismatches = max_mismatches
+        self.threshold = threshold
+        self.table = likelihood_table(max_error)
+        if prior is None:
+            prior = np.ones(len(self.whitelist))
+        prior = np.asarray(prior, dtype=np.float64)
+        assert prior.shape == (len(self.whitelist),) and (prior > 0).all(), \
+            'The prior must have a positive weight for each whitelist barcode.'
+        assert 0 <= off_whitelist < 1, 'The off-whitelist probability must be in [0, 1).'
+        self.log_prior = np.log(prior / prior.sum() * (1 - off_whitelist))
+        self.log_off_whitelist = np.log(off_whitelist) if off_whitelist > 0 else -np.inf
+
+        # pigeonhole index: 2 barcodes within max_mismatches of each other are identical in at least 1 of
+        # max_mismatches + 1 segments
+        n_segments = min(max_mismatches + 1, self.length)
+        bounds = [i * self.length // n_segments for i in range(n_segments + 1)]
+        self.segments = list(zip(bounds[:-1], bounds[1:]))
+        self.segment_values = [self._segment_values(self.codes, start, end) for start, end in self.segments]
+        self.index = []
+        for values in self.segment_values:
+            order = np.argsort(values, kind='stable')
+            self.index.append((values[order], order))
+        self.packed = pack(self.codes)
+
+    @staticmethod
+    def _segment_values(codes, start, end):
+        # base-5 value of the bases in [start, end), so that segments containing N never match the whitelist
+        values = np.zeros(len(codes), dtype=np.uint64)
+        for j in range(start, end):
+            values *= np.uint64(N_CODE + 1)
+            values += codes[:, j]
+        return values
+
+    def candidates(self, codes):
+        '''
+        Whitelist barcodes within max_mismatches of each observed barcode.
+
+        Args
+        - codes: np.ndarray (uint8), shape (n, length)
+            Base codes of observed barcodes
+
+        Returns: (reads, ids, mismatches)
+        - reads: np.ndarray (int64)
+            Index of the observed barcode of each candidate pair, in increasing order
+        - ids: np.ndarray (int64)
+            Whitelist ID of each candidate pair
+        - mismatches: np.ndarray (bool), shape (n_pairs, length)
+            Whether each base of the observed barcode mismatches the candidate
+        '''
+        words, nmask = pack(codes)
+        queries = [self._segment_values(codes, start, end) for start, end in self.segments]
+        reads, ids = [], []
+        for i, (values, order) in enumerate(self.index):
+            lo = np.searchsorted(values, queries[i], side='left')
+            hi = np.searchsorted(values, queries[i], side='right')
+            counts = hi - lo
+            read_idx = np.repeat(np.arange(len(codes)), counts)
+            # position of each pair within its read's range of matching whitelist segments
+            offsets = np.arange(len(read_idx)) - np.repeat(np.cumsum(counts) - counts, counts)
+            id_idx = order[np.repeat(lo, counts) + offsets].astype(np.int64)
+            keep = hamming((words[read_idx], nmask[read_idx]),
+                           (self.packed[0][id_idx], self.packed[1][id_idx])) <= self.max_mismatches
+            # a whitelist barcode sharing several segments with a read is a candidate only via the first one
+            for j in range(i):
+                keep &= queries[j][read_idx] != self.segment_values[j][id_idx]
+            reads.append(read_idx[keep])
+            ids.append(id_idx[keep])
+        reads = np.concatenate(reads)
+        ids = np.concatenate(ids)
+        order = np.argsort(reads, kind='stable')
+        reads, ids = reads[order], ids[order]
+        mismatches = codes[reads] != self.codes[ids]
+        return reads, ids, mismatches
+
+    def assign_codes(self, codes, quals):
+        '''
+        Args
+        - codes: np.ndarray (uint8), shape (n, length)
+            Base codes of observed barcodes, e.g., from sequence_encoding.to_codes()
+        - quals: np.ndarray (uint8), shape (n, length)
+            Phred scores, e.g., from to_quals()
+
+        Returns: (ids, posteriors)
+        - ids: np.ndarray (int64)
+            Whitelist ID assigned to each observed barcode, or -1 if unassigned
+        - posteriors: np.ndarray (float64)
+            Posterior probability of the most likely candidate, or 0 if there is no candidate
+        '''
+        codes = np.asarray(codes, dtype=np.uint8)
+        quals = np.minimum(np.asarray(quals, dtype=np.uint8), MAX_QUALITY)
+        assert codes.shape == quals.shape and codes.shape[1:] == (self.length,), \
+            f'Observed barcodes and qualities must have shape (n, {self.length}).'
+        n = len(codes)
+        ids = np.full(n, -1, dtype=np.int64)
+        posteriors = np.zeros(n)
+        reads, candidate_ids, mismatches = self.candidates(codes)
+        if len(reads) == 0:
+            return ids, posteriors
+        scores = self.table[quals[reads], mismatches.view(np.uint8)].sum(axis=1) + self.log_prior[candidate_ids]
+        starts = np.flatnonzero(np.r_[True, reads[1:] != reads[:-1]])
+        read_idx = reads[starts]
+        # off-whitelist score: each base called as A, C, G, or T has likelihood 1/4 under a random true
+        # barcode; an N call mismatches every true base
+        off_whitelist = self.log_off_whitelist + np.where(
+            codes[read_idx] == N_CODE, self.table[quals[read_idx], 1], np.log(0.25)).sum(axis=1)
+        # normalize over the candidates of each read (candidate pairs are grouped by read) and off-whitelist
+        best = np.maximum.reduceat(scores, starts)
+        shift = np.maximum(best, off_whitelist)
+        counts = np.diff(np.r_[starts, len(reads)])
+        weights = np.exp(scores - np.repeat(shift, counts))
+        totals = np.add.reduceat(weights, starts) + np.exp(off_whitelist - shift)
+        # candidate pair with the best score of each read (ties: lowest whitelist ID)
+        best_pair = np.lexsort((candidate_ids, -scores, reads))[starts]
+        posteriors[read_idx] = np.exp(best - shift) / totals
+        assigned = posteriors[read_idx] >= self.threshold
+        ids[read_idx[assigned]] = candidate_ids[best_pair[assigned]]
+        return ids, posteriors
+
+    def assign(self, seqs, quals, offset=33):
+        '''
+        Args
+        - seqs: sequence of str
+            Observed barcodes, all of the whitelist length
+        - quals: sequence of str
+            Quality strings of the observed barcodes
+        - offset: int. default=33
+
+        Returns: (ids, posteriors); see assign_codes()
+        '''
+        return self.assign_codes(to_codes(seqs, length=self.length), to_quals(quals, length=self.length, offset=offset))
+
+
+def read_whitelist(path):
+    '''
+    Returns: list of str
+        Barcodes in the first column of a text file, one per line, skipping empty lines
+    '''
+    with open(path) as f:
+        return [line.split()[0] for line in f if line.strip()]
+
+
+def assign_fastq(path, assigner, path_out=None, start=0, chunksize=100_000):
+    '''
+    Assign the barcode at a fixed position of every read of a FASTQ file.
+
+    Args
+    - path: str
+        FASTQ file, optionally gzip-compressed. Use '-' for standard in.
+    - assigner: BarcodeAssigner
+    - path_out: str. default=None
+        Output tab-delimited table; columns = read, barcode, posterior. barcode is empty for unassigned
+        reads. If None, write to standard out.
+    - start: int. default=0
+        0-based position of the barcode in each read
+    - chunksize: int. default=100_000
+        Number of reads assigned per batch
+
+    Returns: (int, int)
+        Number of assigned and unassigned reads
+    '''
+    end = start + assigner.length
+    f_in = file_open(path) if path != '-' else sys.stdin.buffer
+    f_out = open(path_out, 'w') if path_out is not None else sys.stdout
+    n_assigned, n_unassigned = 0, 0
+    try:
+        f_out.write('read\tbarcode\tposterior\n')
+        records = fastq_parse(f_in)
+        for chunk in iter(lambda: list(itertools.islice(records, chunksize)), []):
+            names = [name[1:].split(maxsplit=1)[0] for name, _, _, _ in chunk]
+            ids, posteriors = assigner.assign(
+                [seq[start:end] for _, seq, _, _ in chunk],
+                [qual[start:end] for _, _, _, qual in chunk]
+            )
+            whitelist = assigner.whitelist
+            f_out.write(''.join(
+                f'{name}\t{whitelist[i] if i >= 0 else ""}\t{posterior:.4g}\n'
+                for name, i, posterior in zip(names, ids.tolist(), posteriors.tolist())
+            ))
+            n = int((ids >= 0).sum())
+            n_assigned += n
+            n_unassigned += len(chunk) - n
+    finally:
+        if path != '-':
+            f_in.close()
+        if path_out is not None:
+            f_out.close()
+    return n_assigned, n_unassigned
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    assigner = BarcodeAssigner(
+        read_whitelist(args.whitelist),
+        max_mismatches=args.max_mismatches,
+        threshold=args.threshold,
+        off_whitelist=args.off_whitelist
+    )
+    n_assigned, n_unassigned = assign_fastq(
+        args.input,
+        assigner,
+        path_out=args.output,
+        start=args.start,
+        chunksize=args.chunksize
+    )
+    print(f'Assigned {n_assigned:,} reads; {n_unassigned:,} reads were not assigned.', file=sys.stderr)
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description=("Assign the barcode at a fixed position of each read to a whitelist barcode by posterior "
+                     "probability given base qualities. Output is a tab-delimited table; "
+                     "columns = read, barcode, posterior.")
+    )
+    parser.add_argument(
+        "input",
+        metavar="reads.fastq[.gz]|-",
+        help="FASTQ file. Use '-' for standard in."
+    )
+    parser.add_argument(
+        "-w", "--whitelist",
+        required=True,
+        metavar="whitelist.txt",
+        help="Whitelist barcodes, one per line, all of the same length."
+    )
+    parser.add_argument(
+        "-o", "--output",
+        metavar="assignments.tsv",
+        help="Output table. Default: standard out."
+    )
+    parser.add_argument(
+        "--start",
+        type=int,
+        default=0,
+        metavar="POS",
+        help="0-based position of the barcode in each read. Default: 0."
+    )
+    parser.add_argument(
+        "-m", "--max-mismatches",
+        type=int,
+        default=2,
+        metavar="N",
+        help="Maximum number of mismatches between a read's barcode and a candidate whitelist barcode. Default: 2."
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.9,
+        metavar="P",
+        help="Minimum posterior probability of the most likely candidate to assign a read. Default: 0.9."
+    )
+    parser.add_argument(
+        "--off-whitelist",
+        type=float,
+        default=0.01,
+        metavar="P",
+        help=("Prior probability that a read's barcode is not a whitelist barcode within --max-mismatches. "
+              "Use 0 to normalize posteriors over the candidates only. Default: 0.01.")
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=100_000,
+        metavar="N",
+        help="Number of reads assigned per batch. Default: 100000."
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main()
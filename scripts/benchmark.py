@@ -0,0 +1,325 @@
+'''
+Benchmark the throughput (reads/sec) and peak memory of hot paths on synthetic data, and compare to a
+stored baseline.
+
+Each stage runs in a fresh Python subprocess so that peak RSS is measured per stage and so that modules
+from scripts/ and scripts/20241121/ (which both contain a helpers module) do not collide.
+
+Example
+    python benchmark.py --save-baseline               # record baseline.json
+    python benchmark.py                               # compare to baseline.json
+    python benchmark.py --stages dedup_paired_end --scale 5
+'''
+
+import argparse
+import json
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+DIR_SCRIPTS = os.path.abspath(os.path.dirname(__file__))
+DIR_PIPELINE = os.path.join(DIR_SCRIPTS, '20241121')
+sys.path.append(DIR_SCRIPTS)
+
+# stage name -> default number of items (reads, read pairs, barcode lines, whitelist sequences, or command
+# invocations)
+STAGES = {
+    'fastq_parse': 200_000,
+    'find_adapters': 1_000,
+    'generate_variant_map': 96,
+    'barcodes_to_df': 200_000,
+    'dedup_paired_end': 100_000,
+    'dedup_saturation': 100_000,
+    'cli_startup': 24,
+    'assign_barcodes': 200_000,
+}
+
+
+def main():
+    args = parse_arguments()
+    if args.run_stage is not None:
+        print(json.dumps(run_stage(args.run_stage, args.workdir, args.n)))
+        return
+    stages = args.stages if args.stages is not None else list(STAGES)
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        results = dict(
+            python=platform.python_version(),
+            platform=platform.platform(),
+            scale=args.scale,
+            stages=dict()
+        )
+        for stage in stages:
+            n = max(1, int(STAGES[stage] * args.scale))
+            prepare_stage(stage, workdir, n, seed=args.seed)
+            runs = [run_stage_subprocess(stage, workdir, n) for _ in range(args.repeat)]
+            results['stages'][stage] = dict(
+                n=n,
+                seconds=min(run['seconds'] for run in runs),
+                per_sec=max(run['per_sec'] for run in runs),
+                max_rss_mb=min(run['max_rss_mb'] for run in runs),
+            )
+            print(format_result(stage, results['stages'][stage]), file=sys.stderr)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Saved baseline to {args.baseline}', file=sys.stderr)
+        return
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, tolerance=args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+
+def format_result(stage, result):
+    return (f"{stage:<22} n={result['n']:<9} {result['seconds']:8.2f} s "
+            f"{result['per_sec']:12,.0f} /s {result['max_rss_mb']:8.1f} MB")
+
+
+def compare(results, baseline, tolerance=0.1):
+    '''
+    Compare benchmark results to a baseline.
+
+    Args
+    - results, baseline: dict
+        Benchmark results, as generated by main()
+    - tolerance: float
+        Relative slowdown in throughput or increase in peak RSS beyond which a stage is reported as
+        a regression.
+
+    Returns: list of str
+        Stages that regressed
+    '''
+    regressions = []
+    print(f"{'stage':<22} {'per_sec':>12} {'baseline':>12} {'ratio':>7} {'rss_mb':>8} {'baseline':>8}",
+          file=sys.stderr)
+    for stage, result in results['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+        base = baseline['stages'][stage]
+        speed_ratio = result['per_sec'] / base['per_sec']
+        rss_ratio = result['max_rss_mb'] / base['max_rss_mb']
+        regressed = speed_ratio < 1 - tolerance or rss_ratio > 1 + tolerance
+        if regressed:
+            regressions.append(stage)
+        print(f"{stage:<22} {result['per_sec']:12,.0f} {base['per_sec']:12,.0f} {speed_ratio:7.2f} "
+              f"{result['max_rss_mb']:8.1f} {base['max_rss_mb']:8.1f}{'  REGRESSION' if regressed else ''}",
+              file=sys.stderr)
+    return regressions
+
+
+def prepare_stage(stage, workdir, n, seed=0):
+    '''
+    Write synthetic input data for a stage to workdir.
+    '''
+    import synthetic
+    if stage == 'fastq_parse':
+        synthetic.write_fastq(os.path.join(workdir, 'reads.fastq.gz'), synthetic.synthetic_reads(n, seed=seed))
+    elif stage == 'find_adapters':
+        synthetic.write_fastq(
+            os.path.join(workdir, 'adapter_reads.fastq'),
+            synthetic.synthetic_reads(n, sub_rate=0.01, indel_rate=0.005, seed=seed)
+        )
+    elif stage == 'barcodes_to_df':
+        with open(os.path.join(workdir, 'read_barcodes.txt'), 'w') as f:
+            f.writelines(synthetic.synthetic_barcode_lines(n, seed=seed))
+    elif stage in ('dedup_paired_end', 'dedup_saturation'):
+        synthetic.write_paired_bam(os.path.join(workdir, 'pairs.bam'), n, seed=seed)
+
+
+def run_stage_subprocess(stage, workdir, n):
+    process = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--run-stage', stage, '--workdir', workdir, '-n', str(n)],
+        capture_output=True,
+        text=True
+    )
+    if process.returncode != 0:
+        sys.exit(f'Stage {stage} failed:\n{process.stderr}')
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def run_stage(stage, workdir, n):
+    '''
+    Run a stage in the current process on data prepared by prepare_stage().
+
+    Returns: dict
+    - n: number of items processed
+    - seconds: wall time of the stage (excluding imports)
+    - per_sec: items processed per second
+    - max_rss_mb: peak resident set size of the process
+    '''
+    if stage == 'dedup_paired_end':
+        sys.path.insert(0, DIR_PIPELINE)
+        from dedup import dedup_paired_end
+    elif stage == 'dedup_saturation':
+        sys.path.insert(0, DIR_PIPELINE)
+        from dedup import SaturationCounter, dedup_paired_end
+    elif stage == 'find_adapters':
+        import Bio.Align
+        import demultiplex
+        import synthetic
+    elif stage == 'generate_variant_map':
+        import numpy as np
+        import string_distances
+        import synthetic
+    elif stage == 'barcodes_to_df':
+        import parse_barcodes
+        import synthetic
+    elif stage == 'cli_startup':
+        import scbarcode
+    elif stage == 'assign_barcodes':
+        import numpy as np
+        import barcode_assign
+        import synthetic
+    from helpers import fastq_parse, file_open
+
+    start = time.perf_counter()
+    if stage == 'fastq_parse':
+        with file_open(os.path.join(workdir, 'reads.fastq.gz')) as f:
+            n = sum(1 for _ in fastq_parse(f))
+    elif stage == 'find_adapters':
+        adapters = [('2Puni', synthetic.ADAPTER_2PUNI), ('2Pbc_rc', synthetic.reverse_complement(synthetic.ADAPTER_2PBC))]
+        thresholds = {name: 0.8 * len(seq) for name, seq in adapters}
+        aligner = Bio.Align.PairwiseAligner(mismatch_score=-1, internal_gap_score=-1, wildcard='N')
+        aligner.end_gap_score = 0  # free end gaps: find adapters within reads
+        with file_open(os.path.join(workdir, 'adapter_reads.fastq')) as f:
+            n = 0
+            for _, seq, _, _ in fastq_parse(f):
+                demultiplex.find_adapters(seq, adapters, thresholds, aligner=aligner)
+                n += 1
+    elif stage == 'generate_variant_map':
+        # barcodes >= 3 edits apart have disjoint sets of variants within 1 edit
+        seqs = set(synthetic.random_whitelist(
+            np.random.default_rng(0), n, 8, min_distance=3, distfun=string_distances.levenshtein_distance))
+        start = time.perf_counter()
+        string_distances.generate_variant_map(seqs, 1, verify_unique=True)
+    elif stage == 'barcodes_to_df':
+        with open(os.path.join(workdir, 'read_barcodes.txt')) as f:
+            df, n_unmatched, _ = parse_barcodes.barcodes_to_df(f, re.compile(synthetic.REGEX_BARCODE))
+        n = len(df) + n_unmatched
+    elif stage == 'dedup_paired_end':
+        dedup_paired_end(
+            os.path.join(workdir, 'pairs.bam'),
+            path_out_bam=os.devnull,
+            path_out_bed=os.path.join(workdir, 'counts.bed'),
+            barcode_rgx='::bead=([0-9]+)'
+        )
+    elif stage == 'dedup_saturation':
+        # no barcode regex or tag: exercises fragments without a barcode
+        saturation = SaturationCounter([0.1, 0.25, 0.5, 0.75])
+        dedup_paired_end(
+            os.path.join(workdir, 'pairs.bam'),
+            path_out_bam=os.devnull,
+            path_out_bed=os.path.join(workdir, 'counts.bed'),
+            saturation=saturation
+        )
+        saturation.table()
+        saturation.barcode_table()
+    elif stage == 'cli_startup':
+        # startup time of each subcommand (imports and argument parsing), cycling through the subcommands
+        commands = list(scbarcode.COMMANDS)
+        for i in range(n):
+            subprocess.run(
+                [sys.executable, scbarcode.__file__, commands[i % len(commands)], '--help'],
+                stdout=subprocess.DEVNULL,
+                check=True
+            )
+    elif stage == 'assign_barcodes':
+        rng = np.random.default_rng(0)
+        whitelist = synthetic.random_whitelist(rng, 10_000, 16, min_distance=3)
+        seqs = [synthetic.mutate(whitelist[i], rng, sub_rate=0.02) for i in rng.integers(0, len(whitelist), n)]
+        quals = synthetic.random_quals(rng, n, 16)
+        start = time.perf_counter()
+        assigner = barcode_assign.BarcodeAssigner(whitelist, max_mismatches=2)
+        for i in range(0, n, 100_000):
+            assigner.assign(seqs[i:i + 100_000], quals[i:i + 100_000])
+    else:
+        raise ValueError(f'Unknown stage: {stage}')
+    seconds = time.perf_counter() - start
+    # peak RSS of the largest subcommand process
+    who = resource.RUSAGE_CHILDREN if stage == 'cli_startup' else resource.RUSAGE_SELF
+    return dict(
+        n=n,
+        seconds=seconds,
+        per_sec=n / seconds,
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        max_rss_mb=resource.getrusage(who).ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10),
+    )
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Benchmark hot paths on synthetic data and compare to a baseline."
+    )
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=list(STAGES),
+        metavar="STAGE",
+        help=f"Stages to benchmark. Default: all ({', '.join(STAGES)})."
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1,
+        metavar="X",
+        help="Multiply the default number of items per stage by this factor."
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Run each stage N times and report the best run."
+    )
+    parser.add_argument(
+        "--baseline",
+        default=os.path.join(DIR_SCRIPTS, "benchmark_baseline.json"),
+        metavar="baseline.json",
+        help="Baseline results file to compare to (or to write with --save-baseline)."
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Save results as the new baseline instead of comparing to it."
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        metavar="FRAC",
+        help=("Report a regression (and exit with status 1) if throughput drops or peak RSS grows "
+              "by more than this fraction relative to the baseline.")
+    )
+    parser.add_argument(
+        "-o", "--output",
+        metavar="results.json",
+        help="Write results to this file."
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Random seed for synthetic data."
+    )
+    parser.add_argument(
+        "--workdir",
+        metavar="DIR",
+        help="Directory for temporary synthetic data. Default: system temporary directory."
+    )
+    parser.add_argument("--run-stage", choices=list(STAGES), help=argparse.SUPPRESS)
+    parser.add_argument("-n", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
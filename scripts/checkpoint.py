@@ -0,0 +1,185 @@
+'''
+Checkpoints for resumable single-pass runs over a large input file (e.g., parsing barcodes or
+demultiplexing reads), such as cluster jobs that may hit their time limit.
+
+A checkpoint records the input position (byte offset for plain files, uncompressed offset for gzip files,
+virtual offset for BGZF files), the size of each output file, and partial results (e.g., counts). Outputs
+are flushed to disk before the checkpoint is atomically replaced, so on resume, the input is reopened at the
+recorded position and each output is truncated to its recorded size: every input record is reflected in the
+outputs exactly once.
+
+Example
+    checkpoint = Checkpoint(path_out + '.checkpoint', params=dict(regex=pattern))
+    state = checkpoint.load() if resume else None
+    f_in = open_input(path_in, offset=state['input_offset'] if state else 0)
+    f_out = OutputFile(path_out, size=state['output_sizes'][0] if state else None)
+    for chunk in iter(lambda: list(itertools.islice(f_in, 100000)), []):
+        f_out.write(process(chunk))
+        if checkpoint.due():
+            checkpoint.save(f_in.tell(), [f_out], dict(n_lines=...))
+    checkpoint.remove()
+'''
+
+import gzip
+import json
+import os
+import time
+from Bio import bgzf
+from fastq_index import is_bgzf
+from helpers import write_atomic
+
+FORMAT_VERSION = 1
+
+
+def open_input(path, offset=0):
+    '''
+    Open a plain, gzip-, or BGZF-compressed file for binary reading at a position previously returned by
+    the file object's tell().
+
+    Resuming a regular gzip file decompresses (but does not parse) the input up to the offset; BGZF files
+    seek directly to the block containing the offset.
+
+    Returns: file object
+        Supports iteration over lines (bytes), tell(), and seek()
+    '''
+    if is_bgzf(path):
+        f = bgzf.BgzfReader(path, 'rb')
+    else:
+        with open(path, 'rb') as f:
+            compressed = f.read(2) == b'\x1f\x8b'
+        f = gzip.open(path, 'rb') if compressed else open(path, 'rb')
+    if offset:
+        f.seek(offset)
+    return f
+
+
+class OutputFile:
+    '''
+    Append-only output file whose size can be recorded in a checkpoint and restored on resume.
+
+    If the path ends with '.gz', each write() is compressed as a separate gzip member (concatenated members
+    form a valid gzip file), so the file can be truncated at any recorded size.
+    '''
+
+    def __init__(self, path, size=None):
+        '''
+        Args
+        - path: str
+        - size: int. default=None
+            If given, open an existing file and truncate it to this size (e.g., as recorded in a checkpoint).
+            Otherwise, create or overwrite the file.
+        '''
+        self.path = path
+        self.compressed = path.endswith('.gz')
+        if size is None:
+            self.f = open(path, 'wb')
+        else:
+            self.f = open(path, 'r+b')
+            self.f.truncate(size)
+            self.f.seek(size)
+
+    def write(self, text):
+        if len(text) == 0:
+            return
+        data = text.encode()
+        if self.compressed:
+            data = gzip.compress(data, compresslevel=6)
+        self.f.write(data)
+
+    def sync(self):
+        '''
+        Flush written data to disk.
+
+        Returns: int
+            Size of the file
+        '''
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        return self.f.tell()
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Checkpoint:
+    '''
+    Periodically saved state of a run, stored as a JSON file.
+    '''
+
+    def __init__(self, path, params=None, interval=300):
+        '''
+        Args
+        - path: str
+            Path of the checkpoint file
+        - params: dict. default=None
+            JSON-serializable parameters of the run (e.g., input path, regular expression). A checkpoint is
+            only resumed by a run with the same parameters.
+        - interval: float. default=300
+            Minimum number of seconds between checkpoints; see due().
+        '''
+        self.path = path
+        self.params = json.loads(json.dumps(params or {}))  # normalize, e.g., tuples to lists
+        self.interval = interval
+        self.last_save = time.monotonic()
+
+    def due(self):
+        '''
+        Returns: bool
+            Whether at least `interval` seconds have passed since the last checkpoint (or since the
+            Checkpoint object was created).
+        '''
+        return time.monotonic() - self.last_save >= self.interval
+
+    def load(self):
+        '''
+        Returns: dict or None
+            Saved state, or None if there is no checkpoint. Keys:
+            - input_offset: int
+            - output_sizes: list of int
+            - state: dict of partial results, as passed to save()
+        '''
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            checkpoint = json.load(f)
+        assert checkpoint['version'] == FORMAT_VERSION, f'Checkpoint {self.path} has an unsupported format version.'
+        assert checkpoint['params'] == self.params, (
+            f'Checkpoint {self.path} was saved by a run with different parameters: {checkpoint["params"]}. '
+            'Remove it to start over.'
+        )
+        return checkpoint
+
+    def save(self, input_offset, outputs, state=None):
+        '''
+        Flush outputs to disk, then atomically replace the checkpoint file.
+
+        Args
+        - input_offset: int
+            Position of the input after the last processed record, as returned by tell().
+        - outputs: list of OutputFile
+            Outputs written so far
+        - state: dict. default=None
+            JSON-serializable partial results
+        '''
+        checkpoint = dict(
+            version=FORMAT_VERSION,
+            params=self.params,
+            input_offset=input_offset,
+            output_sizes=[output.sync() for output in outputs],
+            state=state or {},
+        )
+        write_atomic(self.path, json.dumps(checkpoint).encode())
+        self.last_save = time.monotonic()
+
+    def remove(self):
+        '''
+        Remove the checkpoint file, e.g., after the run has completed.
+        '''
+        if os.path.exists(self.path):
+            os.remove(self.path)
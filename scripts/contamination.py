@@ -0,0 +1,333 @@
+'''
+Tag-plate contamination analysis from read barcodes (e.g., as parsed by parse_barcodes.barcodes_to_df()).
+
+Reads are tabulated in a sparse contingency tensor over barcoding rounds: each round's label (e.g., the well
+number of the tag) is encoded as a small integer, and each combination of labels as a single mixed-radix
+integer key. Only observed combinations are stored, so memory is bounded by the number of distinct
+combinations rather than the number of reads or the size of the full tensor.
+'''
+
+import itertools
+import numpy as np
+import pandas as pd
+
+KEY_DTYPE = np.uint64
+
+
+class ContingencyTensor:
+    '''
+    Sparse counts of reads per combination of labels across rounds.
+
+    Code 0 of every round denotes a missing label (e.g., the tag of that round was not identified);
+    labels are assigned codes 1, 2, ... in order of first appearance.
+
+    Attributes
+    - rounds: list of str
+        Round names, e.g., ['Y', 'R3', 'R2', 'R1']
+    - labels: list of list
+        labels[i][code] is the label of round i encoded as code; labels[i][0] is None.
+    - keys: np.ndarray (uint64)
+        Sorted mixed-radix keys of observed label combinations
+    - counts: np.ndarray (int64)
+        Number of reads with each key
+    - n_reads: int
+
+    Example
+        tensor = ContingencyTensor(['Y', 'R3', 'R2', 'R1'])
+        tensor.add(df_barcodes)
+        tensor.crosstab('R1', 'R2')
+    '''
+
+    def __init__(self, rounds):
+        self.rounds = list(rounds)
+        assert len(set(self.rounds)) == len(self.rounds), 'Round names must be unique.'
+        self.labels = [[None] for _ in self.rounds]
+        self._lookup = [dict() for _ in self.rounds]
+        self.keys = np.zeros(0, dtype=KEY_DTYPE)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.n_reads = 0
+
+    @property
+    def radices(self):
+        return np.array([len(labels) for labels in self.labels], dtype=KEY_DTYPE)
+
+    @staticmethod
+    def _strides(radices):
+        strides = np.cumprod(np.concatenate(([1], radices[:-1]))).astype(KEY_DTYPE)
+        assert np.prod(radices.astype(np.float64)) < 2**63, 'Too many labels to encode combinations in 64 bits.'
+        return strides
+
+    def encode(self, round, values):
+        '''
+        Encode the labels of one round as small integers, registering new labels.
+
+        Args
+        - round: str
+        - values: array-like
+            Labels. Missing values (None or NaN) are encoded as 0.
+
+        Returns: np.ndarray (uint64)
+        '''
+        i = self.rounds.index(round)
+        codes, uniques = pd.factorize(np.asarray(values, dtype=object), use_na_sentinel=True)
+        lookup = self._lookup[i]
+        mapping = np.empty(len(uniques) + 1, dtype=KEY_DTYPE)
+        mapping[-1] = 0  # factorize encodes missing values as -1
+        for j, label in enumerate(uniques):
+            code = lookup.get(label)
+            if code is None:
+                code = lookup[label] = len(self.labels[i])
+                self.labels[i].append(label)
+            mapping[j] = code
+        return mapping[codes]
+
+    def decode(self, keys=None):
+        '''
+        Args
+        - keys: np.ndarray (uint64). default=None
+            Mixed-radix keys. If None, use the keys of all observed combinations.
+
+        Returns: np.ndarray (int64), shape (len(keys), len(rounds))
+            Code of each round for each key
+        '''
+        return self._decode(self.keys if keys is None else keys, self.radices)
+
+    @classmethod
+    def _decode(cls, keys, radices):
+        strides = cls._strides(radices)
+        return ((keys[:, np.newaxis] // strides) % radices).astype(np.int64)
+
+    def add(self, barcodes, weights=None):
+        '''
+        Add reads.
+
+        Args
+        - barcodes: pd.DataFrame or dict (str -> array-like)
+            Label of each read in each round, e.g., as returned by parse_barcodes.barcodes_to_df().
+            Rounds that are absent are treated as missing for all reads; other columns are ignored.
+        - weights: array-like. default=None
+            Number of reads represented by each row. If None, each row is 1 read.
+        '''
+        n = len(next(iter(barcodes.values())) if isinstance(barcodes, dict) else barcodes)
+        old_radices = self.radices
+        codes = [
+            self.encode(round, barcodes[round]) if round in barcodes else np.zeros(n, dtype=KEY_DTYPE)
+            for round in self.rounds
+        ]
+        radices = self.radices
+        if not np.array_equal(radices, old_radices) and len(self.keys) > 0:
+            # new labels change the radices: re-encode existing keys (order is preserved per code tuple,
+            # but not across tuples, so re-sort)
+            self.keys = self._decode(self.keys, old_radices).astype(KEY_DTYPE) @ self._strides(radices)
+            order = np.argsort(self.keys, kind='stable')
+            self.keys, self.counts = self.keys[order], self.counts[order]
+        strides = self._strides(radices)
+        keys = np.zeros(n, dtype=KEY_DTYPE)
+        for code, stride in zip(codes, strides):
+            keys += code * stride
+        weights = np.ones(n, dtype=np.int64) if weights is None else np.asarray(weights, dtype=np.int64)
+        chunk_keys, inverse = np.unique(keys, return_inverse=True)
+        chunk_counts = np.bincount(inverse.ravel(), weights=weights, minlength=len(chunk_keys)).astype(np.int64)
+        self._merge(chunk_keys, chunk_counts)
+        self.n_reads += int(weights.sum())
+
+    def _merge(self, keys, counts):
+        if len(self.keys) == 0:
+            self.keys, self.counts = keys, counts
+            return
+        all_keys, inverse = np.unique(np.concatenate((self.keys, keys)), return_inverse=True)
+        self.counts = np.bincount(
+            inverse.ravel(), weights=np.concatenate((self.counts, counts)), minlength=len(all_keys)
+        ).astype(np.int64)
+        self.keys = all_keys
+
+    def merge(self, other):
+        '''
+        Add the counts of another ContingencyTensor with the same rounds.
+        '''
+        assert other.rounds == self.rounds, 'Tensors must have the same rounds.'
+        if len(other.keys) == 0:
+            return
+        codes = other.decode()
+        self.add(
+            {round: np.array(other.labels[i], dtype=object)[codes[:, i]] for i, round in enumerate(self.rounds)},
+            weights=other.counts
+        )
+
+    def marginal(self, rounds=None):
+        '''
+        Sum counts over all rounds except the given rounds.
+
+        Args
+        - rounds: list of str. default=None
+            Rounds to keep. If None, keep all rounds.
+
+        Returns: pd.DataFrame
+            Columns = rounds (labels; None if missing) and count. Sorted by count, descending.
+        '''
+        rounds = self.rounds if rounds is None else list(rounds)
+        idx = [self.rounds.index(round) for round in rounds]
+        radices = self.radices[idx]
+        codes = self.decode()[:, idx]
+        sub_keys = codes.astype(KEY_DTYPE) @ self._strides(radices) if len(idx) > 0 \
+            else np.zeros(len(self.keys), dtype=KEY_DTYPE)
+        unique, inverse = np.unique(sub_keys, return_inverse=True)
+        counts = np.bincount(inverse.ravel(), weights=self.counts, minlength=len(unique)).astype(np.int64)
+        unique_codes = self._decode(unique, radices)
+        df = pd.DataFrame({
+            round: np.array(self.labels[i], dtype=object)[unique_codes[:, j]]
+            for j, (i, round) in enumerate(zip(idx, rounds))
+        })
+        df['count'] = counts
+        return df.sort_values('count', ascending=False, kind='stable').reset_index(drop=True)
+
+    def crosstab(self, row, col, dropna=True):
+        '''
+        Dense 2-round contingency table, like pd.crosstab() of the 2 rounds over all reads.
+
+        Args
+        - row, col: str
+            Rounds
+        - dropna: bool. default=True
+            Exclude reads missing the label of either round.
+
+        Returns: pd.DataFrame
+            Index = labels of round row; columns = labels of round col; values = read counts
+        '''
+        df = self.marginal([row, col])
+        if dropna:
+            df = df.dropna()
+        table = df.pivot_table(index=row, columns=col, values='count', aggfunc='sum', fill_value=0, dropna=False)
+        return table.sort_index(axis=0, key=_natural_key).sort_index(axis=1, key=_natural_key)
+
+    def to_frame(self):
+        '''
+        Returns: pd.DataFrame
+            One row per observed label combination. Columns = rounds and count.
+        '''
+        return self.marginal(self.rounds)
+
+
+def _natural_key(index):
+    # sort numeric labels (e.g., well numbers parsed as strings) numerically
+    numeric = pd.to_numeric(index, errors='coerce')
+    return numeric if not np.isnan(numeric).any() else index.astype(str)
+
+
+def tensor_from_barcodes(f, regex, rounds=None, split='::', chunksize=1_000_000):
+    '''
+    Build a ContingencyTensor from a read barcodes file in one streaming pass.
+
+    Args
+    - f: file object
+        The barcode file, e.g., as the output of open() or gzip.open()
+    - regex: re.Pattern
+        Regular expression with a named group for each round, as for parse_barcodes.barcodes_to_df()
+    - rounds: list of str. default=None
+        Named groups of regex to tabulate. If None, use all named groups except 'umi'.
+    - split: str or None
+        Split each line of the barcode file according to split, then search the last split.
+    - chunksize: int. default=1_000_000
+        Number of lines encoded at a time. Memory use is proportional to chunksize plus the number
+        of observed label combinations.
+
+    Returns
+    - tensor: ContingencyTensor
+    - n_unmatched: int
+        Number of lines that did not match regex
+    '''
+    if rounds is None:
+        rounds = [name for name in regex.groupindex if name != 'umi']
+    tensor = ContingencyTensor(rounds)
+    search = regex.search
+    n_unmatched = 0
+    while lines := list(itertools.islice(f, chunksize)):
+        matches = [search(line.strip().split(split)[-1]) for line in lines]
+        matches = [m.group(*rounds) if len(rounds) > 1 else (m.group(*rounds),) for m in matches if m is not None]
+        n_unmatched += len(lines) - len(matches)
+        if matches:
+            tensor.add(dict(zip(rounds, zip(*matches))))
+    return tensor, n_unmatched
+
+
+def label_usage(tensor, round, expected):
+    '''
+    Reads per label of one round, flagging labels that were not used in the experiment.
+
+    Args
+    - tensor: ContingencyTensor
+    - round: str
+    - expected: collection
+        Labels used in the experiment for this round. Reads with other labels indicate contamination.
+
+    Returns: pd.DataFrame
+        Columns = label, count, fraction (of reads with a label in this round), expected (bool).
+        Sorted by count, descending.
+    '''
+    df = tensor.marginal([round]).dropna().rename(columns={round: 'label'})
+    df['fraction'] = df['count'] / df['count'].sum()
+    df['expected'] = df['label'].isin(set(expected))
+    return df.reset_index(drop=True)
+
+
+def well_contamination(tensor, well_round, observed_round, expected=None, top=3):
+    '''
+    Per-well contamination rates: for reads assigned to each well (label) of well_round, the fraction whose
+    label in observed_round is not expected for that well.
+
+    Args
+    - tensor: ContingencyTensor
+    - well_round: str
+        Round whose labels define wells (e.g., the round used to identify samples)
+    - observed_round: str
+        Round whose labels are checked against the expected labels of each well
+    - expected: dict (label -> collection of labels). default=None
+        Labels of observed_round expected for each well. If None, each well expects only its own label
+        (i.e., the same well position in the plate of each round). Wells not in expected expect nothing.
+    - top: int. default=3
+        Number of top offending labels to report per well
+
+    Returns: pd.DataFrame
+        One row per well. Columns = well, reads, expected_reads, contaminant_reads, contamination_rate,
+        top_contaminants (str of 'label:reads' pairs). Sorted by contaminant_reads, descending.
+    '''
+    pairs = contaminant_pairs(tensor, well_round, observed_round, expected=expected)
+    rows = []
+    for well, group in pairs.groupby('well', sort=False):
+        contaminants = group.loc[~group['expected']]
+        n_contaminant = int(contaminants['count'].sum())
+        rows.append(dict(
+            well=well,
+            reads=int(group['count'].sum()),
+            expected_reads=int(group.loc[group['expected'], 'count'].sum()),
+            contaminant_reads=n_contaminant,
+            top_contaminants=', '.join(
+                f'{label}:{count}' for label, count in
+                contaminants.nlargest(top, 'count')[['observed', 'count']].itertuples(index=False)
+            )
+        ))
+    df = pd.DataFrame(rows, columns=['well', 'reads', 'expected_reads', 'contaminant_reads', 'top_contaminants'])
+    df.insert(4, 'contamination_rate', df['contaminant_reads'] / df['reads'])
+    return df.sort_values('contaminant_reads', ascending=False, kind='stable').reset_index(drop=True)
+
+
+def contaminant_pairs(tensor, well_round, observed_round, expected=None):
+    '''
+    Reads per (well, observed label) pair, flagging unexpected pairs. The top offenders are the first rows
+    with expected == False.
+
+    Args: see well_contamination()
+
+    Returns: pd.DataFrame
+        Columns = well, observed, count, fraction (of the well's reads), expected (bool).
+        Sorted by count, descending. Reads missing either label are excluded.
+    '''
+    df = tensor.marginal([well_round, observed_round]).dropna()
+    df.columns = ['well', 'observed', 'count']
+    if expected is None:
+        df['expected'] = df['well'] == df['observed']
+    else:
+        expected = {well: set(labels) for well, labels in expected.items()}
+        df['expected'] = [obs in expected.get(well, ()) for well, obs in zip(df['well'], df['observed'])]
+    df.insert(3, 'fraction', df['count'] / df.groupby('well')['count'].transform('sum'))
+    return df.reset_index(drop=True)
@@ -0,0 +1,215 @@
+'''
+Persistent barcode correction tables: every variant of each whitelist barcode (within a given edit
+distance, see string_distances.generate_variant_map()) mapped to the whitelist barcode's ID.
+
+A table is built once and saved as 2 NumPy arrays, sorted 2-bit-packed uint64 variant keys and uint32
+whitelist IDs, in a cache directory under a name derived from a hash of the whitelist and distance
+parameters. Tables are memory-mapped read-only, so worker processes share one copy of the table through
+the page cache, and batches of observed barcodes are looked up with a vectorized np.searchsorted().
+
+Example
+    table = correction_table(whitelist, dist_total=1, cache_dir='barcode_tables')
+    ids = table.lookup(['ACGTACGT', 'ACGTACGA', 'NNNNNNNN'])   # -> array([3, 3, -1])
+    with multiprocessing.Pool(8) as pool:   # workers re-open the memory-mapped files
+        pool.map(functools.partial(assign, table=table), batches)
+'''
+
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+import string_distances
+from helpers import write_atomic
+from sequence_encoding import MAX_KEY_LENGTH, encode_keys
+
+FORMAT_VERSION = 1
+
+
+def table_hash(whitelist, dist_total, dist_hamming=None, dist_indel=None, ambiguous='drop'):
+    '''
+    Returns: str
+        Hexadecimal hash identifying a correction table by its whitelist (order-independent), distance
+        parameters, and handling of ambiguous variants.
+    '''
+    params = dict(
+        version=FORMAT_VERSION,
+        whitelist=sorted(set(whitelist)),
+        dist_total=dist_total,
+        dist_hamming=dist_hamming,
+        dist_indel=dist_indel,
+        ambiguous=ambiguous
+    )
+    return hashlib.blake2b(json.dumps(params).encode(), digest_size=12).hexdigest()
+
+
+def build_correction_table(
+    whitelist,
+    dist_total,
+    dist_hamming=None,
+    dist_indel=None,
+    path_prefix=None,
+    ambiguous='drop'
+):
+    '''
+    Generate all variants of each whitelist barcode and save the sorted variant keys and whitelist IDs.
+
+    Args
+    - whitelist: iterable of str
+        Whitelist barcodes. IDs are indices into the sorted, deduplicated whitelist.
+    - dist_total, dist_hamming, dist_indel: int
+        Maximum edit distance, Hamming distance, and number of indels. See
+        string_distances.generate_variant_map().
+    - path_prefix: str. default=None
+        Files are written to f'{path_prefix}.keys.npy', f'{path_prefix}.ids.npy', and
+        f'{path_prefix}.json' (whitelist and parameters). If None, use the hash of the inputs in the
+        current directory.
+    - ambiguous: str. default='drop'
+        'drop': omit variants shared by 2 or more whitelist barcodes, so they are not corrected.
+        'raise': raise a ValueError if any variant is shared.
+
+    Returns: str
+        path_prefix
+    '''
+    whitelist = sorted(set(whitelist))
+    assert all(0 < len(seq) <= MAX_KEY_LENGTH - dist_total for seq in whitelist), \
+        f'Whitelist barcodes must be 1-{MAX_KEY_LENGTH - dist_total} bases long.'
+    assert len(whitelist) < 2**32 - 1, 'Whitelist is too large for uint32 IDs.'
+    if path_prefix is None:
+        path_prefix = table_hash(whitelist, dist_total, dist_hamming, dist_indel, ambiguous)
+    keys = []
+    ids = []
+    for i, seq in enumerate(whitelist):
+        variants = list(string_distances.generate_levenshtein_strings(
+            seq, dist_total, n_indel=dist_indel, n_subs=dist_hamming))
+        keys.append(encode_keys(variants))
+        ids.append(np.full(len(variants), i, dtype=np.uint32))
+    keys = np.concatenate(keys) if keys else np.zeros(0, dtype=np.uint64)
+    ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.uint32)
+    order = np.argsort(keys, kind='stable')
+    keys, ids = keys[order], ids[order]
+    shared = np.zeros(len(keys), dtype=bool)
+    shared[1:] = keys[1:] == keys[:-1]
+    shared[:-1] |= shared[1:]
+    n_ambiguous = len(np.unique(keys[shared]))
+    if n_ambiguous > 0:
+        if ambiguous == 'raise':
+            raise ValueError(f'{n_ambiguous} variants are shared by 2 or more whitelist barcodes.')
+        keys, ids = keys[~shared], ids[~shared]
+    _save_atomic(f'{path_prefix}.keys.npy', keys)
+    _save_atomic(f'{path_prefix}.ids.npy', ids)
+    metadata = dict(
+        version=FORMAT_VERSION,
+        whitelist=whitelist,
+        dist_total=dist_total,
+        dist_hamming=dist_hamming,
+        dist_indel=dist_indel,
+        ambiguous=ambiguous,
+        n_variants=len(keys),
+        n_ambiguous=n_ambiguous
+    )
+    # written last: its presence marks a complete table
+    write_atomic(f'{path_prefix}.json', json.dumps(metadata).encode())
+    return path_prefix
+
+
+def _save_atomic(path, array):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp_', suffix='.npy')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class CorrectionTable:
+    '''
+    Read-only, memory-mapped barcode correction table created by build_correction_table().
+
+    Pickling a CorrectionTable (e.g., to pass it to multiprocessing workers) pickles only its path; each
+    process memory-maps the same files.
+    '''
+
+    def __init__(self, path_prefix):
+        self.path_prefix = path_prefix
+        with open(f'{path_prefix}.json') as f:
+            self.metadata = json.load(f)
+        assert self.metadata['version'] == FORMAT_VERSION, \
+            f'Correction table {path_prefix} has an unsupported format version.'
+        self.whitelist = self.metadata['whitelist']
+        self.keys = np.load(f'{path_prefix}.keys.npy', mmap_mode='r')
+        self.ids = np.load(f'{path_prefix}.ids.npy', mmap_mode='r')
+
+    def __reduce__(self):
+        return (CorrectionTable, (self.path_prefix,))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup_keys(self, keys):
+        '''
+        Args
+        - keys: np.ndarray (uint64)
+            Keys as returned by sequence_encoding.encode_keys()
+
+        Returns: np.ndarray (int64)
+            Whitelist ID of each key, or -1 if the key is not within the table's distance of exactly
+            one whitelist barcode.
+        '''
+        keys = np.asarray(keys, dtype=np.uint64)
+        if len(self.keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        idx = np.searchsorted(self.keys, keys)
+        idx_clipped = np.minimum(idx, len(self.keys) - 1)
+        found = self.keys[idx_clipped] == keys
+        return np.where(found, self.ids[idx_clipped].astype(np.int64), -1)
+
+    def lookup(self, seqs):
+        '''
+        Args
+        - seqs: sequence of str
+            Observed barcodes
+
+        Returns: np.ndarray (int64)
+            Whitelist ID (index into self.whitelist) of each barcode, or -1 if uncorrectable.
+        '''
+        return self.lookup_keys(encode_keys(seqs))
+
+    def correct(self, seqs):
+        '''
+        Returns: list of (str or None)
+            Corrected whitelist barcode of each observed barcode, or None if uncorrectable.
+        '''
+        whitelist = self.whitelist
+        return [whitelist[i] if i >= 0 else None for i in self.lookup(seqs).tolist()]
+
+
+def correction_table(
+    whitelist,
+    dist_total,
+    dist_hamming=None,
+    dist_indel=None,
+    cache_dir='.',
+    ambiguous='drop'
+):
+    '''
+    Load the correction table for a whitelist and distance parameters from cache_dir, building it first
+    if it does not exist.
+
+    Args: see build_correction_table()
+    - cache_dir: str. default='.'
+        Directory of cached tables, named by table_hash().
+
+    Returns: CorrectionTable
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    path_prefix = os.path.join(cache_dir, table_hash(whitelist, dist_total, dist_hamming, dist_indel, ambiguous))
+    if not os.path.exists(f'{path_prefix}.json'):
+        build_correction_table(
+            whitelist, dist_total, dist_hamming=dist_hamming, dist_indel=dist_indel,
+            path_prefix=path_prefix, ambiguous=ambiguous
+        )
+    return CorrectionTable(path_prefix)
@@ -1,8 +1,13 @@
-import sys
-sys.path.append('../')
-import Bio
+import argparse
+import itertools
+import os
 import re
+import sys
+import Bio.Align
+import numpy as np
 import string_distances
+from checkpoint import Checkpoint, OutputFile, open_input
+from helpers import fastq_parse
 
 regex_Ns = re.compile('N+', flags=re.IGNORECASE)
 
@@ -33,15 +38,116 @@ def index_alignments(adapters, aligner=None, regex_index=None):
     return index_alignments
 
 
+def index_intervals(index_alignments):
+    '''
+    Coordinates of the index in each adapter, for projecting indices through adapter alignments without
+    Alignment.map(); see project_index_seqs().
+
+    Args
+    - index_alignments: dict(str -> Bio.Align.Alignment)
+        As returned by index_alignments()
+
+    Returns: dict(str -> (int, int))
+      Map from adapter name to start (inclusive) and end (exclusive) of the index in the adapter
+    '''
+    intervals = {}
+    for name, alignment in index_alignments.items():
+        target, query = alignment.coordinates
+        aligned = np.flatnonzero((np.diff(target) > 0) & (np.diff(query) > 0))
+        assert len(aligned) == 1, f'The index of adapter {name} is not aligned without gaps.'
+        intervals[name] = (int(target[aligned[0]]), int(target[aligned[0] + 1]))
+    return intervals
+
+
+def project_index_seqs(adapter_alignments, intervals):
+    '''
+    Index sequences of adapter alignments, projected through the alignments' coordinates in a batch.
+
+    Equivalent to alignment.map(index_alignments[name])[0] for each alignment: the read sequence from the
+    first to the last read base aligned to an index base, including read insertions between them and with
+    '-' for index bases deleted in the read between them. Alignments that do not cover any index base give
+    an empty sequence (for which Alignment.map() returns an empty alignment).
+
+    Args
+    - adapter_alignments: sequence((adapter name, Bio.Align.Alignment))
+        Alignments of adapters (query) to reads (target), e.g., from find_adapters() for any number of reads
+    - intervals: dict(str -> (int, int))
+        As returned by index_intervals()
+
+    Returns: list(str)
+    '''
+    if len(adapter_alignments) == 0:
+        return []
+    coordinates = [alignment.coordinates for _, alignment in adapter_alignments]
+    n_points = np.fromiter(map(len, (c[0] for c in coordinates)), dtype=np.int64, count=len(coordinates))
+    points = np.concatenate(coordinates, axis=1)
+    # segments between consecutive points of the same alignment
+    last = np.cumsum(n_points) - 1
+    is_segment = np.ones(points.shape[1], dtype=bool)
+    is_segment[last] = False
+    segments = np.flatnonzero(is_segment)
+    hit = np.repeat(np.arange(len(coordinates)), n_points)[segments]
+    r0, q0 = points[:, segments]
+    r1, q1 = points[:, segments + 1]
+    index_start, index_end = np.array([intervals[name] for name, _ in adapter_alignments], dtype=np.int64).T
+    index_start, index_end = index_start[hit], index_end[hit]
+
+    # aligned segments clipped to the index: project adapter coordinates onto the read by their offset
+    lo = np.maximum(q0, index_start)
+    hi = np.minimum(q1, index_end)
+    aligned = (r1 > r0) & (q1 > q0) & (lo < hi)
+    n = len(coordinates)
+    read_start = np.full(n, np.iinfo(np.int64).max)
+    read_end = np.full(n, -1)
+    adapter_start = np.full(n, np.iinfo(np.int64).max)
+    adapter_end = np.full(n, -1)
+    np.minimum.at(read_start, hit[aligned], (r0 + lo - q0)[aligned])
+    np.maximum.at(read_end, hit[aligned], (r0 + hi - q0)[aligned])
+    np.minimum.at(adapter_start, hit[aligned], lo[aligned])
+    np.maximum.at(adapter_end, hit[aligned], hi[aligned])
+
+    # adapter bases deleted in the read between the first and last aligned index base
+    deleted = (r1 == r0) & (q1 > q0)
+    deleted &= (q0 < adapter_end[hit]) & (q1 > adapter_start[hit])
+    deletions = {}
+    for i, r, length in zip(
+            hit[deleted].tolist(),
+            r0[deleted].tolist(),
+            (np.minimum(q1, adapter_end[hit]) - np.maximum(q0, adapter_start[hit]))[deleted].tolist()):
+        deletions.setdefault(i, []).append((r, length))
+
+    index_seqs = []
+    for i, ((_, alignment), start, end) in enumerate(zip(adapter_alignments, read_start.tolist(), read_end.tolist())):
+        if end < 0:
+            index_seqs.append('')
+            continue
+        read = alignment.target
+        if i not in deletions:
+            index_seqs.append(str(read[start:end]))
+            continue
+        pieces = []
+        for r, length in deletions[i]:
+            pieces.append(str(read[start:r]))
+            pieces.append('-' * length)
+            start = r
+        pieces.append(str(read[start:end]))
+        index_seqs.append(''.join(pieces))
+    return index_seqs
+
+
 def extract_index(adapter_alignments, index_alignments, indices_hash=None, sort=True):
     '''
     Args
     - adapter_alignments: sequence((adapter name, Bio.Align.Alignment))
         Sequence of tuples of adapter name and adapter alignment (e.g., to a read)
-    - index_alignments: dict(str -> Bio.Align.Alignment)
+    - index_alignments: dict(str -> Bio.Align.Alignment) or dict(str -> (int, int))
         Map from adapter name to alignment of index pattern (query) to adapter (target).
-    - indices_hash: dict(str -> str). default=None
+        If a map to index coordinates in the adapter (see index_intervals()), index sequences of all
+        alignments are projected together with project_index_seqs() instead of Alignment.map().
+    - indices_hash: dict(str -> str) or correction_table.CorrectionTable. default=None
         Map from index sequence to assigned index name.
+        If a CorrectionTable, the index sequences of all alignments are looked up together as 2-bit packed
+        integers, and the index name is the corrected whitelist sequence (None if uncorrectable).
         If not provided, the index sequence is used as the index name.
     - sort: bool. default=True
         Sort returned alignments by target coordinate.
@@ -55,12 +161,17 @@ def extract_index(adapter_alignments, index_alignments, indices_hash=None, sort=
       - index sequence
     '''
     results = []
-    for name, alignment in adapter_alignments:
-        index_seq = alignment.map(index_alignments[name])[0]
-        if indices_hash is not None:
-            index_label = indices_hash[index_seq]
-        else:
-            index_label = index_seq
+    if all(isinstance(value, tuple) for value in index_alignments.values()):
+        index_seqs = project_index_seqs(adapter_alignments, index_alignments)
+    else:
+        index_seqs = [alignment.map(index_alignments[name])[0] for name, alignment in adapter_alignments]
+    if indices_hash is None:
+        index_labels = index_seqs
+    elif hasattr(indices_hash, 'correct'):
+        index_labels = indices_hash.correct(index_seqs)
+    else:
+        index_labels = [indices_hash[index_seq] for index_seq in index_seqs]
+    for (name, alignment), index_label, index_seq in zip(adapter_alignments, index_labels, index_seqs):
         results.append((alignment.coordinates[0, 0], alignment.coordinates[0, -1], name, index_label, index_seq))
     if sort:
         results.sort()
@@ -144,3 +255,234 @@ def demultiplex(record, mod_names=False, loc_names=False, file=True, mapping=Non
             filename += f'({adapter_name}-{index_label})'
         with open(filename, 'a') as f:
             f.write()
+
+
+class _IndexLabels(dict):
+    # index sequences not in the map are labeled '-' (without adding them to the map)
+    def __missing__(self, key):
+        return '-'
+
+
+def read_adapters(path):
+    '''
+    Read a tab-delimited file of adapter names and sequences (Ns mark the index).
+
+    Returns: dict(str -> str)
+        Map from adapter name to adapter sequence
+    '''
+    adapters = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip() == '' or line.startswith('#'):
+                continue
+            name, seq = line.strip().split('\t')[:2]
+            assert name not in adapters, f"The adapter '{name}' is repeated in {path}."
+            assert regex_Ns.search(seq), f"The sequence of adapter '{name}' has no index (Ns)."
+            adapters[name] = seq.upper()
+    return adapters
+
+
+def demultiplex_file(
+    path,
+    path_out=None,
+    adapters=None,
+    indices_hash=None,
+    min_score=0.8,
+    max_reads=None,
+    chunksize=10_000,
+    checkpoint_interval=300,
+    resume=False
+):
+    '''
+    Find adapters in the reads of a FASTQ file and write their indices to a table with one row per adapter
+    match; columns = read, start, end, adapter, index, index_seq.
+
+    Unless the input is standard in or the output is standard out, progress is checkpointed to
+    f'{path_out}.checkpoint' (see checkpoint.py), so that an interrupted run can be resumed with resume=True.
+
+    Args
+    - path: str
+        Path to FASTQ file (plain, gzip, or BGZF). '-' reads from standard in.
+    - path_out: str. default=None
+        Path to output table, gzip-compressed if it ends with '.gz'. If None, write to standard out.
+    - adapters: dict(str -> str)
+        Map from adapter name to adapter sequence, with a string of Ns denoting the index
+    - indices_hash: dict(str -> str). default=None
+        Map from index sequence to index label. See extract_index().
+    - min_score: float. default=0.8
+        Minimum alignment score of an adapter match, as a fraction of the adapter length excluding the index
+        (Ns), which scores 0 against any base.
+    - max_reads: int. default=None
+        Only process the first max_reads reads.
+    - chunksize: int. default=10_000
+        Number of reads per chunk. Checkpoints are saved between chunks.
+    - checkpoint_interval: float. default=300
+        Minimum number of seconds between checkpoints. If 0, do not checkpoint.
+    - resume: bool. default=False
+        Resume from the checkpoint of a previous run with the same arguments, if there is one.
+
+    Returns: (int, int)
+    - Number of reads processed
+    - Number of reads with at least one adapter match
+    '''
+    # the index Ns are wildcards that score 0, so only the non-N bases can contribute to the score
+    thresholds = {name: min_score * len(regex_Ns.sub('', seq)) for name, seq in adapters.items()}
+    index_alns = index_intervals(index_alignments(adapters))
+    # local alignment: start and end are the coordinates of the matched adapter within the read
+    aligner = Bio.Align.PairwiseAligner(mode='local', mismatch_score=-1, gap_score=-1, wildcard='N')
+    checkpoint = None
+    state = None
+    if checkpoint_interval > 0 and path != '-' and path_out is not None:
+        params = dict(
+            input=os.path.abspath(path),
+            input_size=os.path.getsize(path),
+            adapters=adapters,
+            indices=sorted(indices_hash.items()) if indices_hash is not None else None,
+            min_score=min_score,
+            thresholds=thresholds,
+            max_reads=max_reads
+        )
+        checkpoint = Checkpoint(f'{path_out}.checkpoint', params=params, interval=checkpoint_interval)
+        if resume:
+            state = checkpoint.load()
+        else:
+            checkpoint.remove()
+    else:
+        assert not resume, 'Resuming requires an input file and an output file.'
+    if state is not None:
+        print(f"Resuming from {checkpoint.path} after {state['state']['n_reads']:,} reads.", file=sys.stderr)
+        f_in = open_input(path, offset=state['input_offset'])
+        n_reads = state['state']['n_reads']
+        n_found = state['state']['n_found']
+    else:
+        f_in = sys.stdin.buffer if path == '-' else open_input(path)
+        n_reads = n_found = 0
+    f_out = None
+    if path_out is not None:
+        f_out = OutputFile(path_out, size=state['output_sizes'][0] if state is not None else None)
+    write = f_out.write if f_out is not None else sys.stdout.write
+    if state is None:
+        write('read\tstart\tend\tadapter\tindex\tindex_seq\n')
+    records = fastq_parse(f_in)
+    with f_in:
+        while True:
+            n = chunksize if max_reads is None else min(chunksize, max_reads - n_reads)
+            chunk = list(itertools.islice(records, n))
+            if len(chunk) == 0:
+                break
+            names = []
+            n_hits = []
+            chunk_alignments = []
+            for name, seq, _, _ in chunk:
+                adapter_alignments = find_adapters(seq, list(adapters.items()), thresholds, aligner=aligner)
+                if len(adapter_alignments) == 0:
+                    continue
+                names.append(name[1:].split(maxsplit=1)[0])
+                n_hits.append(len(adapter_alignments))
+                chunk_alignments.extend(adapter_alignments)
+            n_found += len(names)
+            # project and label the indices of all adapter matches in the chunk together
+            results = extract_index(chunk_alignments, index_alns, indices_hash=indices_hash, sort=False)
+            lines = []
+            offset = 0
+            for name, n in zip(names, n_hits):
+                # equally scoring alignments can share coordinates and index
+                for start, end, adapter, label, index_seq in dict.fromkeys(sorted(results[offset:offset + n])):
+                    lines.append(f'{name}\t{start}\t{end}\t{adapter}\t{label}\t{index_seq}\n')
+                offset += n
+            n_reads += len(chunk)
+            write(''.join(lines))
+            if checkpoint is not None and checkpoint.due():
+                checkpoint.save(f_in.tell(), [f_out], dict(n_reads=n_reads, n_found=n_found))
+    if f_out is not None:
+        f_out.close()
+    if checkpoint is not None:
+        checkpoint.remove()
+    return n_reads, n_found
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    adapters = read_adapters(args.adapters)
+    indices_hash = None
+    if args.indices is not None:
+        indices_hash = _IndexLabels()
+        with open(args.indices) as f:
+            for line in f:
+                if line.strip() != '':
+                    seq, label = line.strip().split('\t')[:2]
+                    indices_hash[seq.upper()] = label
+    n_reads, n_found = demultiplex_file(
+        args.input,
+        args.output,
+        adapters,
+        indices_hash=indices_hash,
+        min_score=args.min_score,
+        max_reads=args.max_reads,
+        checkpoint_interval=args.checkpoint_interval,
+        resume=args.resume
+    )
+    print(f'Found adapters in {n_found:,} of {n_reads:,} reads.', file=sys.stderr)
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description=("Find adapters in reads and extract their indices. Output is a tab-delimited table with one "
+                     "row per adapter match; columns = read, start, end, adapter, index, index_seq.")
+    )
+    parser.add_argument(
+        "input",
+        metavar="reads.fastq[.gz]|-",
+        help="FASTQ file of reads. Use '-' for standard in."
+    )
+    parser.add_argument(
+        "-a", "--adapters",
+        required=True,
+        metavar="adapters.tsv",
+        help=("Tab-delimited file of adapter names and sequences, with a run of Ns marking the index, "
+              "e.g., '2Puni<TAB>AATGATACGGCGACCACCGAGATCTACACNNNNNNNNACACTC...'.")
+    )
+    parser.add_argument(
+        "-i", "--indices",
+        metavar="indices.tsv",
+        help=("Tab-delimited file of index sequences and labels. Index sequences not in the file are labeled "
+              "'-'. If not provided, the index sequence is used as the label.")
+    )
+    parser.add_argument(
+        "-o", "--output",
+        metavar="indices.tsv",
+        help="Output table. Default: standard out."
+    )
+    parser.add_argument(
+        "--min-score",
+        type=float,
+        default=0.8,
+        metavar="FRAC",
+        help=("Minimum alignment score of an adapter match, as a fraction of the adapter length excluding the "
+              "index (Ns). Default: 0.8.")
+    )
+    parser.add_argument(
+        "-n", "--max-reads",
+        type=int,
+        metavar="N",
+        help="Only process the first N reads."
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        type=float,
+        default=300,
+        metavar="SECONDS",
+        help=("Save progress to OUTPUT.checkpoint at this interval, so that an interrupted run can be resumed "
+              "with --resume. Use 0 to disable. Requires an input file and -o/--output. Default: 300.")
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help=("Resume from the checkpoint of a previous run with the same arguments, if there is one. "
+              "The output is truncated to its size at the checkpoint, so no read is written twice.")
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main()
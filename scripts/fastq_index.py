@@ -0,0 +1,280 @@
+import hashlib
+import os
+import struct
+import zlib
+import numpy as np
+from Bio import bgzf
+
+INDEX_DTYPE = np.dtype([("hash", "<u8"), ("offset", "<u8")])
+
+
+def hash_name(name):
+    """
+    Args
+    - name: bytes
+        Read name, without the leading '@' and without any comment (text after the first whitespace).
+
+    Returns: int
+        64-bit hash of the read name
+    """
+    return int.from_bytes(hashlib.blake2b(name, digest_size=8).digest(), "little")
+
+
+def read_key(name_line):
+    """
+    Args
+    - name_line: bytes or str
+        FASTQ read name line, e.g., b'@readname LX:Z:tag_A:0,3-6'
+
+    Returns: bytes
+        Read name without the leading '@' and without any comment, e.g., b'readname'
+    """
+    if isinstance(name_line, str):
+        name_line = name_line.encode()
+    return name_line.lstrip(b"@").split(maxsplit=1)[0]
+
+
+def is_bgzf(path):
+    """
+    Check whether a file is BGZF-compressed (e.g., by bgzip), as opposed to plain or regular gzip.
+    """
+    with open(path, "rb") as f:
+        header = f.read(16)
+    return (
+        len(header) == 16
+        and header[:4] == b"\x1f\x8b\x08\x04"  # gzip magic, deflate, FEXTRA flag
+        and header[12:14] == b"BC"
+    )
+
+
+def _iter_bgzf_blocks(f):
+    """
+    Iterate over the blocks of a BGZF file.
+
+    Returns: iterator of (int, bytes)
+        Compressed offset of the block and its uncompressed data
+    """
+    while True:
+        block_offset = f.tell()
+        header = f.read(12)
+        if len(header) == 0:
+            return
+        assert len(header) == 12 and header[:4] == b"\x1f\x8b\x08\x04", "ERROR: Invalid BGZF block."
+        extra = f.read(struct.unpack("<H", header[10:12])[0])
+        block_size = None
+        i = 0
+        while i < len(extra):
+            subfield_id = extra[i:i + 2]
+            subfield_len = struct.unpack("<H", extra[i + 2:i + 4])[0]
+            if subfield_id == b"BC":
+                block_size = struct.unpack("<H", extra[i + 4:i + 6])[0] + 1
+            i += 4 + subfield_len
+        assert block_size is not None, "ERROR: BGZF block is missing the BC subfield."
+        compressed = f.read(block_size - 12 - len(extra))
+        yield block_offset, zlib.decompress(compressed[:-8], wbits=-15)
+
+
+def _iter_blocks(path, block_size):
+    """
+    Returns: iterator of (int, int, bytes)
+        Compressed offset of the block (0 for uncompressed files), uncompressed offset of the block,
+        and the uncompressed data
+    """
+    with open(path, "rb") as f:
+        if is_bgzf(path):
+            blocks = _iter_bgzf_blocks(f)
+        else:
+            assert f.read(2) != b"\x1f\x8b", \
+                "ERROR: gzip-compressed FASTQ files must be compressed with bgzip to be indexed."
+            f.seek(0)
+            blocks = ((0, data) for data in iter(lambda: f.read(block_size), b""))
+        uncompressed_offset = 0
+        for block_offset, data in blocks:
+            yield block_offset, uncompressed_offset, data
+            uncompressed_offset += len(data)
+
+
+def build_index(path, index_path=None, block_size=2**24):
+    """
+    Index the byte offset of each read in a FASTQ file.
+
+    Args
+    - path: str
+        Path to FASTQ file, either uncompressed or compressed with bgzip. (Files compressed with regular
+        gzip do not support random access.)
+    - index_path: str. default=None
+        Path to save index. If None, uses f'{path}.fqi.npy'.
+    - block_size: int. default=2**24
+        Number of bytes to read at a time from uncompressed files.
+
+    Returns: str
+        Path to index. The index is a NumPy structured array of (hash of read name, offset) sorted by
+        hash, where offsets are BGZF virtual offsets for bgzip-compressed files and byte offsets
+        otherwise.
+    """
+    if index_path is None:
+        index_path = f"{path}.fqi.npy"
+    bgzf_compressed = is_bgzf(path)
+    hashes = []
+    offsets = []
+    block_starts = []  # (compressed offset, uncompressed offset) of each BGZF block
+    carry = b""
+    carry_offset = 0
+    phase = 0  # index of the next name line among the lines of the next block
+    for block_offset, uncompressed_offset, data in _iter_blocks(path, block_size):
+        if bgzf_compressed:
+            block_starts.append((block_offset, uncompressed_offset))
+        lines = (carry + data).split(b"\n")
+        carry = lines.pop()
+        line_lengths = np.fromiter(map(len, lines), dtype=np.int64, count=len(lines)) + 1
+        line_starts = carry_offset + np.cumsum(line_lengths) - line_lengths
+        names = lines[phase::4]
+        assert len(names) == 0 or names[0].startswith(b"@"), "ERROR: Read name does not start with '@'."
+        offsets.append(line_starts[phase::4])
+        hashes.append(np.fromiter((hash_name(read_key(name)) for name in names), dtype=np.uint64, count=len(names)))
+        carry_offset += line_lengths.sum()
+        phase = (phase - len(lines)) % 4
+    assert carry == b"" or phase != 0, "ERROR: FASTQ file is truncated."
+    index = np.empty(sum(len(h) for h in hashes), dtype=INDEX_DTYPE)
+    index["hash"] = np.concatenate(hashes) if hashes else []
+    offsets = np.concatenate(offsets) if offsets else np.zeros(0, dtype=np.int64)
+    if bgzf_compressed:
+        block_starts = np.array(block_starts, dtype=np.int64).reshape(-1, 2)
+        i_block = np.searchsorted(block_starts[:, 1], offsets, side="right") - 1
+        offsets = (block_starts[i_block, 0] << 16) | (offsets - block_starts[i_block, 1])
+    index["offset"] = offsets
+    index.sort(order=["hash", "offset"], kind="stable")
+    np.save(index_path, index)
+    return index_path
+
+
+class FastqIndex:
+    """
+    Random access to reads of a FASTQ file by read name.
+
+    Example
+        with FastqIndex('reads.fastq.gz') as index:
+            for name, seq, thrd, qual in index.fetch(['read1', 'read2']):
+                ...
+    """
+
+    def __init__(self, path, index_path=None, build=True):
+        """
+        Args
+        - path: str
+            Path to FASTQ file, either uncompressed or compressed with bgzip.
+        - index_path: str. default=None
+            Path to index created by build_index(). If None, uses f'{path}.fqi.npy'.
+        - build: bool. default=True
+            Build the index if it does not exist or is older than the FASTQ file.
+        """
+        if index_path is None:
+            index_path = f"{path}.fqi.npy"
+        if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(path):
+            assert build, f"ERROR: Index {index_path} does not exist or is out of date."
+            build_index(path, index_path)
+        self.path = path
+        self.index = np.load(index_path, mmap_mode="r")
+        if is_bgzf(path):
+            self.f = bgzf.BgzfReader(path, "rb")
+        else:
+            self.f = open(path, "rb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.f.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return len(self._find(read_key(name))) > 0
+
+    def read_at(self, offset):
+        """
+        Args
+        - offset: int
+            Byte offset (uncompressed files) or BGZF virtual offset (bgzip-compressed files) of a read.
+
+        Returns: tuple of str (name, seq, thrd, qual)
+            As returned by fastq_parse()
+        """
+        self.f.seek(int(offset))
+        record = tuple(self.f.readline().decode().rstrip() for _ in range(4))
+        assert record[0].startswith("@") and record[2].startswith("+"), \
+            f"ERROR: No FASTQ record at offset {offset}."
+        return record
+
+    def _candidates(self, keys):
+        hashes = np.fromiter((hash_name(key) for key in keys), dtype=np.uint64, count=len(keys))
+        left = np.searchsorted(self.index["hash"], hashes, side="left")
+        right = np.searchsorted(self.index["hash"], hashes, side="right")
+        return left, right
+
+    def _find(self, key):
+        """
+        Returns: list of tuple
+            Records with read name key (normally exactly 1, or 0 if not present)
+        """
+        left, right = self._candidates([key])
+        records = [self.read_at(offset) for offset in self.index["offset"][left[0]:right[0]]]
+        return [record for record in records if read_key(record[0]) == key]
+
+    def fetch(self, names, missing="raise"):
+        """
+        Fetch reads by name.
+
+        Args
+        - names: iterable of str
+            Read names. Leading '@' and comments (text after the first whitespace) are ignored.
+        - missing: str. default='raise'
+            'raise': raise a KeyError if a read is not found. 'skip': omit reads that are not found.
+
+        Returns: list of tuple of str (name, seq, thrd, qual)
+            Records in the order of names. Reads are read from the file in order of offset.
+        """
+        keys = [read_key(name) for name in names]
+        left, right = self._candidates(keys)
+        # read files sequentially: visit hash matches in order of offset
+        n_candidates = right - left
+        i_key = np.repeat(np.arange(len(keys)), n_candidates)
+        positions = np.repeat(left, n_candidates) + (
+            np.arange(n_candidates.sum()) - np.repeat(np.cumsum(n_candidates) - n_candidates, n_candidates)
+        )
+        offsets = self.index["offset"][positions]
+        found = dict()
+        for i in np.argsort(offsets, kind="stable"):
+            key = keys[i_key[i]]
+            if key in found:
+                continue
+            record = self.read_at(offsets[i])
+            if read_key(record[0]) == key:
+                found[key] = record
+        records = []
+        for key in keys:
+            if key in found:
+                records.append(found[key])
+            elif missing == "raise":
+                raise KeyError(key.decode())
+        return records
+
+    def sample(self, n, seed=None):
+        """
+        Randomly sample reads without replacement.
+
+        Args
+        - n: int
+            Number of reads to sample. If greater than the number of reads, return all reads.
+        - seed: int or np.random.Generator. default=None
+
+        Returns: list of tuple of str (name, seq, thrd, qual)
+            Records in file order.
+        """
+        rng = np.random.default_rng(seed)
+        positions = rng.choice(len(self.index), size=min(n, len(self.index)), replace=False)
+        return [self.read_at(offset) for offset in np.sort(self.index["offset"][positions])]
@@ -0,0 +1,253 @@
+import re
+import numpy as np
+import pandas as pd
+import matplotlib.colors
+import matplotlib.pyplot as plt
+from helpers import file_open
+
+# Matches each tag of a location tag, e.g., 'LX:Z:tag_A:0,3-6,tag_B:0,6-10' gives
+# (tag_A, 0, 3, 6) and (tag_B, 0, 6, 10). Tags after the first are recognized by the comma following
+# the end position of the previous tag.
+regex_tags_bulk = re.compile(rb"(?:LX:Z:|(?<=\d),)([^:\s,]+):(\d+),(\d+)-(\d+)")
+
+
+class FeatureLayout:
+    """
+    Histograms of the file number, start position, and end position of each feature (tag) across reads.
+
+    Attributes
+    - counts: dict (str -> np.ndarray of shape (n_files, n_positions, n_positions))
+        Map from feature name to counts indexed by [file number, start position, end position].
+    - n_reads: int
+        Number of reads added
+    - n_tagged: int
+        Number of reads with a location tag
+    """
+
+    def __init__(self):
+        self.counts = dict()
+        self.n_reads = 0
+        self.n_tagged = 0
+
+    def add(self, names):
+        """
+        Add read names.
+
+        Args
+        - names: bytes
+            Newline-separated read names, including location tags.
+            Example: b'@read1 LX:Z:tag_A:0,3-6,tag_B:0,6-10\\n@read2 LX:Z:tag_A:0,4-7'
+
+        Returns: None
+        """
+        if len(names) == 0:
+            return
+        self.n_reads += names.count(b"\n") + (not names.endswith(b"\n"))
+        self.n_tagged += names.count(b"LX:Z:")
+        matches = regex_tags_bulk.findall(names)
+        if len(matches) == 0:
+            return
+        matches = np.array(matches)
+        feature_names, inverse = np.unique(matches[:, 0], return_inverse=True)
+        inverse = inverse.ravel()
+        coords = matches[:, 1:].astype(np.int64)
+        for i, feature in enumerate(feature_names):
+            self._add_coords(feature.decode(), coords[inverse == i])
+
+    def _add_coords(self, feature, coords):
+        file_n, start, end = coords.T
+        shape = (file_n.max() + 1, max(start.max(), end.max()) + 1)
+        counts = self._grow(feature, shape)
+        n_files, n_positions = counts.shape[:2]
+        index = (file_n * n_positions + start) * n_positions + end
+        counts += np.bincount(index, minlength=counts.size).reshape(counts.shape)
+
+    def _grow(self, feature, shape):
+        """
+        Get the counts array of a feature, padding it to at least shape (n_files, n_positions) as needed.
+        """
+        counts = self.counts.get(feature, np.zeros((0, 0, 0), dtype=np.int64))
+        n_files = max(counts.shape[0], shape[0])
+        n_positions = max(counts.shape[1], shape[1])
+        if (n_files, n_positions) != counts.shape[:2]:
+            counts = np.pad(
+                counts,
+                [(0, n_files - counts.shape[0])] + [(0, n_positions - counts.shape[1])] * 2
+            )
+            self.counts[feature] = counts
+        return counts
+
+    def merge(self, other):
+        """
+        Add the counts of another FeatureLayout.
+
+        Returns: self
+        """
+        self.n_reads += other.n_reads
+        self.n_tagged += other.n_tagged
+        for feature, other_counts in other.counts.items():
+            counts = self._grow(feature, other_counts.shape[:2])
+            counts[tuple(slice(0, n) for n in other_counts.shape)] += other_counts
+        return self
+
+    def features(self):
+        """
+        Returns: list of str
+            Feature names, in order of decreasing number of reads.
+        """
+        return sorted(self.counts, key=lambda feature: -self.counts[feature].sum())
+
+    def position_histogram(self, feature, file_n=None):
+        """
+        Args
+        - feature: str
+        - file_n: int. default=None
+            File number. If None, sum over all files.
+
+        Returns: np.ndarray of shape (n_positions, n_positions)
+            Counts indexed by [start position, end position]
+        """
+        counts = self.counts[feature]
+        if file_n is None:
+            return counts.sum(axis=0)
+        if file_n >= counts.shape[0]:
+            return np.zeros(counts.shape[1:], dtype=counts.dtype)
+        return counts[file_n]
+
+    def summary(self):
+        """
+        Returns: pd.DataFrame
+            One row per (feature, file number) observed. Columns: feature, file, count, fraction
+            (of tagged reads), and the mode and mean start position, end position, and length.
+        """
+        rows = []
+        for feature in self.features():
+            counts = self.counts[feature]
+            n_positions = counts.shape[1]
+            start, end = np.meshgrid(np.arange(n_positions), np.arange(n_positions), indexing="ij")
+            for file_n in np.flatnonzero(counts.sum(axis=(1, 2))):
+                hist = counts[file_n]
+                total = hist.sum()
+                start_mode, end_mode = np.unravel_index(np.argmax(hist), hist.shape)
+                length_counts = np.bincount((end - start).ravel() + n_positions, weights=hist.ravel())
+                rows.append(dict(
+                    feature=feature,
+                    file=file_n,
+                    count=total,
+                    fraction=total / self.n_tagged if self.n_tagged > 0 else np.nan,
+                    start_mode=start_mode,
+                    end_mode=end_mode,
+                    length_mode=np.argmax(length_counts) - n_positions,
+                    start_mean=(hist * start).sum() / total,
+                    end_mean=(hist * end).sum() / total,
+                    length_mean=(hist * (end - start)).sum() / total,
+                ))
+        return pd.DataFrame(rows)
+
+
+def iter_fastq_names(fp, block_size=2**24, max_reads=None):
+    """
+    Read names from a FASTQ file in large blocks.
+
+    Args
+    - fp: binary file object
+        FASTQ file, e.g., as the output of file_open().
+    - block_size: int. default=2**24
+        Number of bytes to read at a time.
+    - max_reads: int. default=None
+        Maximum number of reads to return names for.
+
+    Returns: iterator of bytes
+        Newline-separated read names of the reads fully contained in each block.
+    """
+    carry = b""
+    phase = 0  # index of the next name line among the lines of the next block
+    n_reads = 0
+    while True:
+        block = fp.read(block_size)
+        if not block:
+            break
+        lines = (carry + block).split(b"\n")
+        carry = lines.pop()
+        names = lines[phase::4]
+        phase = (phase - len(lines)) % 4
+        if len(names) == 0:
+            continue
+        assert names[0].startswith(b"@"), "ERROR: Read name does not start with '@'."
+        if max_reads is not None:
+            names = names[:max_reads - n_reads]
+        n_reads += len(names)
+        yield b"\n".join(names)
+        if max_reads is not None and n_reads >= max_reads:
+            return
+    if carry and phase == 0:
+        yield carry
+
+
+def feature_layout(path, block_size=2**24, max_reads=None):
+    """
+    Aggregate feature positions across all reads in a FASTQ file with location tags in read names,
+    such as the output of splitcode.
+
+    Args
+    - path: str
+        Path to FASTQ file, optionally gzip-compressed
+    - block_size, max_reads: see iter_fastq_names()
+
+    Returns: FeatureLayout
+    """
+    layout = FeatureLayout()
+    with file_open(path) as fp:
+        for names in iter_fastq_names(fp, block_size=block_size, max_reads=max_reads):
+            layout.add(names)
+    return layout
+
+
+def plot_feature_layout(layout, features=None, log=True, figsize_per_ax=(3, 3)):
+    """
+    Plot heatmaps of feature start and end positions.
+
+    Args
+    - layout: FeatureLayout
+    - features: list of str. default=None
+        Features to plot. If None, plot all features in layout.features() order.
+    - log: bool. default=True
+        Use a logarithmic color scale.
+    - figsize_per_ax: tuple of (float, float). default=(3, 3)
+
+    Returns: matplotlib.figure.Figure
+        One row per feature and one column per file number. Each heatmap shows counts of reads by
+        feature start position (x-axis) and end position (y-axis).
+    """
+    if features is None:
+        features = layout.features()
+    n_files = max(layout.counts[feature].shape[0] for feature in features)
+    fig, axs = plt.subplots(
+        nrows=len(features),
+        ncols=n_files,
+        squeeze=False,
+        figsize=(figsize_per_ax[0] * n_files, figsize_per_ax[1] * len(features)),
+        constrained_layout=True,
+    )
+    for row, feature in enumerate(features):
+        for file_n in range(n_files):
+            ax = axs[row, file_n]
+            hist = layout.position_histogram(feature, file_n)
+            if hist.sum() == 0:
+                ax.set_axis_off()
+                continue
+            starts, ends = np.nonzero(hist)
+            hist = hist[starts.min():starts.max() + 1, ends.min():ends.max() + 1]
+            im = ax.imshow(
+                hist.T,
+                origin="lower",
+                aspect="auto",
+                interpolation="nearest",
+                extent=(starts.min() - 0.5, starts.max() + 0.5, ends.min() - 0.5, ends.max() + 0.5),
+                norm=matplotlib.colors.LogNorm() if log else None,
+            )
+            fig.colorbar(im, ax=ax)
+            ax.set_title(f"{feature} (file {file_n})")
+            ax.set_xlabel("start")
+            ax.set_ylabel("end")
+    return fig
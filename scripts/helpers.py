@@ -1,4 +1,6 @@
 import gzip
+import os
+import tempfile
 
 
 def file_open(filename):
@@ -14,6 +16,21 @@ def file_open(filename):
         return f
 
 
+def write_atomic(path, data):
+    """
+    Write bytes to a file atomically: readers see either the previous file or the complete new file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp_")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
 def fastq_parse(fp):
     """
     Parse FASTQ file.
@@ -0,0 +1,67 @@
+"""
+Merge barcode count tables (e.g., from `parse_barcodes.py --counts` run on each shard of a FASTQ file),
+summing the counts of identical barcodes.
+"""
+
+import argparse
+import collections
+import sys
+
+
+def merge_barcode_counts(paths, path_out=None):
+    """
+    Args
+    - paths: list of str
+        Tab-delimited count tables with the same header; the last column is the count, and the other
+        columns identify a barcode.
+    - path_out: str. default=None
+        Path to merged count table, sorted by decreasing count. If None, write to standard out.
+
+    Returns: int
+        Number of unique barcodes
+    """
+    header = None
+    counts = collections.Counter()
+    for path in paths:
+        with open(path) as f:
+            file_header = f.readline()
+            assert header is None or file_header == header, f"The header of {path} differs from that of {paths[0]}."
+            header = file_header
+            for line in f:
+                key, _, count = line.rstrip("\n").rpartition("\t")
+                counts[key] += int(count)
+    f = sys.stdout if path_out is None else open(path_out, "w")
+    f.write(header or "")
+    for key, count in counts.most_common():
+        f.write(f"{key}\t{count}\n")
+    if f is not sys.stdout:
+        f.close()
+    return len(counts)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    n = merge_barcode_counts(args.input, args.output)
+    print(f"Merged counts of {n:,} barcodes from {len(args.input)} tables.", file=sys.stderr)
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Merge barcode count tables (e.g., of each shard of a FASTQ file), summing counts of identical barcodes."
+    )
+    parser.add_argument(
+        "input",
+        nargs="+",
+        metavar="counts.tsv",
+        help="Tab-delimited count tables with the same header, e.g., from parse_barcodes.py --counts."
+    )
+    parser.add_argument(
+        "-o", "--output",
+        metavar="merged.tsv",
+        help="Output count table, sorted by decreasing count. Default: standard out."
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,15 @@
+import argparse
+import collections
+import itertools
+import os
+import re
+import sys
 import pandas as pd
+import sequence_encoding
+from checkpoint import Checkpoint, OutputFile, open_input
+from shard_fastq import iter_lines, read_shards
 
-def barcodes_to_df(f, regex, split='::', store_unmatched=100):
+def barcodes_to_df(f, regex, split='::', store_unmatched=100, pack=None):
     '''
     Args
     - f: file object
@@ -14,6 +23,10 @@ def barcodes_to_df(f, regex, split='::', store_unmatched=100):
         then the last split is used for regular expression searching.
     - store_unmatched: int. default=100
         The maximum number of unmatched lines to return. Useful for debugging.
+    - pack: list of str. default=None
+        Columns of DNA sequences (e.g., ['umi']) to store as 2-bit packed uint64 keys (see
+        sequence_encoding.encode_keys()) instead of strings, which reduces memory use and speeds up
+        grouping and deduplication. Sequences with N or longer than 31 bases are encoded as 0.
 
     Returns
     - df: pd.DataFrame
@@ -36,10 +49,277 @@ def barcodes_to_df(f, regex, split='::', store_unmatched=100):
                 store_unmatched -= 1
         else:
             barcodes.append(match.groupdict())
-    return pd.DataFrame(barcodes), n_unmatched, unmatched
+    df = pd.DataFrame(barcodes)
+    for col in pack or []:
+        if col in df.columns:
+            df[col] = sequence_encoding.encode_keys(df[col].fillna('N').tolist())
+    return df, n_unmatched, unmatched
 
 # def count_barcodes(df, rounds, col_umi='UMI'):
 #     if type(col_umi) is not list:
         
 #     col_umi = [col_umi] if type(col_umi) is not list else col_umi
-#     df.groupby(rounds + col_umi).count()
\ No newline at end of file
+#     df.groupby(rounds + col_umi).count()
+
+
+def parse_barcodes_file(
+    path,
+    path_out=None,
+    regex=None,
+    split='::',
+    pack=None,
+    path_counts=None,
+    path_unmatched=None,
+    max_unmatched=100,
+    fastq=False,
+    shard=None,
+    table=True,
+    chunksize=100_000,
+    checkpoint_interval=300,
+    resume=False
+):
+    '''
+    Stream a barcode file through barcodes_to_df() in chunks, writing a table with one row per matching line.
+
+    Unless the input is standard in or the output is standard out, progress is checkpointed to
+    f'{path_out}.checkpoint' (or f'{path_counts}.checkpoint' if table is False; see checkpoint.py), so that
+    an interrupted run can be resumed with resume=True. The checkpoint is removed when the run completes.
+
+    Args
+    - path: str
+        Path to barcode file (plain, gzip, or BGZF). '-' reads from standard in.
+    - path_out: str. default=None
+        Path to output tab-delimited table, gzip-compressed if it ends with '.gz'. If None, write to standard
+        out.
+    - regex, split, pack: see barcodes_to_df()
+    - path_counts: str. default=None
+        Path to output table of the number of lines of each unique combination of regex group values,
+        sorted by decreasing count.
+    - path_unmatched: str. default=None
+        Path to output up to max_unmatched lines that do not match regex.
+    - max_unmatched: int. default=100
+    - fastq: bool. default=False
+        The input is a FASTQ file with barcodes in read names (e.g., splitcode output); only name lines are
+        parsed.
+    - shard: (int, int). default=None
+        Only parse the lines between these start and end positions, e.g., a shard from
+        shard_fastq.shard_fastq().
+    - table: bool. default=True
+        Write the table of matching lines. If False, only write counts (path_counts must be given).
+    - chunksize: int. default=100_000
+        Number of lines (or FASTQ records) per chunk. Checkpoints are saved between chunks.
+    - checkpoint_interval: float. default=300
+        Minimum number of seconds between checkpoints. If 0, do not checkpoint.
+    - resume: bool. default=False
+        Resume from the checkpoint of a previous run with the same arguments, if there is one.
+
+    Returns: (int, int)
+    - Number of matching lines
+    - Number of unmatched lines
+    '''
+    columns = list(regex.groupindex)
+    assert table or path_counts is not None, 'Either write the table of matching lines or counts.'
+    assert shard is None or path != '-', 'Shards can only be read from an input file.'
+    if not table:
+        path_out = None
+    checkpoint = None
+    state = None
+    path_checkpoint = path_out if table else path_counts
+    if checkpoint_interval > 0 and path != '-' and path_checkpoint is not None:
+        params = dict(
+            input=os.path.abspath(path),
+            input_size=os.path.getsize(path),
+            regex=regex.pattern,
+            split=split,
+            pack=pack,
+            table=table,
+            counts=path_counts,
+            unmatched=path_unmatched,
+            max_unmatched=max_unmatched,
+            fastq=fastq,
+            shard=shard
+        )
+        checkpoint = Checkpoint(f'{path_checkpoint}.checkpoint', params=params, interval=checkpoint_interval)
+        if resume:
+            state = checkpoint.load()
+        else:
+            checkpoint.remove()
+    else:
+        assert not resume, 'Resuming requires an input file and an output file.'
+    if state is not None:
+        print(f"Resuming from {checkpoint.path} after {state['state']['n_matched'] + state['state']['n_unmatched']:,} "
+              "lines.", file=sys.stderr)
+        f_in = open_input(path, offset=state['input_offset'])
+        output_sizes = iter(state['output_sizes'])
+        n_matched = state['state']['n_matched']
+        n_unmatched = state['state']['n_unmatched']
+        n_stored = state['state']['n_stored']
+        counts = collections.Counter({tuple(row[:-1]): row[-1] for row in state['state']['counts']})
+    else:
+        f_in = sys.stdin.buffer if path == '-' else open_input(path, offset=shard[0] if shard else 0)
+        output_sizes = None
+        n_matched = n_unmatched = n_stored = 0
+        counts = collections.Counter()
+    outputs = []
+    f_out = None
+    if path_out is not None:
+        f_out = OutputFile(path_out, size=next(output_sizes) if output_sizes else None)
+        outputs.append(f_out)
+    f_unmatched = None
+    if path_unmatched is not None:
+        f_unmatched = OutputFile(path_unmatched, size=next(output_sizes) if output_sizes else None)
+        outputs.append(f_unmatched)
+    if f_out is not None:
+        write = f_out.write
+    elif table:
+        write = sys.stdout.write
+    else:
+        write = None
+    if state is None and write is not None:
+        write('\t'.join(columns) + '\n')
+    lines_in = iter_lines(f_in, shard[1]) if shard else f_in
+    n_lines = chunksize * 4 if fastq else chunksize
+    with f_in:
+        while lines := [line.decode() for line in itertools.islice(lines_in, n_lines)]:
+            if fastq:
+                # chunks start at record boundaries
+                assert lines[0].startswith('@'), 'FASTQ read name does not start with \'@\'.'
+                lines = lines[::4]
+            store_unmatched = max_unmatched - n_stored if f_unmatched is not None else 0
+            df, n, unmatched = barcodes_to_df(lines, regex, split=split, store_unmatched=store_unmatched, pack=pack)
+            df = df.reindex(columns=columns)
+            n_matched += len(df)
+            n_unmatched += n
+            if write is not None:
+                write(df.to_csv(sep='\t', index=False, header=False))
+            if f_unmatched is not None:
+                f_unmatched.write(''.join(unmatched))
+                n_stored += len(unmatched)
+            if path_counts is not None:
+                counts.update(map(tuple, df.fillna('').astype(str).values.tolist()))
+            if checkpoint is not None and checkpoint.due():
+                checkpoint.save(f_in.tell(), outputs, dict(
+                    n_matched=n_matched,
+                    n_unmatched=n_unmatched,
+                    n_stored=n_stored,
+                    counts=[[*key, count] for key, count in counts.items()]
+                ))
+    if path_counts is not None:
+        with open(path_counts, 'w') as f:
+            f.write('\t'.join(columns + ['count']) + '\n')
+            for key, count in counts.most_common():
+                f.write('\t'.join(key) + f'\t{count}\n')
+    for output in outputs:
+        output.close()
+    if checkpoint is not None:
+        checkpoint.remove()
+    return n_matched, n_unmatched
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    n_matched, n_unmatched = parse_barcodes_file(
+        args.input,
+        args.output,
+        re.compile(args.regex),
+        split=args.split,
+        pack=args.pack,
+        path_counts=args.counts,
+        path_unmatched=args.unmatched,
+        max_unmatched=args.max_unmatched,
+        fastq=args.fastq,
+        shard=read_shards(args.shard[0])[int(args.shard[1])] if args.shard else None,
+        table=not args.counts_only,
+        checkpoint_interval=args.checkpoint_interval,
+        resume=args.resume
+    )
+    print(f'Matched {n_matched:,} lines; {n_unmatched:,} lines did not match the regular expression.',
+          file=sys.stderr)
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Extract barcodes from a barcode file into a table, one row per matching line."
+    )
+    parser.add_argument(
+        "input",
+        metavar="barcodes.txt[.gz]|-",
+        help="Barcode file, e.g., '@readname::[R1Bot_1][R2Bot_2]...' per line. Use '-' for standard in."
+    )
+    parser.add_argument(
+        "-r", "--regex",
+        required=True,
+        metavar="REGEX",
+        help="Regular expression with named groups ('(?P<name>...)'), which become the columns of the output."
+    )
+    parser.add_argument(
+        "-o", "--output",
+        metavar="barcodes.tsv[.gz]",
+        help="Output tab-delimited table. Compressed if the path ends with .gz. Default: standard out."
+    )
+    parser.add_argument(
+        "--split",
+        default="::",
+        metavar="STR",
+        help="Search the regular expression in the last field of each line split by STR. Default: '::'."
+    )
+    parser.add_argument(
+        "--pack",
+        action="append",
+        metavar="COLUMN",
+        help=("Output this column of DNA sequences (e.g., a UMI) as 2-bit packed integer keys "
+              "(see sequence_encoding.encode_keys()). Can be repeated.")
+    )
+    parser.add_argument(
+        "--counts",
+        metavar="counts.tsv",
+        help="Write the number of lines of each unique combination of regex group values to this file."
+    )
+    parser.add_argument(
+        "--counts-only",
+        action="store_true",
+        help="Only write --counts, not the table of matching lines."
+    )
+    parser.add_argument(
+        "--fastq",
+        action="store_true",
+        help="The input is a FASTQ file with barcodes in read names (e.g., splitcode output); only parse read names."
+    )
+    parser.add_argument(
+        "--shard",
+        nargs=2,
+        metavar=("shards.tsv", "INDEX"),
+        help="Only parse the INDEX-th (0-based) shard of the input, as listed in a shards file from shard_fastq.py."
+    )
+    parser.add_argument(
+        "--unmatched",
+        metavar="unmatched.txt",
+        help="Write lines that do not match the regular expression to this file, for debugging."
+    )
+    parser.add_argument(
+        "--max-unmatched",
+        type=int,
+        default=100,
+        metavar="N",
+        help="Maximum number of unmatched lines to write with --unmatched. Default: 100."
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        type=float,
+        default=300,
+        metavar="SECONDS",
+        help=("Save progress to OUTPUT.checkpoint (COUNTS.checkpoint with --counts-only) at this interval, so "
+              "that an interrupted run can be resumed with --resume. Use 0 to disable. Requires an input file "
+              "and an output file. Default: 300.")
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help=("Resume from the checkpoint of a previous run with the same arguments, if there is one. "
+              "Outputs are truncated to their size at the checkpoint, so no line is written twice.")
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,19 @@
 from collections import defaultdict
+import argparse
+import functools
+import itertools
+import multiprocessing
 import re
+import sys
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
 from matplotlib.collections import PatchCollection
+from matplotlib.figure import Figure
 from matplotlib.patches import Rectangle
 import matplotlib.ticker
-from helpers import fastq_parse
+from helpers import fastq_parse, file_open
 
 regex_loc_tag = re.compile(r"LX:Z:(([^:]+:\d+,\d+-\d+,?)+)")
 regex_tag = re.compile(r"([^:]+):(\d+),(\d+)-(\d+),?")
@@ -80,7 +88,7 @@ def parse_quals(qual_str, offset=33):
 
     Returns: np.ndarray
     """
-    return np.array([ord(c) - offset for c in qual_str])
+    return np.frombuffer(qual_str.encode("ascii"), dtype=np.uint8).astype(np.int64) - offset
 
 
 def plot_features(feature_coords, ax):
@@ -92,19 +100,19 @@ def plot_features(feature_coords, ax):
         Each tuple describes a feature: (name, start position, end position, y)
     - ax: matplotlib.axes.Axes
 
-    Returns: list of matplotlib.patches.Rectangle, list of matplotlib.text.Text
+    Returns: matplotlib.collections.PatchCollection, list of matplotlib.text.Text
     """
-    rects = [
-        Rectangle((start-0.5, y), (end - start), 1, facecolor=f"C{i}", edgecolor="black")
-        for i, (name, start, end, y) in enumerate(feature_coords)
-    ]
-    for rect in rects:
-        ax.add_patch(rect)
+    rects = PatchCollection(
+        [Rectangle((start-0.5, y), (end - start), 1) for (name, start, end, y) in feature_coords],
+        facecolors=[f"C{i}" for i in range(len(feature_coords))],
+        edgecolors="black",
+    )
+    ax.add_collection(rects, autolim=True)
     texts = [
         ax.text((end - start) / 2 + start, y + 0.5, name, va="center", ha="center")
         for (name, start, end, y) in feature_coords
     ]
-    ax.relim()
+    # Axes.relim() ignores collections; add_collection(autolim=True) already updated the data limits
     ax.autoscale_view()
     ax.spines["right"].set_visible(False)
     ax.spines["top"].set_visible(False)
@@ -155,13 +163,71 @@ def plot_read(seq, quals, feature_coords, axs, reverse=False):
     qscores = parse_quals(quals)
     plot_seq_qscores(seq, qscores, axs[0])
     plot_features(feature_coords, axs[1])
-    xticks = list(range(len(seq)))
-    axs[1].set_xticks(xticks, labels=xticks[::-1] if reverse else xticks)
     axs[1].xaxis.set_major_locator(matplotlib.ticker.AutoLocator())
+    if reverse:
+        n = len(seq) - 1
+        axs[1].xaxis.set_major_formatter(matplotlib.ticker.FuncFormatter(lambda x, pos: f"{n - x:g}"))
+    else:
+        axs[1].xaxis.set_major_formatter(matplotlib.ticker.ScalarFormatter())
     axs[0].margins(x=0.01)
     axs[1].set_xlim(*axs[0].get_xlim())
 
 
+def read_pair_features(name):
+    """
+    Parse features from a read name and lay them out for plotting.
+
+    Args
+    - name: str
+        Read name, including location tag.
+
+    Returns: dict, int
+    - Map from file number to list of 4-tuple (name, start, end, y). Empty if the read name
+      has no location tag.
+    - Number of rows (y values) needed to plot the features.
+    """
+    features = parse_locations(name)
+    if features is None:
+        return defaultdict(list), 0
+    feature_coords = features_to_coordinates(features)
+    max_y = max(
+        [feature[3] + 1 for feature_list in feature_coords.values() for feature in feature_list]
+    )
+    return feature_coords, max_y
+
+
+def draw_read_pair(fig, axs, name, seq1, quals1, seq2=None, quals2=None, reverse2=False, feature_coords=None):
+    """
+    Draw a read pair onto existing axes. See plot_read_pair().
+
+    Args
+    - fig: matplotlib.figure.Figure
+    - axs: np.ndarray of matplotlib.axes.Axes, shape (2, 1) or (2, 2)
+    - feature_coords: dict. default=None
+        Output of read_pair_features(name). Parsed from name if None.
+
+    Returns: None
+    """
+    if feature_coords is None:
+        feature_coords, _ = read_pair_features(name)
+    plot_read(seq1, quals1, feature_coords[0], [axs[0, 0], axs[1, 0]])
+    axs[0, 0].set_title("read 1")
+    if seq2:
+        if reverse2:
+            seq2 = seq2[::-1]
+            quals2 = quals2[::-1]
+            new_feature_coords = []
+            n = len(seq2) - 1
+            for feature_name, start, end, y in feature_coords[1]:
+                start_rev = n - end
+                end_rev = n - start
+                new_feature_coords.append((feature_name, start_rev, end_rev, y))
+            feature_coords[1] = new_feature_coords
+        plot_read(seq2, quals2, feature_coords[1], [axs[0, 1], axs[1, 1]], reverse=reverse2)
+        axs[0, 1].set_title("read 2")
+    fig.suptitle(f"Read {name.split()[0]}")
+
+
 def plot_read_pair(name, seq1, quals1, seq2=None, quals2=None, reverse2=False, fig_kws=None):
     """
     Plot features from a read pair.
@@ -188,39 +254,236 @@ def plot_read_pair(name, seq1, quals1, seq2=None, quals2=None, reverse2=False, f
     """
     if fig_kws is None:
         fig_kws = {}
-    features = parse_locations(name)
-    if features is None:
-        # only plot sequence and FASTQ scores
-        max_y = 0
-    else:
-        # plot sequence, FASTQ scores, features
-        feature_coords = features_to_coordinates(features)
-        max_y = max(
-            [feature[3] + 1 for feature_list in feature_coords.values() for feature in feature_list]
-        )
+    feature_coords, max_y = read_pair_features(name)
     fig_kws_default = dict(
         constrained_layout=True,
-        height_ratios=[4, max_y / 2],
+        height_ratios=[4, max(max_y, 1) / 2],
         width_ratios=[len(seq1), len(seq2)] if seq2 is not None else [1],
         sharey="row",
     )
     fig_kws_default.update(fig_kws)
     ncols = 1 if seq2 is None else 2
     fig, axs = plt.subplots(nrows=2, ncols=ncols, squeeze=False, **fig_kws_default)
-    plot_read(seq1, quals1, feature_coords[0], [axs[0, 0], axs[1, 0]])
-    axs[0, 0].set_title("read 1")
-    if seq2:
-        if reverse2:
-            seq2 = seq2[::-1]
-            quals2 = quals2[::-1]
-            new_feature_coords = []
-            n = len(seq2) - 1
-            for feature_name, start, end, y in feature_coords[1]:
-                start_rev = n - end
-                end_rev = n - start
-                new_feature_coords.append((feature_name, start_rev, end_rev, y))
-            feature_coords[1] = new_feature_coords
-        plot_read(seq2, quals2, feature_coords[1], [axs[0, 1], axs[1, 1]], reverse=reverse2)
-        axs[0, 1].set_title("read 2")
-    fig.suptitle(f"Read {name.split()[0]}")
+    draw_read_pair(fig, axs, name, seq1, quals1, seq2, quals2, reverse2=reverse2, feature_coords=feature_coords)
     return fig
+
+
+class ReadPairPlotter:
+    """
+    Reusable figure for plotting many read pairs.
+
+    The figure and axes are created once (without pyplot) and cleared between reads, instead of
+    creating a new figure per read.
+    """
+
+    def __init__(self, paired=True, fig_kws=None):
+        """
+        Args
+        - paired: bool. default=True
+            Whether reads to be plotted have a read 2.
+        - fig_kws: dict. default=None
+            Keyword arguments to pass to matplotlib.figure.Figure().
+        """
+        fig_kws_default = dict(figsize=(25, 3), constrained_layout=True)
+        fig_kws_default.update(fig_kws or {})
+        self.paired = paired
+        self.fig = Figure(**fig_kws_default)
+        FigureCanvasAgg(self.fig)
+        self.axs = self.fig.subplots(nrows=2, ncols=2 if paired else 1, squeeze=False, sharey="row")
+        self.gridspec = self.axs[0, 0].get_subplotspec().get_gridspec()
+
+    def draw(self, name, seq1, quals1, seq2=None, quals2=None, reverse2=False):
+        """
+        Draw a read pair, replacing the previously drawn read pair. See plot_read_pair().
+
+        Returns: matplotlib.figure.Figure
+        """
+        feature_coords, max_y = read_pair_features(name)
+        # Remove artists rather than calling Axes.cla(), which would also discard the axis ticks
+        # that set_xticks() can otherwise reuse for the next read.
+        for ax in self.axs.flat:
+            for artist in [*ax.lines, *ax.collections, *ax.texts]:
+                artist.remove()
+            ax.set_prop_cycle(None)
+            ax.relim()
+            ax.set_autoscale_on(True)
+        self.gridspec.set_height_ratios([4, max(max_y, 1) / 2])
+        if self.paired:
+            self.gridspec.set_width_ratios([len(seq1), len(seq2)])
+        draw_read_pair(self.fig, self.axs, name, seq1, quals1, seq2, quals2, reverse2=reverse2,
+                       feature_coords=feature_coords)
+        return self.fig
+
+    def render(self, *args, dpi=100, **kwargs):
+        """
+        Draw a read pair and rasterize it.
+
+        Returns: np.ndarray, shape (height, width, 4), dtype uint8
+            RGBA image
+        """
+        self.draw(*args, **kwargs)
+        self.fig.set_dpi(dpi)
+        self.fig.canvas.draw()
+        return np.asarray(self.fig.canvas.buffer_rgba()).copy()
+
+
+def _batched(iterable, n):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, n)):
+        yield batch
+
+
+_worker_plotter = None
+
+
+def _init_render_worker(paired, fig_kws):
+    global _worker_plotter
+    _worker_plotter = ReadPairPlotter(paired=paired, fig_kws=fig_kws)
+
+
+def _render_batch(batch, reverse2=False, dpi=100):
+    return [_worker_plotter.render(*read_pair, reverse2=reverse2, dpi=dpi) for read_pair in batch]
+
+
+def iter_read_pairs(records1, records2=None):
+    """
+    Combine FASTQ records (e.g., from fastq_parse()) of read 1 and read 2 into arguments for
+    plot_read_pair(). The read 1 name (with the location tag) is used as the read pair name.
+
+    Returns: iterator of tuple (name, seq1, quals1[, seq2, quals2])
+    """
+    if records2 is None:
+        for name, seq, _, quals in records1:
+            yield name, seq, quals
+    else:
+        for (name, seq1, _, quals1), (_, seq2, _, quals2) in zip(records1, records2):
+            yield name, seq1, quals1, seq2, quals2
+
+
+def plot_read_pairs_pdf(
+    path,
+    records1,
+    records2=None,
+    reverse2=False,
+    fig_kws=None,
+    processes=1,
+    batch_size=16,
+    dpi=100,
+):
+    """
+    Plot features from many reads into a multi-page PDF, one read (pair) per page.
+
+    Args
+    - path: str
+        Output PDF path
+    - records1: iterable of tuple (name, seq, thrd, qual)
+        Read 1 FASTQ records with location tags in the name, e.g., from fastq_parse().
+    - records2: iterable of tuple (name, seq, thrd, qual). default=None
+        Read 2 FASTQ records, in the same order as records1.
+    - reverse2: bool. default=False
+        See plot_read_pair().
+    - fig_kws: dict. default=None
+        Keyword arguments to pass to matplotlib.figure.Figure(). Default figsize=(25, 3).
+    - processes: int. default=1
+        Number of worker processes. If 1, pages are written as vector graphics by a single reused
+        figure. Otherwise, pages are rendered in parallel as images (at the given dpi) and written
+        in input order.
+    - batch_size: int. default=16
+        Number of reads sent to a worker process at a time.
+    - dpi: int. default=100
+        Resolution of rendered pages if processes > 1.
+
+    Returns: int
+        Number of pages written
+    """
+    paired = records2 is not None
+    read_pairs = iter_read_pairs(records1, records2)
+    n_pages = 0
+    with PdfPages(path) as pdf:
+        if processes == 1:
+            plotter = ReadPairPlotter(paired=paired, fig_kws=fig_kws)
+            for read_pair in read_pairs:
+                pdf.savefig(plotter.draw(*read_pair, reverse2=reverse2))
+                n_pages += 1
+            return n_pages
+        page = Figure()
+        with multiprocessing.Pool(processes, initializer=_init_render_worker, initargs=(paired, fig_kws)) as pool:
+            render = functools.partial(_render_batch, reverse2=reverse2, dpi=dpi)
+            for images in pool.imap(render, _batched(read_pairs, batch_size)):
+                for image in images:
+                    page.clear()
+                    page.set_size_inches(image.shape[1] / dpi, image.shape[0] / dpi)
+                    page.figimage(image, resize=False)
+                    pdf.savefig(page, dpi=dpi)
+                    n_pages += 1
+    return n_pages
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    records1 = itertools.islice(fastq_parse(file_open(args.read1)), args.max_reads)
+    records2 = None
+    if args.read2 is not None:
+        records2 = itertools.islice(fastq_parse(file_open(args.read2)), args.max_reads)
+    n_pages = plot_read_pairs_pdf(
+        args.output,
+        records1,
+        records2,
+        reverse2=args.reverse2,
+        processes=args.processes,
+        dpi=args.dpi
+    )
+    print(f'Wrote {n_pages:,} pages to {args.output}', file=sys.stderr)
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Plot the features (from location tags in read names) of reads into a PDF, one read (pair) per page."
+    )
+    parser.add_argument(
+        "read1",
+        metavar="R1.fastq[.gz]",
+        help="Read 1 FASTQ file, with location tags in read names (e.g., '@readname LX:Z:tag_A:0,3-6')."
+    )
+    parser.add_argument(
+        "read2",
+        nargs="?",
+        metavar="R2.fastq[.gz]",
+        help="Read 2 FASTQ file, with reads in the same order as read 1."
+    )
+    parser.add_argument(
+        "-o", "--output",
+        required=True,
+        metavar="reads.pdf",
+        help="Output PDF file."
+    )
+    parser.add_argument(
+        "--reverse2",
+        action="store_true",
+        help="Plot read 2 in reverse orientation (but not reverse complement)."
+    )
+    parser.add_argument(
+        "-n", "--max-reads",
+        type=int,
+        metavar="N",
+        help="Only plot the first N reads (pairs)."
+    )
+    parser.add_argument(
+        "-p", "--processes",
+        type=int,
+        default=1,
+        metavar="#",
+        help=("Number of worker processes. If greater than 1, pages are rendered in parallel as images "
+              "instead of written as vector graphics.")
+    )
+    parser.add_argument(
+        "--dpi",
+        type=int,
+        default=100,
+        help="Resolution of pages rendered by worker processes. Default: 100."
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main()
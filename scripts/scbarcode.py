@@ -0,0 +1,92 @@
+'''
+Single command-line entry point for the scBarcode tools, with one subcommand per tool.
+
+Only the module of the requested subcommand is imported, so heavy dependencies (pandas, pysam, Bio,
+matplotlib) are loaded only by the subcommands that use them, and `scbarcode.py -h` imports none of them.
+Each subcommand accepts the same arguments as the corresponding script.
+
+Example
+    python scbarcode.py -h
+    python scbarcode.py dedup -h
+    samtools view -u in.bam | python scbarcode.py remove-unpaired -o paired.bam -
+'''
+
+import argparse
+import importlib
+import os
+import sys
+
+PROG = 'scbarcode'
+DIR_SCRIPTS = os.path.abspath(os.path.dirname(__file__))
+DIR_PIPELINE = os.path.join(DIR_SCRIPTS, '20241121')
+
+# subcommand -> (directory, module, description)
+COMMANDS = {
+    'parse-barcodes': (DIR_SCRIPTS, 'parse_barcodes', 'Extract barcodes from a barcode file into a table.'),
+    'demux': (DIR_SCRIPTS, 'demultiplex', 'Find adapters in reads and extract their indices.'),
+    'assign-barcodes': (DIR_SCRIPTS, 'barcode_assign', 'Assign barcodes to a whitelist using base qualities.'),
+    'plot': (DIR_SCRIPTS, 'plot_features', 'Plot read features into a multi-page PDF.'),
+    'shard': (DIR_SCRIPTS, 'shard_fastq', 'Split a FASTQ file into record-aligned byte ranges.'),
+    'merge-barcode-counts': (DIR_SCRIPTS, 'merge_barcode_counts', 'Merge barcode count tables of shards.'),
+    'tag-barcodes': (DIR_PIPELINE, 'tag_barcodes', 'Move barcodes from read names into integer BAM tags.'),
+    'rename-filter': (DIR_PIPELINE, 'rename_and_filter_chr', 'Rename and filter chromosomes of a BAM file.'),
+    'remove-unpaired': (DIR_PIPELINE, 'remove_unpaired', 'Remove unpaired reads from a BAM file.'),
+    'dedup': (DIR_PIPELINE, 'dedup', 'Deduplicate reads by barcode and fragment coordinates.'),
+    'merge-counts': (DIR_PIPELINE, 'merge_counts', 'Merge sorted counts BED files.'),
+    'fragment-store': (DIR_PIPELINE, 'fragment_store', 'Convert a counts BED file into a fragment store.'),
+    'complexity': (DIR_PIPELINE, 'complexity', 'Estimate library complexity from a counts BED file.'),
+    'cell-qc': (DIR_PIPELINE, 'cell_qc', 'Compute per-barcode fragment length and TSS enrichment QC.'),
+    'coverage': (DIR_PIPELINE, 'coverage', 'Build coverage tracks from a counts BED file.'),
+    'count-matrix': (DIR_PIPELINE, 'count_matrix', 'Build a sparse barcode x bin/peak count matrix.'),
+    'barnyard': (DIR_PIPELINE, 'barnyard', 'Compute species-mixing statistics per barcode.'),
+}
+
+
+def load_command(command):
+    '''
+    Import the module implementing a subcommand.
+
+    scripts/ and scripts/20241121/ both contain a helpers module, so the subcommand's directory is put
+    first on sys.path. Only one subcommand is loaded per process.
+
+    Returns: module
+        Module with a main(argv=None) function
+    '''
+    directory, module, _ = COMMANDS[command]
+    sys.path.insert(0, directory)
+    return importlib.import_module(module)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    module = load_command(args.command)
+    # usage and error messages of the subcommand's parser start with 'scbarcode <command>'
+    sys.argv[0] = f'{PROG} {args.command}'
+    module.main(args.args)
+
+
+def parse_arguments(argv=None):
+    width = max(map(len, COMMANDS))
+    parser = argparse.ArgumentParser(
+        prog=PROG,
+        description="scBarcode tools. Run 'scbarcode <command> -h' for the arguments of a command.",
+        epilog='commands:\n' + '\n'.join(
+            f'  {command:<{width}}  {description}' for command, (_, _, description) in COMMANDS.items()),
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "command",
+        choices=list(COMMANDS),
+        metavar="command",
+        help="Command to run (see below)."
+    )
+    parser.add_argument(
+        "args",
+        nargs=argparse.REMAINDER,
+        help="Arguments of the command."
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+'''
+2-bit encoding of DNA sequences in NumPy arrays, for comparing, hashing, and looking up barcodes and
+adapters as integers instead of Python strings.
+
+Representations
+- codes: np.ndarray (uint8), shape (n, length)
+    One code per base: A=0, C=1, G=2, T=3, and N_CODE (4) for N or any other character.
+    The complement of code c < 4 is 3 - c.
+- packed: tuple of np.ndarray (uint64), each of shape (n, n_words)
+    (words, nmask). 32 bases per word, first base in the most significant bits of the first word.
+    nmask has the low bit of a base's 2-bit field set where the base is N (whose bits in words are 0).
+    Used for vectorized Hamming distances (XOR + popcount).
+- keys: np.ndarray (uint64), shape (n,)
+    Sequences of up to MAX_KEY_LENGTH bases without Ns, packed below a sentinel bit that encodes the
+    length, so that sequences of different lengths never collide. 0 is never a valid key. Used for
+    sorting, hashing, set membership, and np.searchsorted() lookups.
+'''
+
+import numpy as np
+
+BASES = 'ACGT'
+N_CODE = 4
+MAX_KEY_LENGTH = 31  # 2 bits per base plus a sentinel bit in 64 bits
+BASES_PER_WORD = 32
+
+_CODES = np.full(256, N_CODE, dtype=np.uint8)
+for _code, _base in enumerate(BASES):
+    _CODES[ord(_base)] = _code
+    _CODES[ord(_base.lower())] = _code
+_LETTERS = np.frombuffer(b'ACGTN', dtype=np.uint8)
+
+# bit patterns for 64-bit words
+_LOW_BITS = np.uint64(0x5555555555555555)  # low bit of each 2-bit field
+_SWAPS = (
+    (np.uint64(2), np.uint64(0x3333333333333333)),
+    (np.uint64(4), np.uint64(0x0F0F0F0F0F0F0F0F)),
+    (np.uint64(8), np.uint64(0x00FF00FF00FF00FF)),
+    (np.uint64(16), np.uint64(0x0000FFFF0000FFFF)),
+    (np.uint64(32), np.uint64(0x00000000FFFFFFFF)),
+)
+
+
+def to_codes(seqs, length=None):
+    '''
+    Encode sequences as a 2-D array of base codes.
+
+    Args
+    - seqs: sequence of str
+    - length: int. default=None
+        Length of the output rows: shorter sequences are padded with N, longer sequences are truncated.
+        If None, all sequences must have the same length.
+
+    Returns: np.ndarray (uint8), shape (len(seqs), length)
+    '''
+    lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+    if length is None:
+        assert len(seqs) == 0 or (lengths == lengths[0]).all(), \
+            'Sequences must have the same length unless length is given.'
+        length = int(lengths[0]) if len(seqs) > 0 else 0
+    flat = _CODES[np.frombuffer(''.join(seqs).encode(), dtype=np.uint8)]
+    if (lengths == length).all():
+        return flat.reshape(len(seqs), length)
+    codes = np.full((len(seqs), length), N_CODE, dtype=np.uint8)
+    starts = np.cumsum(lengths) - lengths
+    positions = np.arange(length)
+    in_seq = positions < lengths[:, np.newaxis]
+    codes[in_seq] = flat[(starts[:, np.newaxis] + positions)[in_seq]]
+    return codes
+
+
+def from_codes(codes):
+    '''
+    Decode a 2-D array of base codes to strings.
+
+    Returns: list of str
+    '''
+    codes = np.asarray(codes, dtype=np.uint8)
+    letters = _LETTERS[np.minimum(codes, N_CODE)]
+    return [row.tobytes().decode() for row in letters]
+
+
+def pack(codes):
+    '''
+    Pack base codes into 64-bit words.
+
+    Args
+    - codes: np.ndarray (uint8), shape (n, length)
+
+    Returns: (words, nmask)
+    - words: np.ndarray (uint64), shape (n, n_words)
+    - nmask: np.ndarray (uint64), shape (n, n_words)
+    '''
+    codes = np.asarray(codes, dtype=np.uint8)
+    n, length = codes.shape
+    n_words = max(1, -(-length // BASES_PER_WORD))
+    padded = np.zeros((n, n_words * BASES_PER_WORD), dtype=np.uint64)
+    is_n = np.zeros(padded.shape, dtype=np.uint64)
+    padded[:, :length] = np.where(codes == N_CODE, 0, codes)
+    is_n[:, :length] = codes == N_CODE
+    padded = padded.reshape(n, n_words, BASES_PER_WORD)
+    is_n = is_n.reshape(n, n_words, BASES_PER_WORD)
+    words = np.zeros((n, n_words), dtype=np.uint64)
+    nmask = np.zeros((n, n_words), dtype=np.uint64)
+    for j in range(BASES_PER_WORD):
+        words <<= np.uint64(2)
+        words |= padded[:, :, j]
+        nmask <<= np.uint64(2)
+        nmask |= is_n[:, :, j]
+    return words, nmask
+
+
+def unpack(words, nmask, length):
+    '''
+    Inverse of pack().
+
+    Returns: np.ndarray (uint8), shape (n, length)
+    '''
+    words = np.asarray(words, dtype=np.uint64)
+    nmask = np.asarray(nmask, dtype=np.uint64)
+    shifts = np.arange(2 * (BASES_PER_WORD - 1), -2, -2, dtype=np.uint64)
+    codes = ((words[:, :, np.newaxis] >> shifts) & np.uint64(3)).astype(np.uint8)
+    is_n = ((nmask[:, :, np.newaxis] >> shifts) & np.uint64(1)).astype(bool)
+    codes[is_n] = N_CODE
+    return codes.reshape(len(words), -1)[:, :length]
+
+
+def popcount(x):
+    '''
+    Number of set bits in each element of an unsigned integer array.
+    '''
+    x = np.asarray(x, dtype=np.uint64)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x).astype(np.int64)
+    return np.unpackbits(x.view(np.uint8).reshape(*x.shape, 8), axis=-1).sum(axis=-1, dtype=np.int64)
+
+
+def hamming(a, b):
+    '''
+    Hamming distances between packed sequences of the same length. N mismatches every base, including N.
+
+    Args
+    - a, b: (words, nmask) tuples, as returned by pack()
+        Shapes must broadcast, e.g., (n, 1, n_words) and (1, m, n_words) for a distance matrix.
+
+    Returns: np.ndarray (int64)
+        Broadcast shape of a and b without the last (word) axis
+    '''
+    words_a, nmask_a = a
+    words_b, nmask_b = b
+    diff = words_a ^ words_b
+    diff = ((diff | (diff >> np.uint64(1))) & _LOW_BITS) | nmask_a | nmask_b
+    return popcount(diff).sum(axis=-1)
+
+
+def hamming_matrix(seqs1, seqs2):
+    '''
+    Pairwise Hamming distances between 2 sets of sequences, all of the same length.
+
+    Returns: np.ndarray (int64), shape (len(seqs1), len(seqs2))
+    '''
+    words1, nmask1 = pack(to_codes(seqs1))
+    words2, nmask2 = pack(to_codes(seqs2))
+    assert words1.shape[1] == words2.shape[1] and \
+        (len(seqs1) == 0 or len(seqs2) == 0 or len(seqs1[0]) == len(seqs2[0])), \
+        'Input strings must have the same length'
+    return hamming(
+        (words1[:, np.newaxis], nmask1[:, np.newaxis]),
+        (words2[np.newaxis], nmask2[np.newaxis])
+    )
+
+
+def encode_keys(seqs):
+    '''
+    Pack sequences into sortable uint64 keys.
+
+    Args
+    - seqs: sequence of str
+
+    Returns: np.ndarray (uint64)
+        Keys. Sequences containing bases other than A, C, G, and T, or longer than MAX_KEY_LENGTH, are
+        encoded as 0.
+    '''
+    keys = np.zeros(len(seqs), dtype=np.uint64)
+    lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+    flat = _CODES[np.frombuffer(''.join(seqs).encode(), dtype=np.uint8)]
+    starts = np.cumsum(lengths) - lengths
+    for length in np.unique(lengths):
+        if length > MAX_KEY_LENGTH:
+            continue
+        if lengths[0] == length and len(flat) == length * len(lengths):
+            # all sequences have the same length
+            idx = np.arange(len(lengths))
+            codes = flat.reshape(len(lengths), length)
+        else:
+            idx = np.flatnonzero(lengths == length)
+            codes = flat[starts[idx, np.newaxis] + np.arange(length)]
+        valid = (codes != N_CODE).all(axis=1)
+        keys[idx[valid]] = codes_to_keys(codes[valid])
+    return keys
+
+
+def codes_to_keys(codes):
+    '''
+    Args
+    - codes: np.ndarray (uint8), shape (n, length)
+        Base codes without N, with length <= MAX_KEY_LENGTH
+
+    Returns: np.ndarray (uint64), shape (n,)
+    '''
+    n, length = codes.shape
+    assert length <= MAX_KEY_LENGTH
+    keys = np.ones(n, dtype=np.uint64)
+    for j in range(length):
+        keys <<= np.uint64(2)
+        keys |= codes[:, j]
+    return keys
+
+
+def key_lengths(keys):
+    '''
+    Returns: np.ndarray (int64)
+        Sequence length encoded by each key (-1 for the invalid key 0)
+    '''
+    keys = np.asarray(keys, dtype=np.uint64)
+    lengths = np.full(keys.shape, -1, dtype=np.int64)
+    for length in range(MAX_KEY_LENGTH + 1):
+        lengths[(keys >> np.uint64(2 * length)) == 1] = length
+    return lengths
+
+
+def decode_keys(keys):
+    '''
+    Inverse of encode_keys().
+
+    Returns: list of (str or None)
+        None for the invalid key 0
+    '''
+    keys = np.asarray(keys, dtype=np.uint64)
+    lengths = key_lengths(keys)
+    seqs = [None] * len(keys)
+    for length in np.unique(lengths):
+        if length < 0:
+            continue
+        idx = np.flatnonzero(lengths == length)
+        shifts = np.arange(2 * length - 2, -2, -2, dtype=np.uint64)
+        codes = ((keys[idx, np.newaxis] >> shifts) & np.uint64(3)).astype(np.uint8)
+        for i, seq in zip(idx.tolist(), from_codes(codes)):
+            seqs[i] = seq
+    return seqs
+
+
+def _reverse_fields(x):
+    # reverse the order of the 32 2-bit fields of each 64-bit word
+    for shift, mask in _SWAPS:
+        x = ((x >> shift) & mask) | ((x & mask) << shift)
+    return x
+
+
+def reverse_complement_keys(keys):
+    '''
+    Reverse complement sequences encoded as keys.
+
+    Returns: np.ndarray (uint64)
+    '''
+    keys = np.asarray(keys, dtype=np.uint64)
+    lengths = key_lengths(keys)
+    sentinel = np.where(lengths >= 0, np.uint64(1) << (2 * np.maximum(lengths, 0)).astype(np.uint64), 0)
+    payload = keys ^ sentinel
+    complement = ~payload & (sentinel - np.uint64(1))
+    # after reversing all 32 fields, the sequence occupies the top 2 * length bits
+    shift = (64 - 2 * np.maximum(lengths, 0)).astype(np.uint64)
+    reversed_ = np.where(lengths > 0, _reverse_fields(complement) >> np.minimum(shift, np.uint64(63)), 0)
+    return np.where(lengths >= 0, reversed_ | sentinel, 0).astype(np.uint64)
+
+
+def reverse_complement_codes(codes):
+    '''
+    Reverse complement a 2-D array of base codes (N stays N).
+    '''
+    codes = np.asarray(codes, dtype=np.uint8)
+    return np.where(codes < N_CODE, 3 - codes, codes)[:, ::-1]
+
+
+def reverse_complement(seqs):
+    '''
+    Reverse complement sequences of any lengths (characters other than ACGT become N).
+
+    Returns: list of str
+    '''
+    lengths = [len(seq) for seq in seqs]
+    if len(set(lengths)) <= 1:
+        return from_codes(reverse_complement_codes(to_codes(seqs)))
+    max_length = max(lengths)
+    rc = from_codes(reverse_complement_codes(to_codes(seqs, length=max_length)))
+    # padding Ns are at the start of each reverse-complemented row
+    return [seq[max_length - length:] for seq, length in zip(rc, lengths)]
+
+
+def kmers(seq, k):
+    '''
+    Packed k-mers at every position of a sequence.
+
+    Args
+    - seq: str or np.ndarray (uint8) of base codes
+    - k: int
+        k-mer length, at most BASES_PER_WORD
+
+    Returns: (kmers, valid)
+    - kmers: np.ndarray (uint64), shape (max(len(seq) - k + 1, 0),)
+        k-mer starting at each position, 2 bits per base without a sentinel bit
+    - valid: np.ndarray (bool)
+        Whether each k-mer contains no N
+    '''
+    assert 0 < k <= BASES_PER_WORD
+    codes = to_codes([seq])[0] if isinstance(seq, str) else np.asarray(seq, dtype=np.uint8)
+    n = max(len(codes) - k + 1, 0)
+    result = np.zeros(n, dtype=np.uint64)
+    invalid = np.zeros(n, dtype=bool)
+    for j in range(k):
+        window = codes[j:j + n]
+        result <<= np.uint64(2)
+        result |= np.where(window == N_CODE, 0, window).astype(np.uint64)
+        invalid |= window == N_CODE
+    return result, ~invalid
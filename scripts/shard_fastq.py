@@ -0,0 +1,232 @@
+"""
+Split a FASTQ file into record-aligned byte ranges (shards) without rewriting it, so that shards can be
+processed by independent jobs (e.g., `scbarcode parse-barcodes --fastq --shard shards.tsv 3`) and their
+results merged (e.g., with merge_barcode_counts.py).
+
+Shard boundaries are byte offsets for uncompressed files and BGZF virtual offsets for files compressed with
+bgzip. Files compressed with regular gzip cannot be sharded without decompressing them from the start, so
+they are read in one pass: the last shard spans the whole file and the other shards are empty. This fallback is
+for ad-hoc use; recompress such files with bgzip (as the pipeline does) to shard them.
+
+Example
+    shards = shard_fastq('reads.fastq.gz', 16)
+    with open('shards.tsv', 'w') as f:
+        write_shards(f, shards)
+    start, end = read_shards('shards.tsv')[3]
+    with open_input('reads.fastq.gz', offset=start) as f:
+        for name, seq, thrd, qual in fastq_parse(iter_lines(f, end)):
+            ...
+"""
+
+import argparse
+import collections
+import os
+import struct
+import sys
+from checkpoint import open_input
+from fastq_index import is_bgzf
+
+# end of a shard that extends to the end of a file whose uncompressed size is unknown (regular gzip)
+UNBOUNDED = sys.maxsize
+
+
+def _bgzf_block_offsets(path):
+    """
+    Compressed offsets of the blocks of a BGZF file, read from block headers without decompressing blocks.
+    """
+    with open(path, "rb") as f:
+        offset = 0
+        while True:
+            header = f.read(12)
+            if len(header) == 0:
+                return
+            assert len(header) == 12 and header[:4] == b"\x1f\x8b\x08\x04", "ERROR: Invalid BGZF block."
+            extra = f.read(struct.unpack("<H", header[10:12])[0])
+            block_size = None
+            i = 0
+            while i < len(extra):
+                subfield_len = struct.unpack("<H", extra[i + 2:i + 4])[0]
+                if extra[i:i + 2] == b"BC":
+                    block_size = struct.unpack("<H", extra[i + 4:i + 6])[0] + 1
+                i += 4 + subfield_len
+            assert block_size is not None, "ERROR: BGZF block is missing the BC subfield."
+            yield offset
+            offset += block_size
+            f.seek(offset)
+
+
+def _next_record(f, offset, skip_partial_line=True):
+    """
+    Find the start of the first FASTQ record at or after a position.
+
+    A line is the name line of a record if it starts with '@' and the line 2 lines later starts with '+'.
+    (A quality line can start with '@', but the line 2 lines after it is a sequence line.)
+
+    Args
+    - f: file object
+        As returned by checkpoint.open_input()
+    - offset: int
+        Position (byte offset or BGZF virtual offset) at the start of a line, or, if skip_partial_line is
+        True, anywhere within a line.
+    - skip_partial_line: bool. default=True
+        Skip to the start of the next line first.
+
+    Returns: int or None
+        Position of the record, or None if there is no record after offset.
+    """
+    f.seek(offset)
+    if skip_partial_line:
+        f.readline()
+    window = collections.deque(maxlen=3)  # (position, first byte) of the last 3 lines
+    while True:
+        position = f.tell()
+        line = f.readline()
+        if len(line) == 0:
+            return None
+        window.append((position, line[:1]))
+        if len(window) == 3 and window[0][1] == b"@" and window[2][1] == b"+":
+            return window[0][0]
+
+
+def shard_fastq(path, n_shards):
+    """
+    Split a FASTQ file into record-aligned shards of approximately equal (compressed) size.
+
+    Args
+    - path: str
+        Path to FASTQ file, either uncompressed or compressed with bgzip. Files compressed with regular
+        gzip are not split: all shards but the last are empty.
+    - n_shards: int
+        Number of shards. Shards of small files may be empty.
+
+    Returns: list of (int, int)
+        Start (inclusive) and end (exclusive) position of each shard: byte offsets for uncompressed files
+        and BGZF virtual offsets for bgzip-compressed files. The end of the last shard is past the end of
+        the file (UNBOUNDED for regular gzip files).
+    """
+    assert n_shards >= 1, "ERROR: The number of shards must be at least 1."
+    size = os.path.getsize(path)
+    bgzf_compressed = is_bgzf(path)
+    if not bgzf_compressed:
+        with open(path, "rb") as f:
+            gzip_compressed = f.read(2) == b"\x1f\x8b"
+        if gzip_compressed:
+            # positions in regular gzip files are uncompressed offsets, reached only by decompressing from the start
+            return [(0, 0)] * (n_shards - 1) + [(0, UNBOUNDED)]
+    if bgzf_compressed:
+        blocks = list(_bgzf_block_offsets(path))
+        # start searching for records at the first block at or after each evenly spaced compressed offset
+        targets = []
+        i_block = 0
+        for i in range(1, n_shards):
+            while i_block < len(blocks) and blocks[i_block] < size * i // n_shards:
+                i_block += 1
+            targets.append(blocks[i_block] << 16 if i_block < len(blocks) else None)
+        eof = size << 16
+    else:
+        targets = [size * i // n_shards for i in range(1, n_shards)]
+        eof = size
+    boundaries = [0]
+    with open_input(path) as f:
+        for target in targets:
+            if target is None:
+                start = eof
+            elif target <= boundaries[-1]:
+                # the previous shard already extends past the target: this shard is empty
+                start = boundaries[-1]
+            else:
+                # target can be within a line (a BGZF block starts at the beginning of a line only by chance)
+                start = _next_record(f, target)
+                start = start if start is not None else eof
+            boundaries.append(start)
+    boundaries.append(eof)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def iter_lines(f, end):
+    """
+    Iterate over the lines of a file object up to a position.
+
+    Args
+    - f: file object
+        As returned by checkpoint.open_input()
+    - end: int
+        Position (exclusive) at which to stop, e.g., the end of a shard
+
+    Returns: iterator of bytes
+    """
+    while f.tell() < end:
+        line = f.readline()
+        if len(line) == 0:
+            return
+        yield line
+
+
+def write_shards(f, shards):
+    """
+    Write shards to a file object as a tab-delimited table; columns = shard, start, end.
+    """
+    f.write("shard\tstart\tend\n")
+    for i, (start, end) in enumerate(shards):
+        f.write(f"{i}\t{start}\t{end}\n")
+
+
+def read_shards(path):
+    """
+    Returns: list of (int, int)
+        Start and end position of each shard, as written by write_shards()
+    """
+    with open(path) as f:
+        header = f.readline().rstrip("\n").split("\t")
+        assert header == ["shard", "start", "end"], f"ERROR: {path} is not a shards file."
+        shards = []
+        for line in f:
+            i, start, end = map(int, line.rstrip("\n").split("\t"))
+            assert i == len(shards), f"ERROR: Shards in {path} are not numbered consecutively from 0."
+            shards.append((start, end))
+    return shards
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    shards = shard_fastq(args.input, args.shards)
+    if shards[-1][1] == UNBOUNDED and args.shards > 1:
+        print(f"{args.input} is compressed with gzip, not bgzip: it is read in one pass by the last shard. "
+              "Recompress it with bgzip to shard it.",
+              file=sys.stderr)
+    if args.output is None:
+        write_shards(sys.stdout, shards)
+    else:
+        with open(args.output, "w") as f:
+            write_shards(f, shards)
+    print(f"Split {args.input} into {len(shards)} shards.", file=sys.stderr)
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description=("Split a FASTQ file into record-aligned byte ranges (shards) without rewriting it. "
+                     "Output is a tab-delimited table; columns = shard, start, end.")
+    )
+    parser.add_argument(
+        "input",
+        metavar="reads.fastq[.gz]",
+        help=("FASTQ file, either uncompressed or compressed with bgzip. A file compressed with regular gzip "
+              "is not split: all of it is in the last shard.")
+    )
+    parser.add_argument(
+        "-n", "--shards",
+        type=int,
+        required=True,
+        metavar="N",
+        help="Number of shards."
+    )
+    parser.add_argument(
+        "-o", "--output",
+        metavar="shards.tsv",
+        help="Output table of shards. Default: standard out."
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,6 @@
 import itertools
+import numpy as np
+import sequence_encoding
 
 def hamming_distance(s1, s2):
     """
@@ -137,6 +139,16 @@ def generate_variant_map(seqs, dist_total, dist_hamming=None, dist_indel=None, v
     return result
 
 
+def hamming_distance_matrix(seqs1, seqs2):
+    '''
+    Pairwise Hamming distances between 2 collections of strings of equal length, computed on 2-bit packed
+    sequences (XOR + popcount). Characters other than A, C, G, and T mismatch every character.
+
+    Returns: np.ndarray (int64), shape (len(seqs1), len(seqs2))
+    '''
+    return sequence_encoding.hamming_matrix(list(seqs1), list(seqs2))
+
+
 def min_group_distance(seqs, distfun):
     '''
     Compute the minimum distance between any 2 sequences in a group.
@@ -152,6 +164,11 @@ def min_group_distance(seqs, distfun):
     - If distfun is `hamming_distance`, then np.nan is returned if not all
       the sequences in seqs have the same length.
     '''
+    seqs = list(seqs)
+    if distfun is hamming_distance and len(seqs) > 1 and len(set(map(len, seqs))) == 1 \
+            and all(set(seq) <= set(sequence_encoding.BASES) for seq in seqs):
+        distances = hamming_distance_matrix(seqs, seqs)
+        return int(distances[np.triu_indices(len(seqs), k=1)].min())
     try:
         return min(distfun(a, b) for a, b in itertools.combinations(seqs, 2))
     except ValueError as e:
@@ -0,0 +1,298 @@
+'''
+Synthetic data resembling scBarcode sequencing data, for benchmarking.
+
+- Reads built from adapter layouts, with random index sequences and random substitutions and indels
+- Read barcode files in the format of the splitcode-generated read_barcodes files
+- Name-sorted paired-end BAM files with barcodes in read names and a controlled duplicate rate
+'''
+
+import gzip
+import numpy as np
+
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+COMPLEMENT = str.maketrans('ACGTN', 'TGCAN')
+
+ADAPTER_2PUNI = 'AATGATACGGCGACCACCGAGATCTACACNNNNNNNNACACTCTTTCCCTACACGACGCTCTTCCGATC'
+ADAPTER_2PBC = 'CAAGCAGAAGACGGCATACGAGATNNNNNNNNGTGACTGGAGTTCAGACGTGTGCTCTTCCGATCT'
+ADAPTERS = {'2Puni': ADAPTER_2PUNI, '2Pbc': ADAPTER_2PBC}
+
+# barcode rounds of the split-pool barcoding scheme, in read order
+ROUNDS = ('Y', 'R3', 'R2', 'R1')
+ROUND_TAGS = {'Y': 'NYStgBot', 'R3': 'R3Bot', 'R2': 'R2Bot', 'R1': 'R1Bot'}
+REGEX_BARCODE = (
+    r'\[NYStgBot_(?P<Y>\d+)\]'
+    r'\[R3\]'
+    r'\[R3Bot_(?P<R3>\d+)\]'
+    r'\[R2\]'
+    r'\[R2Bot_(?P<R2>\d+)\]'
+    r'\[R1\]'
+    r'\[R1Bot_(?P<R1>\d+)\]'
+    r'\[Even\]\[2Puni\]'
+    r'\s+'
+    r'RX:Z:(?P<umi>[ACGNT]*)'
+)
+
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def random_seqs(rng, n, length):
+    '''
+    Returns: list of str
+        n random DNA sequences of the given length
+    '''
+    codes = BASES[rng.integers(0, 4, size=(n, length))]
+    return [row.tobytes().decode() for row in codes]
+
+
+def random_whitelist(rng, n, length, min_distance=1, distfun=None):
+    '''
+    Random set of DNA sequences with pairwise distance >= min_distance.
+
+    Args
+    - rng: np.random.Generator
+    - n: int
+        Number of sequences
+    - length: int
+        Length of each sequence
+    - min_distance: int. default=1
+    - distfun: callable. default=None
+        Distance function taking 2 strings, such as string_distances.levenshtein_distance.
+        If None, use Hamming distance.
+
+    Returns: list of str
+    '''
+    seqs = []
+    codes = np.zeros((0, length), dtype=np.int8)
+    while len(seqs) < n:
+        for candidate in rng.integers(0, 4, size=(n, length), dtype=np.int8):
+            if len(seqs) == n:
+                break
+            seq = BASES[candidate].tobytes().decode()
+            if distfun is None:
+                accept = len(codes) == 0 or (codes != candidate).sum(axis=1).min() >= min_distance
+            else:
+                accept = all(distfun(seq, other) >= min_distance for other in seqs)
+            if accept:
+                codes = np.vstack((codes, candidate))
+                seqs.append(seq)
+    return seqs
+
+
+def mutate(seq, rng, sub_rate=0.0, indel_rate=0.0):
+    '''
+    Introduce random substitutions, insertions, and deletions into a sequence.
+
+    Args
+    - seq: str
+    - rng: np.random.Generator
+    - sub_rate: float. default=0
+        Per-base probability of a substitution (to a different base)
+    - indel_rate: float. default=0
+        Per-base probability of an indel. Insertions (of a random base after the base) and deletions
+        are equally likely.
+
+    Returns: str
+    '''
+    if sub_rate == 0 and indel_rate == 0:
+        return seq
+    codes = np.searchsorted(BASES, np.frombuffer(seq.encode(), dtype=np.uint8))
+    n = len(codes)
+    sub = rng.random(n) < sub_rate
+    codes[sub] = (codes[sub] + rng.integers(1, 4, size=sub.sum())) % 4
+    bases = BASES[codes]
+    if indel_rate > 0:
+        event = rng.random(n)
+        deletion = event < indel_rate / 2
+        insertion = (event >= indel_rate / 2) & (event < indel_rate)
+        bases = np.insert(bases, np.flatnonzero(insertion) + 1, BASES[rng.integers(0, 4, size=insertion.sum())])
+        bases = np.delete(bases, np.flatnonzero(deletion) + np.cumsum(insertion)[deletion] - insertion[deletion])
+    return bases.tobytes().decode()
+
+
+def random_quals(rng, n, length, quals='F:,#', p=(0.85, 0.1, 0.04, 0.01)):
+    '''
+    Returns: list of str
+        n random quality strings
+    '''
+    symbols = np.frombuffer(quals.encode(), dtype=np.uint8)
+    codes = symbols[rng.choice(len(symbols), size=(n, length), p=p)]
+    return [row.tobytes().decode() for row in codes]
+
+
+def synthetic_reads(
+    n,
+    layout=(ADAPTER_2PUNI, 40, reverse_complement(ADAPTER_2PBC)),
+    read_length=150,
+    sub_rate=0.005,
+    indel_rate=0.001,
+    seed=None
+):
+    '''
+    Generate reads from an adapter layout.
+
+    Args
+    - n: int
+        Number of reads
+    - layout: sequence of str or int
+        Segments of each read, in order. A str is an adapter sequence, where each run of Ns is filled with
+        a random index sequence. An int is the length of a random insert.
+    - read_length: int. default=150
+        Reads are truncated or padded with random sequence to this length.
+    - sub_rate, indel_rate: see mutate()
+    - seed: int or np.random.Generator. default=None
+
+    Returns: iterator of tuple of str (name, seq, thrd, qual)
+        As returned by fastq_parse()
+    '''
+    rng = np.random.default_rng(seed)
+    quals = random_quals(rng, min(n, 10000), read_length)
+    for i in range(n):
+        segments = []
+        for segment in layout:
+            if isinstance(segment, int):
+                segments.append(random_seqs(rng, 1, segment)[0])
+            else:
+                segments.append(''.join(
+                    random_seqs(rng, 1, len(part))[0] if part.startswith('N') else part
+                    for part in _split_Ns(segment)
+                ))
+        seq = mutate(''.join(segments), rng, sub_rate=sub_rate, indel_rate=indel_rate)
+        if len(seq) < read_length:
+            seq += random_seqs(rng, 1, read_length - len(seq))[0]
+        yield f'@read{i}', seq[:read_length], '+', quals[i % len(quals)]
+
+
+def _split_Ns(seq):
+    '''
+    Split a sequence into runs of Ns and runs of other bases.
+    '''
+    parts = []
+    for base in seq:
+        if parts and (base == 'N') == parts[-1].startswith('N'):
+            parts[-1] += base
+        else:
+            parts.append(base)
+    return parts
+
+
+def write_fastq(path, records):
+    '''
+    Write FASTQ records (tuples of name, seq, thrd, qual) to a file, gzip-compressed if path ends with .gz.
+
+    Returns: int
+        Number of records written
+    '''
+    opener = gzip.open if path.endswith('.gz') else open
+    n = 0
+    with opener(path, 'wt') as f:
+        for name, seq, thrd, qual in records:
+            f.write(f'{name}\n{seq}\n{thrd}\n{qual}\n')
+            n += 1
+    return n
+
+
+def synthetic_barcode_lines(n, n_wells=24, umi_length=12, unmatched_rate=0.05, seed=None):
+    '''
+    Generate lines of a read barcodes file, matched by REGEX_BARCODE.
+    Example: '@read0::[NYStgBot_21][R3][R3Bot_21][R2][R2Bot_22][R1][R1Bot_21][Even][2Puni] RX:Z:ACGTACGTACGT'
+
+    Args
+    - n: int
+        Number of lines
+    - n_wells: int. default=24
+        Number of barcodes per round
+    - umi_length: int. default=12
+    - unmatched_rate: float. default=0.05
+        Fraction of lines missing a barcode round (which do not match REGEX_BARCODE)
+    - seed: int or np.random.Generator. default=None
+
+    Returns: iterator of str
+    '''
+    rng = np.random.default_rng(seed)
+    wells = rng.integers(1, n_wells + 1, size=(n, len(ROUNDS)))
+    unmatched = rng.random(n) < unmatched_rate
+    umis = random_seqs(rng, n, umi_length)
+    for i in range(n):
+        tags = [f'[{ROUND_TAGS[r]}_{w}]' for r, w in zip(ROUNDS, wells[i])]
+        if unmatched[i]:
+            tags[rng.integers(len(tags))] = ''
+        yield (f'@read{i}::{tags[0]}[R3]{tags[1]}[R2]{tags[2]}[R1]{tags[3]}[Even][2Puni]'
+               f' RX:Z:{umis[i]}\n')
+
+
+def write_paired_bam(
+    path,
+    n,
+    duplicate_rate=0.3,
+    n_barcodes=1000,
+    chrom_sizes=None,
+    read_length=50,
+    fragment_length=(100, 600),
+    seed=None
+):
+    '''
+    Write a name-sorted (read pairs adjacent) paired-end BAM file with barcodes in read names
+    ('::bead=<barcode>') and a controlled fraction of duplicate fragments.
+
+    Args
+    - path: str
+    - n: int
+        Number of read pairs
+    - duplicate_rate: float. default=0.3
+        Fraction of read pairs that duplicate (same coordinates and barcode) an earlier read pair
+    - n_barcodes: int. default=1000
+    - chrom_sizes: dict (str -> int). default=None
+        Chromosome names and lengths. Default: 3 chromosomes of 10 Mb.
+    - read_length: int. default=50
+    - fragment_length: tuple of (int, int). default=(100, 600)
+        Range of fragment lengths
+    - seed: int or np.random.Generator. default=None
+
+    Returns: int
+        Number of unique fragments
+    '''
+    import pysam
+    rng = np.random.default_rng(seed)
+    if chrom_sizes is None:
+        chrom_sizes = {f'chr{i}': 10_000_000 for i in range(1, 4)}
+    header = {
+        'HD': {'VN': '1.6', 'SO': 'queryname'},
+        'SQ': [{'SN': name, 'LN': length} for name, length in chrom_sizes.items()]
+    }
+    lengths = np.array(list(chrom_sizes.values()))
+    n_unique = n - int(round(n * duplicate_rate))
+    chroms = rng.choice(len(lengths), size=n_unique, p=lengths / lengths.sum())
+    frag_lengths = rng.integers(fragment_length[0], fragment_length[1] + 1, size=n_unique)
+    starts = rng.integers(0, lengths[chroms] - frag_lengths)
+    barcodes = rng.integers(0, n_barcodes, size=n_unique)
+    reverse = rng.random(n_unique) < 0.5
+    fragments = np.concatenate((np.arange(n_unique), rng.integers(0, n_unique, size=n - n_unique)))
+    rng.shuffle(fragments)
+    seqs = random_seqs(rng, 1000, read_length)
+    qual = pysam.qualitystring_to_array('F' * read_length)
+    with pysam.AlignmentFile(path, 'wb', header=header) as f:
+        for i, j in enumerate(fragments):
+            start, end = int(starts[j]), int(starts[j] + frag_lengths[j])
+            tlen = end - start
+            # read 1 on the forward strand: flags 99/147; read 1 on the reverse strand: flags 83/163
+            mates = [(start, 99 if not reverse[j] else 163, tlen), (end - read_length, 147 if not reverse[j] else 83, -tlen)]
+            if reverse[j]:
+                mates = mates[::-1]
+            for k, (pos, flag, template_length) in enumerate(mates):
+                mate_pos = mates[1 - k][0]
+                read = pysam.AlignedSegment(f.header)
+                read.query_name = f'pair{i}::bead={barcodes[j]}'
+                read.flag = flag
+                read.reference_id = int(chroms[j])
+                read.reference_start = pos
+                read.mapping_quality = 42
+                read.cigarstring = f'{read_length}M'
+                read.next_reference_id = int(chroms[j])
+                read.next_reference_start = mate_pos
+                read.template_length = template_length
+                read.query_sequence = seqs[i % len(seqs)]
+                read.query_qualities = qual
+                f.write(read)
+    return n_unique